@@ -0,0 +1,84 @@
+#
+# Type caster lookup used by the hooks
+#
+
+import functools
+import hashlib
+import json
+import re
+import typing
+
+CasterCfg = typing.Dict[str, typing.Any]
+
+_type_caster_seps = re.compile(r"[<>\(\)]")
+
+
+@functools.lru_cache(maxsize=None)
+def split_typename(typename: str) -> typing.Tuple[str, ...]:
+    """
+    Splits a type into the names that may have type casters: the template
+    (or the type itself if it isn't a template) and each of its parameters
+    """
+    tmpl_idx = typename.find("<")
+    if tmpl_idx == -1:
+        return (typename,)
+
+    return (typename[:tmpl_idx],) + tuple(
+        _type_caster_seps.split(typename[tmpl_idx:].replace(" ", ""))
+    )
+
+
+class CasterIndex:
+    """
+    Resolves the type casters used by types. The casters used by each type
+    are only looked up once, and the index for a set of casters is shared
+    by every wrapper and generation job that uses the same set.
+    """
+
+    def __init__(self, casters: typing.Dict[str, CasterCfg], key: str):
+        self.casters = casters
+        self.key = key
+
+        self._cfgs: typing.Dict[str, typing.Tuple[CasterCfg, ...]] = {}
+        self._includes: typing.Dict[str, typing.FrozenSet[str]] = {}
+
+    def __reduce__(self):
+        # jobs that run in other processes share the index there too
+        return _get_index, (self.casters, self.key)
+
+    def get_cfgs(self, typename: str) -> typing.Tuple[CasterCfg, ...]:
+        """Returns the configuration of each caster used by the type"""
+        cfgs = self._cfgs.get(typename)
+        if cfgs is None:
+            get = self.casters.get
+            cfgs = tuple(
+                ccfg
+                for ccfg in map(get, filter(None, split_typename(typename)))
+                if ccfg
+            )
+            self._cfgs[typename] = cfgs
+        return cfgs
+
+    def get_includes(self, typename: str) -> typing.FrozenSet[str]:
+        """Returns the headers of the casters used by the type"""
+        includes = self._includes.get(typename)
+        if includes is None:
+            includes = frozenset(ccfg["hdr"] for ccfg in self.get_cfgs(typename))
+            self._includes[typename] = includes
+        return includes
+
+
+_indexes: typing.Dict[str, CasterIndex] = {}
+
+
+def _get_index(casters: typing.Dict[str, CasterCfg], key: str) -> CasterIndex:
+    index = _indexes.get(key)
+    if index is None:
+        index = _indexes[key] = CasterIndex(casters, key)
+    return index
+
+
+def get_caster_index(casters: typing.Dict[str, CasterCfg]) -> CasterIndex:
+    """Returns the shared index for the casters"""
+    key = hashlib.sha256(json.dumps(casters, sort_keys=True).encode("utf-8"))
+    return _get_index(casters, key.hexdigest())
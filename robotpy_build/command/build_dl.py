@@ -2,6 +2,7 @@ from distutils.core import Command
 from typing import List
 import os.path
 
+from ..download import check_offline, open_archives, parallel_downloads
 from ..platforms import get_platform
 from ..static_libs import StaticLib
 from ..wrapper import Wrapper
@@ -41,10 +42,23 @@ class BuildDl(Command):
             self.lib_unpack_to = os.path.join(self.build_temp, "dlstatic")
 
     def run(self):
-        for lib in self.static_libs:
-            lib.on_build_dl(self.build_cache, self.lib_unpack_to)
-        for wrapper in self.wrappers:
-            wrapper.on_build_dl(self.build_cache, self.src_unpack_to)
+        # everything is downloaded in the background while the archives
+        # that have already been downloaded are extracted. Archives are only
+        # opened once, even if several wrappers extract parts of them
+        urls = [
+            dl.url
+            for item in self.static_libs + self.wrappers
+            for dl in item.cfg.download or ()
+        ]
+
+        # when offline, fail before anything is extracted
+        check_offline(urls, self.build_cache)
+
+        with parallel_downloads(urls, self.build_cache), open_archives():
+            for lib in self.static_libs:
+                lib.on_build_dl(self.build_cache, self.lib_unpack_to)
+            for wrapper in self.wrappers:
+                wrapper.on_build_dl(self.build_cache, self.src_unpack_to)
 
         # On OSX, fix library loader paths for embedded libraries
         # -> this happens here so that the libs are modified before build_py
@@ -2,21 +2,32 @@
 # Portions copied from pybind11's setup_helpers.py
 #
 
+import contextlib
+import hashlib
+import json
 import os
-from os.path import join
+from os.path import exists, join
 from setuptools.command.build_ext import build_ext
 import platform
 import setuptools
+import shutil
+import subprocess
 import sys
 import sysconfig
 import tempfile
+import threading
+import typing
 
 from .util import get_install_root
+from .. import dlcache
 from ..platforms import get_platform
 
 # TODO: only works for GCC
 debug = os.environ.get("RPYBUILD_DEBUG") == "1"
 
+# precompiled headers are only supported for GCC/Clang on Linux
+use_pch = os.environ.get("RPYBUILD_PCH") == "1"
+
 WIN = sys.platform.startswith("win32") and "mingw" not in sysconfig.get_platform()
 MACOS = sys.platform.startswith("darwin")
 STD_TMPL = "/std:c++{}" if WIN else "-std=c++{}"
@@ -39,13 +50,167 @@ def has_flag(compiler, flagname):
     return True
 
 
-def cxx_std(compiler) -> int:
+#: Programs that run the compiler that follows them on the command line, or
+#: that pretend to be the compiler when symlinked to its name
+COMPILER_LAUNCHERS = {"ccache", "sccache", "distcc", "icecc", "buildcache"}
+
+
+def _is_launcher(exe: str) -> bool:
+    name = os.path.splitext(os.path.basename(exe))[0].lower()
+    launcher = os.environ.get("RPYBUILD_CC_LAUNCHER")
+    if launcher and name == os.path.splitext(os.path.basename(launcher))[0].lower():
+        return True
+    return name in COMPILER_LAUNCHERS
+
+
+def find_compiler(cmd: typing.List[str]) -> typing.Optional[str]:
+    """
+    Returns the compiler executable that the command runs, looking past
+    launchers such as ccache. Returns None if it can't be found.
+    """
+    for arg in cmd:
+        # skip launchers and their options
+        if _is_launcher(arg) or arg.startswith("-"):
+            continue
+
+        exe = shutil.which(arg)
+        if exe is None:
+            return None
+        exe = os.path.realpath(exe)
+        if not _is_launcher(exe):
+            return exe
+
+        # the launcher is symlinked to the compiler's name (such as
+        # /usr/lib/ccache/g++), the compiler is further down the PATH
+        for d in os.environ.get("PATH", "").split(os.pathsep):
+            exe = shutil.which(os.path.basename(arg), path=d)
+            if exe is not None and not _is_launcher(os.path.realpath(exe)):
+                return os.path.realpath(exe)
+        return None
+
+    return None
+
+
+class ProbeCache:
+    """
+    Remembers which flags a compiler supports, so that they are only
+    checked once for each compiler. Results are keyed on the compiler
+    executable (not the launcher that runs it), its version output, the
+    command line and the flag, and are stored in the shared cache. Flags
+    that aren't supported are checked again each time, since the check may
+    have failed for another reason.
+    """
+
+    def __init__(self, compiler, fname: typing.Optional[str]):
+        self.compiler = compiler
+        self.fname = fname
+        self._key: typing.Optional[str] = None
+        self._data: typing.Dict[str, typing.Any] = self._load()
+
+    def _load(self) -> typing.Dict[str, typing.Any]:
+        data = {}
+        if self.fname is not None:
+            try:
+                with open(self.fname) as fp:
+                    data = json.load(fp)
+            except (OSError, ValueError):
+                pass
+        data.setdefault("versions", {})
+        data.setdefault("flags", {})
+        return data
+
+    def _save(self, update: typing.Callable[[typing.Dict[str, typing.Any]], None]):
+        if self.fname is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            # other builds may have added results since this was loaded
+            with dlcache.locked(f"{self.fname}.lock"):
+                self._data = self._load()
+                update(self._data)
+                tmp = f"{self.fname}.{os.getpid()}.tmp"
+                with open(tmp, "w") as fp:
+                    json.dump(self._data, fp)
+                os.replace(tmp, self.fname)
+        except OSError:
+            pass
+
+    def _get_command(self) -> typing.List[str]:
+        if self.compiler.compiler_type == "msvc":
+            if not getattr(self.compiler, "initialized", True):
+                self.compiler.initialize()
+            return [self.compiler.cc]
+        return list(self.compiler.compiler_so)
+
+    def _get_version(self, exe: str) -> str:
+        # the version output is only checked again if the executable changes
+        st = os.stat(exe)
+        stamp = [st.st_size, st.st_mtime_ns]
+        cached = self._data["versions"].get(exe)
+        if cached is not None and cached[:2] == stamp:
+            return cached[2]
+
+        args = [exe] if self.compiler.compiler_type == "msvc" else [exe, "--version"]
+        r = subprocess.run(
+            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False
+        )
+        version = r.stdout.decode("utf-8", "replace")
+
+        def _update(data):
+            data["versions"][exe] = stamp + [version]
+
+        self._save(_update)
+        return version
+
+    def _get_key(self) -> typing.Optional[str]:
+        if self._key is None:
+            cmd = self._get_command()
+            exe = find_compiler(cmd)
+            if exe is None:
+                return None
+            key = [exe, self._get_version(exe), cmd]
+            self._key = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return self._key
+
+    def has_flag(self, flagname: str) -> bool:
+        """Like has_flag, but uses the cached result if there is one"""
+        key = None
+        if self.fname is not None:
+            with contextlib.suppress(OSError):
+                key = self._get_key()
+        if key is None:
+            return has_flag(self.compiler, flagname)
+
+        flags = self._data["flags"].setdefault(key, {})
+        if flags.get(flagname):
+            return True
+
+        result = has_flag(self.compiler, flagname)
+        if result:
+
+            def _update(data):
+                data["flags"].setdefault(key, {})[flagname] = True
+
+            self._save(_update)
+        return result
+
+
+def get_probe_cache_fname() -> typing.Optional[str]:
+    """Where compiler probe results are stored, None if the cache is disabled"""
+    if dlcache.get_cache_size() <= 0:
+        return None
+    return join(dlcache.get_cache_dir(), "compiler-probes.json")
+
+
+def cxx_std(compiler, probes: typing.Optional[ProbeCache] = None) -> int:
     """Return the -std=c++[11/14/17/20] compiler flag.
     The newer version is prefered over c++11 (when it is available).
     """
+    if probes is None:
+        probes = ProbeCache(compiler, None)
 
     for level in (20, 17, 17, 11):
-        if has_flag(compiler, STD_TMPL.format(level)):
+        if probes.has_flag(STD_TMPL.format(level)):
             return level
 
     raise RuntimeError("Unsupported compiler -- at least C++11 support is needed!")
@@ -87,7 +252,9 @@ class BuildExt(build_ext):
 
     def build_extensions(self):
         ct = self.compiler.compiler_type
-        std = cxx_std(self.compiler)
+        self._use_pch = use_pch and ct == "unix" and get_platform().os == "linux"
+        probes = ProbeCache(self.compiler, get_probe_cache_fname())
+        std = cxx_std(self.compiler, probes)
         opts, link_opts = get_opts(ct, std)
 
         # To support ccache on windows
@@ -101,7 +268,7 @@ class BuildExt(build_ext):
             else:
                 opts.append("-g0")  # remove debug symbols
             opts.append(STD_TMPL.format(std))
-            if has_flag(self.compiler, "-fvisibility=hidden"):
+            if probes.has_flag("-fvisibility=hidden"):
                 opts.append("-fvisibility=hidden")
 
             if cc_launcher:
@@ -114,7 +281,7 @@ class BuildExt(build_ext):
             opts.append(STD_TMPL.format(std))
             opts.append("/Zc:__cplusplus")
             # Enable standards-compliant preprocessor
-            if has_flag(self.compiler, "/Zc:preprocessor"):
+            if probes.has_flag("/Zc:preprocessor"):
                 opts.append("/Zc:preprocessor")
             if cc_launcher:
                 # yes, this is terrible. There's really no other way with distutils
@@ -155,6 +322,61 @@ class BuildExt(build_ext):
                 # Used in build_pyi
                 ext.rpybuild_libs = libs
 
+    def build_extension(self, ext):
+        wrapper = getattr(ext, "rpybuild_wrapper", None)
+        if not self._use_pch or wrapper is None or not wrapper.pch_includes:
+            build_ext.build_extension(self, ext)
+            return
+
+        # The precompiled header is force-included into each generated
+        # source. GCC and Clang both look for '<header>.gch' next to the
+        # header, and fall back to the header itself if the flags differ
+        pch_dir = join(self.build_temp, "rpygen_pch", ext.name)
+        pch_hdr = join(pch_dir, "rpygen_pch.hpp")
+        pch_gch = pch_hdr + ".gch"
+
+        os.makedirs(pch_dir, exist_ok=True)
+        with open(pch_hdr, "w") as fp:
+            fp.write("// This file is autogenerated. DO NOT EDIT\n")
+            for inc in wrapper.pch_includes:
+                fp.write(f"#include <{inc}>\n")
+
+        compiler = self.compiler
+        _compile = compiler._compile
+        pch_sources = wrapper.pch_sources
+        pch_lock = threading.Lock()
+        pch_built = False
+
+        # The header is precompiled with the same flags as the first
+        # generated source, right before it is compiled. When
+        # RPYBUILD_PARALLEL is set the other sources wait for it
+        def _pch_compile(obj, src, ext, cc_args, extra_postargs, pp_opts):
+            nonlocal pch_built
+            if src in pch_sources:
+                with pch_lock:
+                    if not pch_built:
+                        if exists(pch_gch):
+                            os.unlink(pch_gch)
+                        _compile(
+                            pch_gch,
+                            pch_hdr,
+                            ".hpp",
+                            cc_args + ["-x", "c++-header"],
+                            extra_postargs,
+                            pp_opts,
+                        )
+                        pch_built = True
+
+                cc_args = cc_args + ["-Winvalid-pch", "-include", pch_hdr]
+
+            _compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+
+        compiler._compile = _pch_compile
+        try:
+            build_ext.build_extension(self, ext)
+        finally:
+            del compiler._compile
+
     def run(self):
 
         # files need to be generated before building can occur
@@ -2,7 +2,7 @@ from distutils.core import Command
 from typing import List
 import os.path
 
-from ..wrapper import Wrapper
+from ..wrapper import Wrapper, get_caster_indexes
 
 
 class BuildGen(Command):
@@ -12,6 +12,7 @@ class BuildGen(Command):
     user_options = [
         ("build-base=", "b", "base directory for build library"),
         ("build-temp=", "t", "temporary build directory"),
+        ("build-cache=", None, "build directory to cache parsed headers"),
         ("cxx-gen-dir=", "b", "Directory to write generated C++ files"),
     ]
     wrappers: List[Wrapper] = []
@@ -19,12 +20,14 @@ class BuildGen(Command):
     def initialize_options(self):
         self.build_base = None
         self.build_temp = None
+        self.build_cache = None
         self.cxx_gen_dir = None
 
     def finalize_options(self):
         self.set_undefined_options(
             "build", ("build_base", "build_base"), ("build_temp", "build_temp")
         )
+        self.set_undefined_options("build_dl", ("build_cache", "build_cache"))
         if self.cxx_gen_dir is None:
             self.cxx_gen_dir = os.path.join(self.build_temp, "gensrc")
 
@@ -32,5 +35,10 @@ class BuildGen(Command):
         # files need to be downloaded before building can occur
         self.run_command("build_dl")
 
+        caster_indexes = get_caster_indexes(self.wrappers)
         for wrapper in self.wrappers:
-            wrapper.on_build_gen(self.cxx_gen_dir)
+            wrapper.on_build_gen(
+                self.cxx_gen_dir,
+                cache_dir=self.build_cache,
+                caster_index=caster_indexes.get(wrapper.name),
+            )
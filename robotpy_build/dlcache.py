@@ -0,0 +1,486 @@
+#
+# User-level cache of downloaded artifacts, shared by every project that is
+# built by the same user
+#
+
+import contextlib
+import hashlib
+import json
+import os
+from os.path import expanduser, join
+import shutil
+import sys
+import time
+import typing
+
+#: Entries used more recently than this are never evicted, since a build
+#: may still be reading them
+EVICT_GRACE = 10 * 60
+
+#: Partially downloaded files are kept for this long so they can be resumed
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+#: ETag and Last-Modified of a downloaded file
+Validators = typing.Dict[str, typing.Optional[str]]
+
+
+def get_cache_dir() -> str:
+    """
+    Location of the shared cache, set via RPYBUILD_CACHE_DIR. Defaults to
+    the user's cache directory.
+    """
+    cache_dir = os.environ.get("RPYBUILD_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or expanduser("~/AppData/Local")
+    elif sys.platform == "darwin":
+        base = expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or expanduser("~/.cache")
+
+    return join(base, "robotpy-build")
+
+
+def get_cache_size() -> int:
+    """
+    Size limit of the shared cache in MiB, set via RPYBUILD_CACHE_SIZE.
+    0 disables the shared cache.
+    """
+    return int(os.environ.get("RPYBUILD_CACHE_SIZE", "4096"))
+
+
+def get_artifact_cache() -> typing.Optional["ArtifactCache"]:
+    """Returns the shared artifact cache, or None if it is disabled"""
+    size = get_cache_size()
+    if size <= 0:
+        return None
+    return ArtifactCache(join(get_cache_dir(), "downloads"), size * 1024 * 1024)
+
+
+@contextlib.contextmanager
+def locked(fname: str):
+    """Holds an exclusive lock on the file, which is shared by processes"""
+    with open(fname, "a+b") as fp:
+        if sys.platform == "win32":
+            import msvcrt
+
+            while True:
+                try:
+                    fp.seek(0)
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    pass
+            try:
+                yield
+            finally:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def sha256_file(fname: str) -> str:
+    """Returns the SHA-256 of the content of the file"""
+    h = hashlib.sha256()
+    with open(fname, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _write_json(fname: str, data: typing.Dict[str, typing.Any]):
+    tmp = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump(data, fp)
+    os.replace(tmp, fname)
+
+
+def _remove_files(fnames: typing.Iterable[str]):
+    for fname in fnames:
+        try:
+            os.unlink(fname)
+        except OSError:
+            pass
+
+
+class ArtifactCache:
+    """
+    Downloaded files, keyed on their full URL. The content of each file is
+    stored once under its SHA-256, and is verified against it whenever it
+    is reused.
+
+    * index/<key>.json: url, sha256, size, when it was last used and the
+      validators (ETag/Last-Modified) returned by the server
+    * blobs/<sha256>: content of the downloaded files
+    * tmp/<key>.part: partially downloaded files
+    * locks/<key>.lock: held while a URL is being downloaded or looked up
+    * unpacked/<sha256>: files extracted from archives, so that builds can
+      link them instead of extracting them again
+    * patched/<sha256>-<key>: the same, after patches have been applied
+    * <dir>.json: manifest of each unpacked or patched directory, which
+      records the size of its files. Its mtime is when it was last used.
+    * probes/<key>.json: which files exist in a maven artifact directory,
+      as found by parse-maven. Its mtime is when it was last used.
+
+    When the cache grows larger than max_size bytes, the least recently
+    used entries and directories are removed.
+    """
+
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+
+        self.index_dir = join(root, "index")
+        self.blob_dir = join(root, "blobs")
+        self.lock_dir = join(root, "locks")
+        self.tmp_dir = join(root, "tmp")
+        self.unpacked_dir = join(root, "unpacked")
+        self.patched_dir = join(root, "patched")
+        self.probe_dir = join(root, "probes")
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _makedirs(self):
+        for d in (
+            self.index_dir,
+            self.blob_dir,
+            self.lock_dir,
+            self.tmp_dir,
+            self.unpacked_dir,
+            self.patched_dir,
+            self.probe_dir,
+        ):
+            os.makedirs(d, exist_ok=True)
+
+    def _lock(self, key: str):
+        return locked(join(self.lock_dir, f"{key}.lock"))
+
+    def _blob(self, sha256: str) -> str:
+        return join(self.blob_dir, sha256)
+
+    def is_blob(self, fname: str) -> bool:
+        """Returns True if the file is content stored in the cache"""
+        return os.path.dirname(os.path.abspath(fname)) == os.path.abspath(self.blob_dir)
+
+    def get_unpacked_dir(self, sha256: str) -> str:
+        """Where the archive with this content is extracted to"""
+        return join(self.unpacked_dir, sha256)
+
+    def lock_unpacked(self, sha256: str):
+        """Held while the archive with this content is being extracted"""
+        self._makedirs()
+        return self._lock(f"unpacked-{sha256}")
+
+    def get_patched_dir(self, sha256: str, key: str) -> str:
+        """Where the archive with this content is extracted and patched to"""
+        return join(self.patched_dir, f"{sha256}-{key}")
+
+    def lock_patched(self, sha256: str, key: str):
+        """Held while the archive with this content is being patched"""
+        self._makedirs()
+        return self._lock(f"patched-{sha256}-{key}")
+
+    def load_probes(self, dir_url: str) -> typing.Optional[typing.Dict[str, bool]]:
+        """Returns the probe results stored for the directory url, if any"""
+        fname = join(self.probe_dir, f"{self._key(dir_url)}.json")
+        try:
+            with open(fname) as fp:
+                probes = json.load(fp)
+            # keeps it from being evicted
+            os.utime(fname)
+        except (OSError, ValueError):
+            return None
+        return probes
+
+    def save_probes(self, dir_url: str, probes: typing.Dict[str, bool]):
+        """Stores which of the files in the directory url exist"""
+        self._makedirs()
+        _write_json(join(self.probe_dir, f"{self._key(dir_url)}.json"), probes)
+
+    def _load_entry(self, key: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        try:
+            with open(join(self.index_dir, f"{key}.json")) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _lookup(self, key: str) -> typing.Optional[str]:
+        entry = self._load_entry(key)
+        if entry is None:
+            return None
+
+        blob = self._blob(entry["sha256"])
+        try:
+            valid = sha256_file(blob) == entry["sha256"]
+        except OSError:
+            valid = False
+
+        if not valid:
+            print("WARNING: discarding corrupted cache entry for", entry["url"])
+            _remove_files([blob, join(self.index_dir, f"{key}.json")])
+            return None
+
+        entry["used"] = time.time()
+        _write_json(join(self.index_dir, f"{key}.json"), entry)
+        return blob
+
+    def get(self, url: str) -> typing.Optional[str]:
+        """Returns the filename of the cached content of the url, if any"""
+        key = self._key(url)
+        self._makedirs()
+        with self._lock(key):
+            return self._lookup(key)
+
+    def contains(self, url: str) -> bool:
+        """
+        Returns True if the url has been downloaded to the cache. Unlike get,
+        the content isn't verified.
+        """
+        entry = self._load_entry(self._key(url))
+        return entry is not None and os.path.exists(self._blob(entry["sha256"]))
+
+    def fetch(
+        self,
+        url: str,
+        download: typing.Callable[
+            [str, str, typing.Optional[Validators]], typing.Optional[Validators]
+        ],
+        revalidate: bool = False,
+    ) -> str:
+        """
+        Returns the filename of the cached content of the url, calling
+        download(url, fname, validators) to download it to fname if it isn't
+        cached. Other processes that fetch the same url wait for the
+        download to finish.
+
+        If revalidate is True, download is called with the validators stored
+        for a cached file, and should only download the file if it has
+        changed. download returns the validators of the file it downloaded,
+        or None if it did not download it.
+        """
+        key = self._key(url)
+        self._makedirs()
+        with self._lock(key):
+            blob = self._lookup(key)
+            if blob is not None and not revalidate:
+                return blob
+
+            # partially downloaded files are left here so that they can
+            # be resumed
+            tmp = join(self.tmp_dir, key)
+            try:
+                if blob is None:
+                    validators = download(url, tmp, None)
+                else:
+                    entry = self._load_entry(key) or {}
+                    validators = download(url, tmp, entry.get("validators") or {})
+                    if validators is None:
+                        return blob
+
+                sha256 = sha256_file(tmp)
+                size = os.stat(tmp).st_size
+                blob = self._blob(sha256)
+                os.replace(tmp, blob)
+            finally:
+                _remove_files([tmp])
+
+            entry = {
+                "url": url,
+                "sha256": sha256,
+                "size": size,
+                "used": time.time(),
+                "validators": validators,
+            }
+            _write_json(join(self.index_dir, f"{key}.json"), entry)
+
+        self.evict(self.max_size)
+        return blob
+
+    def entries(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Returns every entry in the cache, least recently used first"""
+        entries = []
+        with contextlib.suppress(OSError), os.scandir(self.index_dir) as it:
+            for dentry in it:
+                if dentry.name.endswith(".json"):
+                    entry = self._load_entry(dentry.name[:-5])
+                    if entry is not None:
+                        entry["key"] = dentry.name[:-5]
+                        entries.append(entry)
+
+        entries.sort(key=lambda e: e["used"])
+        return entries
+
+    def trees(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Returns every unpacked or patched directory in the cache, least
+        recently used first
+        """
+        trees = []
+        for d, kind in ((self.unpacked_dir, "unpacked"), (self.patched_dir, "patched")):
+            with contextlib.suppress(OSError), os.scandir(d) as it:
+                for dentry in it:
+                    if not dentry.name.endswith(".json"):
+                        continue
+                    try:
+                        used = dentry.stat().st_mtime
+                        with open(dentry.path) as fp:
+                            size = json.load(fp)["size"]
+                    except (OSError, ValueError, KeyError, TypeError):
+                        continue
+                    name = dentry.name[:-5]
+                    trees.append(
+                        {
+                            "path": dentry.path[:-5],
+                            "lock": f"{kind}-{name}",
+                            "sha256": name[:64],
+                            "size": size,
+                            "used": used,
+                        }
+                    )
+
+        trees.sort(key=lambda t: t["used"])
+        return trees
+
+    def probes(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Returns every stored probe result, least recently used first"""
+        probes = []
+        with contextlib.suppress(OSError), os.scandir(self.probe_dir) as it:
+            for dentry in it:
+                if dentry.name.endswith(".json"):
+                    with contextlib.suppress(OSError):
+                        st = dentry.stat()
+                        probes.append(
+                            {
+                                "path": dentry.path,
+                                "size": st.st_size,
+                                "used": st.st_mtime,
+                            }
+                        )
+
+        probes.sort(key=lambda p: p["used"])
+        return probes
+
+    def total_size(self) -> int:
+        """Size of the content stored in the cache"""
+        total = sum(t["size"] for t in self.trees() + self.probes())
+        with contextlib.suppress(OSError), os.scandir(self.blob_dir) as it:
+            for dentry in it:
+                with contextlib.suppress(OSError):
+                    total += dentry.stat().st_size
+        return total
+
+    def _remove_tree(self, tree: typing.Dict[str, typing.Any]) -> bool:
+        with self._lock(tree["lock"]):
+            # might have been used since it was loaded
+            manifest = f"{tree['path']}.json"
+            try:
+                if os.stat(manifest).st_mtime != tree["used"]:
+                    return False
+            except OSError:
+                return False
+            _remove_files([manifest])
+            shutil.rmtree(tree["path"], ignore_errors=True)
+        return True
+
+    def evict(self, max_size: int, grace: float = EVICT_GRACE) -> int:
+        """
+        Removes the least recently used entries, unpacked or patched
+        directories and probe results until the cache is no larger than
+        max_size bytes, along with content that no entry refers to. Returns
+        the number of entries, directories and probe results removed.
+        """
+        entries = self.entries()
+        trees = self.trees()
+        probes = self.probes()
+        sizes = {e["sha256"]: e["size"] for e in entries}
+        total = sum(sizes.values()) + sum(t["size"] for t in trees + probes)
+
+        removed = 0
+        now = time.time()
+        for entry in sorted(entries + trees + probes, key=lambda e: e["used"]):
+            if total <= max_size or now - entry["used"] < grace:
+                break
+
+            if "lock" not in entry and "path" in entry:
+                # might have been used since it was loaded
+                with contextlib.suppress(OSError):
+                    if os.stat(entry["path"]).st_mtime == entry["used"]:
+                        os.unlink(entry["path"])
+                        removed += 1
+                        total -= entry["size"]
+                continue
+
+            if "path" in entry:
+                # may have been removed along with its archive
+                if any(t is entry for t in trees) and self._remove_tree(entry):
+                    removed += 1
+                    total -= entry["size"]
+                    trees = [t for t in trees if t is not entry]
+                continue
+
+            with self._lock(entry["key"]):
+                # might have been used since the entry was loaded
+                current = self._load_entry(entry["key"])
+                if current is None or current["used"] != entry["used"]:
+                    continue
+                _remove_files([join(self.index_dir, f"{entry['key']}.json")])
+
+            removed += 1
+            sha256 = entry["sha256"]
+            refcount = sum(1 for e in entries if e["sha256"] == sha256)
+            entries = [e for e in entries if e is not entry]
+            if refcount == 1:
+                _remove_files([self._blob(sha256)])
+                total -= sizes[sha256]
+
+                # directories extracted from it aren't used without it
+                for tree in trees:
+                    if tree["sha256"] == sha256 and self._remove_tree(tree):
+                        removed += 1
+                        total -= tree["size"]
+                trees = [t for t in trees if t["sha256"] != sha256]
+
+        keep = {e["sha256"] for e in entries}
+        self._remove_orphans(self.blob_dir, keep, now - grace)
+        self._remove_orphans(self.unpacked_dir, keep, now - grace)
+        self._remove_orphans(self.patched_dir, keep, now - grace)
+        self._remove_orphans(self.tmp_dir, set(), now - max(grace, PARTIAL_MAX_AGE))
+        return removed
+
+    def _remove_orphans(self, d: str, keep: typing.Set[str], before: float):
+        with contextlib.suppress(OSError), os.scandir(d) as it:
+            for dentry in it:
+                # named after the content of the archive they came from
+                if dentry.name[:64] in keep:
+                    continue
+                # may be in the process of being added
+                with contextlib.suppress(OSError):
+                    if dentry.stat().st_mtime < before:
+                        if dentry.is_dir():
+                            shutil.rmtree(dentry.path, ignore_errors=True)
+                        else:
+                            _remove_files([dentry.path])
+
+    def clear(self):
+        """Removes everything in the cache"""
+        for d in (
+            self.index_dir,
+            self.blob_dir,
+            self.tmp_dir,
+            self.unpacked_dir,
+            self.patched_dir,
+            self.probe_dir,
+        ):
+            shutil.rmtree(d, ignore_errors=True)
@@ -1,63 +1,533 @@
 import atexit
+from concurrent.futures import Future, ThreadPoolExecutor
 import contextlib
+import email.message
+import errno
+import hashlib
+import http.client
+import io
+import json
 import os
-from os.path import dirname, exists, join, normpath
+from os.path import basename, dirname, exists, join, normpath, relpath
 import posixpath
 import shutil
+import ssl
 import sys
+from urllib.error import HTTPError, URLError
+import urllib.parse
 import urllib.request
 import tempfile
+import threading
+import typing
 import zipfile
 
+from .dlcache import Validators, get_artifact_cache, locked, sha256_file
 from .version import version
 
-
 USER_AGENT = f"robotpy-build/{version}"
 SHOW_PROGRESS = "CI" not in os.environ
 
 
-def _download(url: str, dst_fname: str):
+_TIMEOUT = 60
+_MAX_REDIRECTS = 10
+
+# connections are reused for each file downloaded from the same host by the
+# same thread
+_connections = threading.local()
+
+
+def _get_connection(scheme: str, netloc: str) -> http.client.HTTPConnection:
+    conns = getattr(_connections, "conns", None)
+    if conns is None:
+        conns = _connections.conns = {}
+
+    conn = conns.get((scheme, netloc))
+    if conn is None:
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                netloc, timeout=_TIMEOUT, context=ssl.create_default_context()
+            )
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=_TIMEOUT)
+        conns[(scheme, netloc)] = conn
+    return conn
+
+
+def _close_connections():
+    conns = getattr(_connections, "conns", None)
+    if conns:
+        for conn in conns.values():
+            conn.close()
+        conns.clear()
+
+
+def _uses_proxy(parts: urllib.parse.SplitResult) -> bool:
+    return parts.scheme in urllib.request.getproxies() and not (
+        urllib.request.proxy_bypass(parts.hostname or "")
+    )
+
+
+def _open(url: str, headers: typing.Dict[str, str], method: str = "GET"):
+    """
+    Sends a request for the url and returns the response, following any
+    redirects. Raises HTTPError for error responses, except for 416.
+    """
+    headers = dict(headers)
+    headers["User-Agent"] = USER_AGENT
+
+    for _ in range(_MAX_REDIRECTS):
+        parts = urllib.parse.urlsplit(url)
+
+        # urllib is used for anything that http.client can't handle alone
+        if parts.scheme not in ("http", "https") or _uses_proxy(parts):
+            request = urllib.request.Request(url, headers=headers, method=method)
+            try:
+                return urllib.request.urlopen(request, timeout=_TIMEOUT)
+            except HTTPError as e:
+                if e.code in (304, 416):
+                    return e
+                raise
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        # a reused connection may have been closed by the server
+        for retry in (True, False):
+            conn = _get_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+                break
+            except (http.client.HTTPException, OSError):
+                _close_connections()
+                if not retry:
+                    raise
+
+        status = resp.status
+        if status in (301, 302, 303, 307, 308):
+            location = resp.headers.get("Location")
+            resp.read()
+            if not location:
+                raise HTTPError(
+                    url, status, "redirect without location", resp.headers, None
+                )
+            url = urllib.parse.urljoin(url, location)
+            continue
+
+        if status >= 400 and status != 416:
+            body = resp.read()
+            raise HTTPError(url, status, resp.reason, resp.headers, io.BytesIO(body))
+
+        return resp
+
+    raise HTTPError(url, 310, "too many redirects", email.message.Message(), None)
+
+
+def _status(resp) -> int:
+    return resp.code if isinstance(resp, HTTPError) else resp.status
+
+
+def _get_validators(resp) -> Validators:
+    return {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+
+
+def _read_json(fname: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    try:
+        with open(fname) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _download(
+    url: str,
+    dst_fname: str,
+    show_progress: bool = SHOW_PROGRESS,
+    validators: typing.Optional[Validators] = None,
+) -> typing.Optional[Validators]:
     """
     Downloads a file to a specified directory
+
+    If the validators of a previously downloaded copy of the file are given,
+    the file is only downloaded if it has changed, otherwise None is
+    returned. Returns the validators of the downloaded file.
+
+    The file is downloaded to dst_fname.part first. If the download is
+    interrupted, the next download of the same url to dst_fname continues
+    where it left off, as long as the file has not changed on the server.
     """
 
-    def _reporthook(count, blocksize, totalsize):
-        if SHOW_PROGRESS:
-            percent = int(count * blocksize * 100 / totalsize)
-            sys.stdout.write("\r%02d%%" % percent)
-            sys.stdout.flush()
+    part_fname = f"{dst_fname}.part"
+    part_info_fname = f"{dst_fname}.part.json"
+
+    headers = {}
+    offset = 0
+    part_info = _read_json(part_info_fname)
+    if part_info is not None and part_info.get("url") == url and exists(part_fname):
+        offset = os.stat(part_fname).st_size
+        validator = part_info.get("etag") or part_info.get("last_modified")
+        if offset and validator:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+    elif validators is not None:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
 
-    print("Downloading", url)
+    completed = False
+    try:
+        resp = _open(url, headers)
+        with contextlib.closing(resp):
+            status = _status(resp)
+            if status == 304:
+                resp.read()
+                completed = True
+                return None
 
-    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+            if status == 416:
+                # the partial file doesn't match the file on the server
+                resp.read()
+                completed = True
+                _remove_files([part_fname, part_info_fname])
+                return _download(url, dst_fname, show_progress, validators)
 
-    with contextlib.closing(urllib.request.urlopen(request)) as fp:
-        headers = fp.info()
+            resp_validators = _get_validators(resp)
+            if status == 206:
+                print(f"Resuming download of {url}")
+                mode = "ab"
+            else:
+                print(f"Downloading {url}")
+                mode = "wb"
+                offset = 0
 
-        with open(dst_fname, "wb") as tfp:
+            # records what the partial file is, so that it can be resumed
+            if resp_validators["etag"] or resp_validators["last_modified"]:
+                with open(part_info_fname, "w") as fp:
+                    json.dump(dict(resp_validators, url=url), fp)
+            else:
+                _remove_files([part_info_fname])
 
-            # copied from urlretrieve source code, Python license
-            bs = 1024 * 8
             size = -1
-            blocknum = 0
-            read = 0
-            if "content-length" in headers:
-                size = int(headers["Content-Length"])
-
-            while True:
-                block = fp.read(bs)
-                if not block:
-                    break
-                read += len(block)
-                tfp.write(block)
-                blocknum += 1
-                if _reporthook:
-                    _reporthook(blocknum, bs, size)
-
-    if SHOW_PROGRESS:
+            if "content-length" in resp.headers:
+                size = offset + int(resp.headers["Content-Length"])
+
+            with open(part_fname, mode) as tfp:
+                read = offset
+                while True:
+                    block = resp.read(1024 * 64)
+                    if not block:
+                        break
+                    read += len(block)
+                    tfp.write(block)
+                    if show_progress and size > 0:
+                        sys.stdout.write("\r%02d%%" % int(read * 100 / size))
+                        sys.stdout.flush()
+
+            # the connection may be closed before everything was sent
+            if size >= 0 and read != size:
+                raise http.client.IncompleteRead(b"", size - read)
+
+            completed = True
+    finally:
+        if not completed:
+            _close_connections()
+
+    os.replace(part_fname, dst_fname)
+    _remove_files([part_info_fname])
+
+    if show_progress:
         sys.stdout.write("\n")
         sys.stdout.flush()
 
+    return resp_validators
+
+
+def url_exists(url: str) -> typing.Optional[bool]:
+    """
+    Checks whether the url exists using a HEAD request. Returns None if
+    that couldn't be determined, such as when the server can't be reached.
+    """
+    try:
+        try:
+            resp = _open(url, {}, "HEAD")
+            # leaves the connection ready for the next request
+            resp.read()
+        except HTTPError as e:
+            if e.code not in (405, 501):
+                raise
+            # the server doesn't support HEAD, so the file is requested
+            # instead; its body isn't read, so the connection can't be reused
+            resp = _open(url, {}, "GET")
+            _close_connections()
+
+        with contextlib.closing(resp):
+            return _status(resp) == 200
+
+    except HTTPError as e:
+        return None if e.code >= 500 else False
+    except (OSError, http.client.HTTPException):
+        return None
+
+
+def probe_urls(
+    urls: typing.Iterable[str], jobs: int
+) -> typing.Dict[str, typing.Optional[bool]]:
+    """
+    Checks whether each url exists (see url_exists), with up to jobs
+    requests at once. Each thread reuses its connection to the server.
+    """
+    urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max(jobs, 1)) as executor:
+        return dict(zip(urls, executor.map(url_exists, urls)))
+
+
+def get_revalidate_mode() -> str:
+    """
+    When cached files are checked for changes on the server, set via
+    RPYBUILD_DL_REVALIDATE: 'snapshot' (the default) checks files whose url
+    contains SNAPSHOT, 'always' checks every file, 'never' checks none.
+    """
+    mode = os.environ.get("RPYBUILD_DL_REVALIDATE", "snapshot")
+    if mode not in ("snapshot", "always", "never"):
+        raise ValueError(
+            f"RPYBUILD_DL_REVALIDATE must be snapshot, always or never, not {mode!r}"
+        )
+    return mode
+
+
+def is_offline() -> bool:
+    """
+    When set via RPYBUILD_OFFLINE=1, files that aren't in the cache are not
+    downloaded, and cached files are never revalidated
+    """
+    return os.environ.get("RPYBUILD_OFFLINE", "0") not in ("", "0")
+
+
+def _offline_error(urls: typing.Sequence[str]) -> OSError:
+    return OSError(
+        "RPYBUILD_OFFLINE is set, but these files have not been downloaded:\n  "
+        + "\n  ".join(urls)
+        + "\nUse 'robotpy-build prefetch' to download them first"
+    )
+
+
+def needs_revalidation(url: str) -> bool:
+    """Returns True if a cached copy of the url should be revalidated"""
+    if is_offline():
+        return False
+    mode = get_revalidate_mode()
+    return mode == "always" or (mode == "snapshot" and "SNAPSHOT" in url)
+
+
+def revalidate(
+    url: str,
+    fname: str,
+    validators: typing.Optional[Validators],
+    show_progress: bool = SHOW_PROGRESS,
+) -> typing.Optional[Validators]:
+    """
+    Downloads the url to fname if it has changed since the copy with the
+    specified validators was downloaded, and returns the new validators.
+    Returns None if it has not changed, or if the server can't be reached.
+    """
+    if not validators or not (
+        validators.get("etag") or validators.get("last_modified")
+    ):
+        validators = {"etag": None, "last_modified": None}
+    try:
+        return _download(url, fname, show_progress, validators)
+    except (HTTPError, URLError, http.client.HTTPException, OSError) as e:
+        print(f"WARNING: could not check {url} for changes ({e}), using cached copy")
+        return None
+
+
+def _download_to_cache(url: str, cache: str, show_progress: bool = SHOW_PROGRESS):
+    # the shared cache is used instead of the project's cache if enabled
+    artifacts = get_artifact_cache()
+    if artifacts is not None:
+
+        def _fetch(url: str, fname: str, validators: typing.Optional[Validators]):
+            if validators is None:
+                if is_offline():
+                    raise _offline_error([url])
+                return _download(url, fname, show_progress)
+            return revalidate(url, fname, validators, show_progress)
+
+        return artifacts.fetch(url, _fetch, needs_revalidation(url))
+
+    os.makedirs(cache, exist_ok=True)
+    zip_fname = join(cache, posixpath.basename(url))
+    info_fname = f"{zip_fname}.json"
+
+    # urls with the same basename are downloaded to the same file, so only
+    # one of them may be downloaded at a time
+    with locked(f"{zip_fname}.lock"):
+        if not exists(zip_fname):
+            if is_offline():
+                raise _offline_error([url])
+            validators = _download(url, zip_fname, show_progress)
+        elif needs_revalidation(url):
+            validators = revalidate(
+                url, zip_fname, _read_json(info_fname), show_progress
+            )
+        else:
+            validators = None
+
+        if validators is not None:
+            with open(info_fname, "w") as fp:
+                json.dump(validators, fp)
+
+    return zip_fname
+
+
+def _remove_files(fnames: typing.Iterable[str]):
+    for fname in fnames:
+        with contextlib.suppress(OSError):
+            os.unlink(fname)
+
+
+def is_cached(url: str, cache: str) -> bool:
+    """Returns True if the url has been downloaded to the cache"""
+    artifacts = get_artifact_cache()
+    if artifacts is not None:
+        return artifacts.contains(url)
+    return exists(join(cache, posixpath.basename(url)))
+
+
+def check_offline(urls: typing.Iterable[str], cache: str):
+    """
+    If offline, raises an error listing every url that hasn't been
+    downloaded to the cache
+    """
+    if is_offline():
+        missing = [url for url in dict.fromkeys(urls) if not is_cached(url, cache)]
+        if missing:
+            raise _offline_error(missing)
+
+
+def prefetch(urls: typing.Iterable[str], cache: str) -> typing.Dict[str, str]:
+    """
+    Downloads the urls to the cache concurrently. Returns the error for
+    each url that could not be downloaded.
+    """
+    errors = {}
+    urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max(get_download_jobs(), 1)) as executor:
+        futures = [
+            executor.submit(_download_to_cache, url, cache, False) for url in urls
+        ]
+        for url, future in zip(urls, futures):
+            try:
+                future.result()
+            except (HTTPError, URLError, http.client.HTTPException, OSError) as e:
+                errors[url] = str(e)
+    return errors
+
+
+class DownloadScheduler:
+    """
+    Downloads files to the cache concurrently. Files are fetched in the
+    order that they are scheduled, and download_and_extract_zip waits for
+    a scheduled file to finish downloading instead of downloading it again,
+    so each archive can be extracted as soon as it is downloaded while the
+    rest are still being fetched.
+    """
+
+    def __init__(self, cache: str, jobs: int):
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(jobs)
+        self._futures: typing.Dict[typing.Tuple[str, str], Future] = {}
+
+    def schedule(self, url: str):
+        key = (url, self.cache)
+        if key not in self._futures:
+            self._futures[key] = self._executor.submit(
+                _download_to_cache, url, self.cache, False
+            )
+
+    def get(self, url: str, cache: str) -> typing.Optional[str]:
+        """
+        Waits for a scheduled file to be downloaded and returns its filename,
+        or returns None if it wasn't scheduled
+        """
+        future = self._futures.get((url, cache))
+        if future is None:
+            return None
+        return future.result()
+
+    def close(self):
+        # downloads that haven't started are no longer needed if a build
+        # step failed, and ones in progress are left to finish
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+
+_scheduler: typing.Optional[DownloadScheduler] = None
+
+
+def get_download_jobs() -> int:
+    """
+    Number of files to download at once, set via RPYBUILD_DL_JOBS. 0 or 1
+    downloads one file at a time.
+    """
+    return int(os.environ.get("RPYBUILD_DL_JOBS", "4"))
+
+
+@contextlib.contextmanager
+def parallel_downloads(urls: typing.Iterable[str], cache: str):
+    """
+    Starts downloading the urls to the cache in the background. Calls to
+    download_and_extract_zip made in this context wait for the scheduled
+    downloads instead of starting them.
+    """
+    global _scheduler
+
+    jobs = get_download_jobs()
+    if jobs <= 1:
+        yield
+        return
+
+    # cached files are verified in the background too
+    scheduler = DownloadScheduler(cache, jobs)
+    for url in urls:
+        scheduler.schedule(url)
+
+    old_scheduler = _scheduler
+    _scheduler = scheduler
+    try:
+        yield
+    finally:
+        _scheduler = old_scheduler
+        scheduler.close()
+
+
+def get_zip(url: str, cache: str) -> str:
+    """
+    Downloads the url to the cache if needed, and returns the filename of
+    the downloaded file
+    """
+    zip_fname = None
+    if _scheduler is not None:
+        zip_fname = _scheduler.get(url, cache)
+    if zip_fname is None:
+        zip_fname = _download_to_cache(url, cache)
+    return zip_fname
+
+
+def get_archive_hash(zip_fname: str) -> str:
+    """Returns the SHA-256 of a file returned by get_zip"""
+    # files in the shared cache are named after their content
+    artifacts = get_artifact_cache()
+    if artifacts is not None and artifacts.is_blob(zip_fname):
+        return basename(zip_fname)
+    return sha256_file(zip_fname)
+
 
 def download_and_extract_zip(url, to, cache):
     """
@@ -66,49 +536,484 @@ def download_and_extract_zip(url, to, cache):
 
     :param to: is either a string or a dict of {src: dst}
     """
+    extract_zip(get_zip(url, cache), to)
 
-    os.makedirs(cache, exist_ok=True)
-    zip_fname = join(cache, posixpath.basename(url))
-    if not exists(zip_fname):
-        _download(url, zip_fname)
 
-    with zipfile.ZipFile(zip_fname) as z:
+#: Archives with at least this many files to extract are extracted by
+#: multiple threads
+PARALLEL_EXTRACT_MIN_FILES = 64
+
+
+def get_extract_jobs() -> int:
+    """
+    Number of threads used to extract large archives, set via
+    RPYBUILD_EXTRACT_JOBS. 0 or 1 extracts one file at a time.
+    """
+    return int(os.environ.get("RPYBUILD_EXTRACT_JOBS", "4"))
+
+
+def _sanitize(name: str) -> str:
+    # same as zipfile.extractall: remove absolute paths and '..'
+    parts = name.replace("\\", "/").split("/")
+    return os.sep.join(p for p in parts if p not in ("", ".", ".."))
+
+
+_Members = typing.List[typing.Tuple[zipfile.ZipInfo, str]]
+
+
+class _Archive:
+    """
+    An open zipfile, and an index of the files in each of its directories
+    so that mappings can be resolved without scanning the whole archive
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.zf = zipfile.ZipFile(fname)
+        # held while opening a member, ZipFile.open isn't thread safe
+        self.lock = threading.Lock()
+
+        self.infos: typing.List[zipfile.ZipInfo] = self.zf.infolist()
+        self.files: typing.Dict[str, zipfile.ZipInfo] = {}
+
+        #: directory ("a/b/") -> [(info, name relative to the directory)]
+        self.dirs: typing.Dict[str, _Members] = {}
+
+        for info in self.infos:
+            if info.is_dir():
+                self.dirs.setdefault(info.filename, [])
+                continue
+
+            self.files[info.filename] = info
+            name = posixpath.normpath(info.filename)
+            idx = name.find("/")
+            while idx != -1:
+                self.dirs.setdefault(name[: idx + 1], []).append(
+                    (info, name[idx + 1 :])
+                )
+                idx = name.find("/", idx + 1)
+
+    def close(self):
+        self.zf.close()
+
+    def plan(
+        self,
+        to: typing.Union[str, typing.Dict[str, str]],
+        files: typing.Dict[str, typing.Tuple["_Archive", zipfile.ZipInfo]],
+        dirs: typing.Set[str],
+    ):
+        """
+        Adds the files to be extracted for the mapping to files (keyed by
+        their destination), and the directories to create to dirs
+        """
         if isinstance(to, str):
             to = {"": to}
 
         for src, dst in to.items():
             if src == "":
-                z.extractall(dst)
-            else:
-                # if is directory, copy whole thing recursively
-                try:
-                    info = z.getinfo(src)
-                except KeyError as e:
-                    osrc = src
-                    src = src + "/"
-                    try:
-                        info = z.getinfo(src)
-                    except KeyError:
-                        info = None
-                    if info is None:
-                        msg = f"error extracting {osrc} from {zip_fname}"
-                        raise ValueError(msg) from e
-                if info.is_dir():
-                    ilen = len(info.filename)
-                    for minfo in z.infolist():
-                        if minfo.is_dir():
-                            continue
-                        srcname = posixpath.normpath(minfo.filename)
-                        if srcname.startswith(info.filename):
-                            dstname = join(dst, normpath(srcname[ilen:]))
-                            dstdir = dirname(dstname)
-                            if not exists(dstdir):
-                                os.makedirs(dstdir)
-                            with z.open(minfo.filename, "r") as zfp, open(
-                                dstname, "wb"
-                            ) as fp:
-                                shutil.copyfileobj(zfp, fp)
-                else:
-                    # otherwise write a single file
-                    with z.open(src, "r") as zfp, open(dst, "wb") as fp:
-                        shutil.copyfileobj(zfp, fp)
+                for info in self.infos:
+                    dstname = join(dst, _sanitize(info.filename))
+                    if info.is_dir():
+                        dirs.add(dstname)
+                    else:
+                        files[dstname] = (self, info)
+                        dirs.add(dirname(dstname))
+                continue
+
+            # if is directory, copy whole thing recursively
+            info = self.files.get(src)
+            if info is not None:
+                # otherwise write a single file
+                files[dst] = (self, info)
+                dirs.add(dirname(dst))
+                continue
+
+            members = self.dirs.get(src if src.endswith("/") else src + "/")
+            if members is None:
+                raise ValueError(f"error extracting {src} from {self.fname}")
+
+            for info, relname in members:
+                dstname = join(dst, normpath(relname))
+                files[dstname] = (self, info)
+                dirs.add(dirname(dstname))
+
+    def extract(self, info: zipfile.ZipInfo, dst: str):
+        with self.lock:
+            zfp = self.zf.open(info, "r")
+        with zfp, open(dst, "wb") as fp:
+            shutil.copyfileobj(zfp, fp)
+
+
+_archives: typing.Optional[typing.Dict[str, _Archive]] = None
+
+
+@contextlib.contextmanager
+def open_archives():
+    """
+    Archives extracted in this context are only opened (and indexed) once,
+    even when several wrappers extract different parts of them
+    """
+    global _archives
+
+    if _archives is not None:
+        yield
+        return
+
+    _archives = {}
+    try:
+        yield
+    finally:
+        archives = _archives
+        _archives = None
+        for archive in archives.values():
+            archive.close()
+
+
+def _get_archive(zip_fname: str) -> _Archive:
+    assert _archives is not None
+    archive = _archives.get(zip_fname)
+    if archive is None:
+        archive = _archives[zip_fname] = _Archive(zip_fname)
+    return archive
+
+
+def get_archive_files(zip_fname: str, src: str = "") -> typing.Set[str]:
+    """
+    Returns the names of the files under src in a downloaded archive ("" for
+    everything), relative to src
+    """
+    with open_archives():
+        archive = _get_archive(zip_fname)
+        if not src:
+            return {posixpath.normpath(name) for name in archive.files}
+        members = archive.dirs.get(src if src.endswith("/") else src + "/", [])
+        return {relname for _, relname in members}
+
+
+def extract_zip(zip_fname: str, to):
+    """
+    Extracts a downloaded zipfile
+
+    :param to: is either a string or a dict of {src: dst}
+    """
+    extract_zips([(zip_fname, to)])
+
+
+def extract_zips(items: typing.Iterable[typing.Tuple[str, typing.Any]]):
+    """
+    Extracts downloaded zipfiles. When a file is extracted to the same
+    place more than once, the last one wins.
+
+    :param items: (zip filename, to) for each extraction, where to is either
+                  a string or a dict of {src: dst}
+    """
+    with open_archives():
+        files: typing.Dict[str, typing.Tuple[_Archive, zipfile.ZipInfo]] = {}
+        dirs: typing.Set[str] = set()
+
+        for zip_fname, to in items:
+            _get_archive(zip_fname).plan(to, files, dirs)
+
+        _write_files(files, dirs)
+
+
+_Files = typing.Dict[str, typing.Tuple[_Archive, zipfile.ZipInfo]]
+
+
+def _write_files(files: _Files, dirs: typing.Set[str]):
+    for d in sorted(dirs):
+        if d:
+            os.makedirs(d, exist_ok=True)
+
+    # files are linked from the unpacked-archive store when possible
+    needed: typing.Dict[_Archive, typing.List[typing.Tuple[str, zipfile.ZipInfo]]]
+    needed = {}
+    for dst, (archive, info) in files.items():
+        needed.setdefault(archive, []).append((dst, info))
+    linker = _Linker()
+    to_extract = []
+    for archive, members in needed.items():
+        if not _link_unpacked(archive, members, linker):
+            to_extract.extend((dst, archive, info) for dst, info in members)
+
+    # read each archive from start to end
+    to_extract.sort(key=lambda i: (i[1].fname, i[2].header_offset))
+
+    jobs = get_extract_jobs()
+    if jobs > 1 and len(to_extract) >= PARALLEL_EXTRACT_MIN_FILES:
+        with ThreadPoolExecutor(jobs) as executor:
+            futures = [
+                executor.submit(archive.extract, info, dst)
+                for dst, archive, info in to_extract
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for dst, archive, info in to_extract:
+            archive.extract(info, dst)
+
+
+def get_link_downloads() -> bool:
+    """
+    Whether extracted files are linked from the unpacked-archive store in
+    the shared cache. Set RPYBUILD_DL_LINK=0 to always copy them.
+    """
+    return os.environ.get("RPYBUILD_DL_LINK", "1") != "0"
+
+
+def _link_unpacked(
+    archive: _Archive,
+    members: typing.List[typing.Tuple[str, zipfile.ZipInfo]],
+    linker: "_Linker",
+) -> bool:
+    # The files of each archive in the shared cache are extracted once into
+    # the unpacked-archive store, and linked to where they are needed. Only
+    # the files that are needed are extracted, the rest are added when a
+    # later build needs them. Returns False if the store isn't used.
+    artifacts = get_artifact_cache()
+    if (
+        artifacts is None
+        or not get_link_downloads()
+        or not artifacts.is_blob(archive.fname)
+    ):
+        return False
+
+    sha256 = basename(archive.fname)
+    root = artifacts.get_unpacked_dir(sha256)
+
+    # files that were changed through a link are noticed, and the
+    # archive is extracted again
+    manifest = ExtractionManifest(f"{root}.json", [root])
+
+    with artifacts.lock_unpacked(sha256):
+        extracted = manifest.get_files(sha256)
+        if extracted is None:
+            manifest.remove()
+            shutil.rmtree(root, ignore_errors=True)
+            extracted = set()
+
+        missing = {}
+        for _, info in members:
+            src = join(root, _sanitize(info.filename))
+            if src not in extracted:
+                missing[src] = info
+
+        if missing:
+            manifest.remove()
+            for src, info in missing.items():
+                os.makedirs(dirname(src), exist_ok=True)
+                archive.extract(info, src)
+            manifest.save(sha256)
+        else:
+            # keeps it from being evicted while it's in use
+            os.utime(manifest.fname)
+
+        # the store may not be changed by another build while linking
+        for dst, info in members:
+            linker.link(join(root, _sanitize(info.filename)), dst)
+
+    return True
+
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str):
+    if sys.platform == "darwin":
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dst)
+    elif sys.platform.startswith("linux"):
+        import fcntl
+
+        try:
+            with open(src, "rb") as sfp, open(dst, "wb") as dfp:
+                fcntl.ioctl(dfp.fileno(), _FICLONE, sfp.fileno())
+        except OSError as e:
+            _remove_files([dst])
+            # some filesystems don't know about the ioctl at all
+            if e.errno in (errno.EINVAL, errno.ENOTTY):
+                raise OSError(errno.ENOTSUP, "reflinks are not supported", dst)
+            raise
+    else:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported", dst)
+
+
+class _Linker:
+    """
+    Creates files from the files in the unpacked-archive store, using the
+    cheapest method that works: a reflink (a copy-on-write copy), then a
+    hardlink, then a copy. Once a method is found to be unsupported (for
+    example, because the store is on another filesystem) it isn't tried
+    again. Any other error is raised.
+    """
+
+    _UNSUPPORTED = {
+        errno.EXDEV,
+        errno.EPERM,
+        errno.ENOTSUP,
+        errno.EOPNOTSUPP,
+        errno.EMLINK,
+    }
+
+    def __init__(
+        self,
+        methods: typing.Sequence[typing.Callable[[str, str], typing.Any]] = (
+            _reflink,
+            os.link,
+            shutil.copyfile,
+        ),
+    ):
+        self.methods = list(methods)
+
+    def link(self, src: str, dst: str):
+        _remove_files([dst])
+        while True:
+            try:
+                self.methods[0](src, dst)
+                return
+            except OSError as e:
+                if e.errno not in self._UNSUPPORTED or len(self.methods) == 1:
+                    raise
+                self.methods.pop(0)
+
+
+def link_tree(src_root: str, dst_root: str):
+    """
+    Creates every file under src_root at the same place under dst_root,
+    linking them when possible
+    """
+    linker = _Linker() if get_link_downloads() else _Linker([shutil.copyfile])
+    for root, _, fnames in os.walk(src_root):
+        d = join(dst_root, relpath(root, src_root))
+        os.makedirs(d, exist_ok=True)
+        for fname in fnames:
+            linker.link(join(root, fname), join(d, fname))
+
+
+def get_patched_tree(
+    zip_fname: str,
+    src: str,
+    patches_key: typing.Any,
+    apply_patches: typing.Callable[[str], None],
+) -> typing.Optional[str]:
+    """
+    Returns a directory in the shared cache that contains the files under
+    src in the archive ("" for everything) after apply_patches(root) has
+    patched them, so that the patches are only applied once for each
+    archive. Returns None if the archive isn't in the shared cache.
+
+    :param patches_key: identifies the patches that apply_patches applies
+    """
+    artifacts = get_artifact_cache()
+    if artifacts is None or not artifacts.is_blob(zip_fname):
+        return None
+
+    sha256 = basename(zip_fname)
+    key = hashlib.sha256(json.dumps([src, patches_key]).encode("utf-8")).hexdigest()
+    root = artifacts.get_patched_dir(sha256, key)
+    manifest = ExtractionManifest(f"{root}.json", [root])
+
+    with artifacts.lock_patched(sha256, key):
+        if manifest.is_current(key):
+            # keeps it from being evicted while it's in use
+            os.utime(manifest.fname)
+            return root
+
+        manifest.remove()
+        shutil.rmtree(root, ignore_errors=True)
+
+        try:
+            extract_zip(zip_fname, {src: root} if src else root)
+            apply_patches(root)
+        except BaseException:
+            shutil.rmtree(root, ignore_errors=True)
+            raise
+
+        manifest.save(key)
+
+    return root
+
+
+def unshare_file(fname: str):
+    """
+    Replaces a file that is hardlinked from the unpacked-archive store with
+    a copy, so that it can be modified in place
+    """
+    if os.stat(fname).st_nlink > 1:
+        tmp = f"{fname}.tmp"
+        shutil.copy2(fname, tmp)
+        os.replace(tmp, fname)
+
+
+class ExtractionManifest:
+    """
+    Records what was extracted into a set of directories, so that the
+    extraction can be skipped when nothing has changed since.
+
+    The key identifies everything that went into the directories (the
+    archives and their hashes, what was extracted from them, and the
+    patches applied). The size and mtime of every file in the directories
+    is recorded too, so that changes to the extracted files are noticed,
+    along with their total size.
+    """
+
+    def __init__(self, fname: str, dirs: typing.List[str]):
+        self.fname = fname
+        self.dirs = dirs
+
+    def _scan(self) -> typing.Dict[str, typing.List[int]]:
+        files = {}
+        for d in self.dirs:
+            for root, _, fnames in os.walk(d):
+                for fname in fnames:
+                    path = join(root, fname)
+                    st = os.stat(path)
+                    files[path] = [st.st_size, st.st_mtime_ns]
+        return files
+
+    def get_files(self, key: typing.Any) -> typing.Optional[typing.Set[str]]:
+        """
+        Returns the files that were extracted if the directories were
+        extracted with this key and haven't changed since, otherwise None
+        """
+        try:
+            with open(self.fname) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("version") != version or data.get("key") != key:
+            return None
+
+        for path, (size, mtime_ns) in data["files"].items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return None
+
+        return set(data["files"])
+
+    def is_current(self, key: typing.Any) -> bool:
+        """Returns True if the directories were extracted with this key"""
+        return self.get_files(key) is not None
+
+    def remove(self):
+        _remove_files([self.fname])
+
+    def save(self, key: typing.Any):
+        """Records the files that are now in the directories"""
+        files = self._scan()
+        size = sum(size for size, _ in files.values())
+        data = {"version": version, "key": key, "files": files, "size": size}
+        os.makedirs(dirname(self.fname), exist_ok=True)
+        tmp = f"{self.fname}.tmp"
+        with open(tmp, "w") as fp:
+            json.dump(data, fp)
+        os.replace(tmp, self.fname)
@@ -0,0 +1,483 @@
+#
+# Caches used to avoid redoing work during code generation
+#
+
+import copy
+import copyreg
+import hashlib
+import io
+import json
+import os
+from os.path import abspath, dirname, exists, join
+import pickle
+import typing
+
+import CppHeaderParser
+from CppHeaderParser.CppHeaderParser import TagStr
+from pydantic import BaseModel
+import sphinxify
+import yaml
+
+from . import hooks_datacfg
+from .hooks_datacfg import HooksDataYaml
+from .version import version
+
+
+def hash_files(h, fnames: typing.Iterable[str]):
+    """
+    Adds the name and contents of each file to the hash object. Files that
+    do not exist are hashed as such, so that their appearance is noticed.
+    """
+    for fname in fnames:
+        h.update(fname.encode("utf-8"))
+        h.update(b"\0")
+        try:
+            with open(fname, "rb") as fp:
+                h.update(hashlib.sha256(fp.read()).digest())
+        except OSError:
+            h.update(b"<missing>")
+        h.update(b"\0")
+
+
+class FingerprintStore:
+    """
+    Records the inputs that each autogenerated header was generated from
+    and the files that were output, so that headers whose inputs have not
+    changed can be skipped on the next build.
+
+    The fingerprint of a header consists of:
+
+    * a per-wrapper key (casters, defines, templates, robotpy-build version)
+    * the contents of the header and of every file it included
+    * the contents of its generation data
+    """
+
+    def __init__(self, fname: str, key: str):
+        self.fname = fname
+        self.key = key
+        self.headers: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        self.loaded = False
+
+        # outputs can move between headers, don't delete them if so
+        self._written: typing.Set[str] = set()
+
+        try:
+            with open(fname) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") != version or data.get("key") != key:
+            return
+
+        self.headers = data["headers"]
+        self.loaded = True
+
+    @staticmethod
+    def make_key(*items: typing.Any) -> str:
+        """Computes a key from json-serializable items"""
+        return hashlib.sha256(
+            json.dumps(items, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def fingerprint(
+        self, name: str, data_fname: typing.Optional[str], included: typing.List[str]
+    ) -> str:
+        h = hashlib.sha256()
+        h.update(name.encode("utf-8"))
+        h.update(b"\0")
+        if data_fname:
+            hash_files(h, [data_fname])
+        hash_files(h, included)
+        return h.hexdigest()
+
+    def get_current(
+        self, name: str, data_fname: typing.Optional[str]
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """
+        Returns the stored entry for the header if nothing has changed since
+        it was generated, otherwise None
+        """
+        entry = self.headers.get(name)
+        if entry is None:
+            return None
+
+        if not all(exists(f) for f in entry["outputs"]):
+            return None
+
+        if self.fingerprint(name, data_fname, entry["included"]) != entry["fp"]:
+            return None
+
+        return entry
+
+    def update(
+        self,
+        name: str,
+        data_fname: typing.Optional[str],
+        included: typing.List[str],
+        outputs: typing.List[str],
+        missing: typing.Optional[typing.Dict],
+        unity_cost: typing.Optional[int] = None,
+    ):
+        """
+        Records a newly generated header, and removes any files that it
+        previously output but did not output this time
+        """
+        self._written.update(outputs)
+
+        old = self.headers.get(name)
+        if old:
+            _remove_files(set(old["outputs"]) - self._written)
+
+        self.headers[name] = {
+            "fp": self.fingerprint(name, data_fname, included),
+            "included": included,
+            "outputs": outputs,
+            "missing": copy.deepcopy(missing),
+            "unity_cost": unity_cost,
+        }
+
+    def remove_unused(self, names: typing.Iterable[str]):
+        """Removes headers that are no longer generated and their outputs"""
+        for name in set(self.headers.keys()) - set(names):
+            entry = self.headers.pop(name)
+            _remove_files(set(entry["outputs"]) - self._written)
+
+    def save(self):
+        data = {"version": version, "key": self.key, "headers": self.headers}
+        tmp = f"{self.fname}.tmp"
+        with open(tmp, "w") as fp:
+            json.dump(data, fp)
+        os.replace(tmp, self.fname)
+
+
+#: (new entries, keys of entries used) reported by DocCache.take_changes
+DocChanges = typing.Tuple[
+    typing.Dict[str, typing.Optional[typing.List[str]]], typing.Set[str]
+]
+
+
+class DocCache:
+    """
+    Remembers the quoted docstrings that the hooks converted from doxygen
+    comments, keyed on the comment and everything else that affects the
+    docstring. The same comment is often converted many times, for
+    overloads and template instantiations, and again whenever a header is
+    regenerated.
+
+    The cache is stored in a single file and is saved at the end of the
+    build. When it grows larger than max_size bytes, the least recently
+    used entries are removed.
+    """
+
+    def __init__(self, fname: str, max_size: int):
+        self.fname = fname
+        self.max_size = max_size
+
+        #: in least recently used order
+        self.entries: typing.Dict[str, typing.Optional[typing.List[str]]] = {}
+
+        self._added: typing.Dict[str, typing.Optional[typing.List[str]]] = {}
+        self._used: typing.Set[str] = set()
+        self._changed = False
+
+        try:
+            with open(fname, "rb") as fp:
+                data = pickle.load(fp)
+        except Exception:
+            return
+
+        if data.get("key") == self._cache_key():
+            self.entries = data["entries"]
+
+    @staticmethod
+    def _cache_key():
+        # the docstrings are converted by the hooks, so any change to them
+        # discards the cache
+        h = hashlib.sha256()
+        hash_files(h, [join(dirname(abspath(__file__)), "hooks.py")])
+        return [version, sphinxify.__version__, h.hexdigest()]
+
+    def get(self, key: str) -> typing.Optional[typing.List[str]]:
+        """Returns the cached docstring, raises KeyError if not present"""
+        value = self.entries[key]
+        self._used.add(key)
+        return value
+
+    def put(self, key: str, value: typing.Optional[typing.List[str]]):
+        self.entries[key] = value
+        self._added[key] = value
+
+    def take_changes(self) -> DocChanges:
+        """
+        Returns the entries added and used since the last call, so that they
+        can be merged into the cache of the process that saves it
+        """
+        changes = (self._added, self._used)
+        self._added = {}
+        self._used = set()
+        return changes
+
+    def merge(self, changes: DocChanges):
+        added, used = changes
+        if not added and not used:
+            return
+
+        self._changed = True
+        self.entries.update(added)
+
+        # move used entries to the end
+        for key in used | added.keys():
+            value = self.entries.pop(key, None)
+            self.entries[key] = value
+
+    def save(self):
+        self.merge(self.take_changes())
+        if not self._changed:
+            return
+
+        # approximate, but good enough to bound the size of the file
+        sizes = [
+            (key, 100 + sum(len(s) for s in value or ()))
+            for key, value in self.entries.items()
+        ]
+        total = sum(size for _, size in sizes)
+        for key, size in sizes:
+            if total <= self.max_size:
+                break
+            del self.entries[key]
+            total -= size
+
+        data = {"key": self._cache_key(), "entries": self.entries}
+        os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+        tmp = f"{self.fname}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fp:
+            pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.fname)
+        self._changed = False
+
+
+def _make_tagstr(s: str, location) -> TagStr:
+    return TagStr(s, location=location)
+
+
+def _reduce_tagstr(s: TagStr):
+    return _make_tagstr, (str(s), s.location)
+
+
+class ParseCache:
+    """
+    Stores parsed headers on disk, keyed on the preprocessed content of the
+    header and the version of CppHeaderParser. This allows a header to be
+    regenerated without parsing it again when only its generation data has
+    changed.
+
+    When the cache grows larger than max_size bytes, the least recently
+    used entries are removed.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        # TagStr can't be pickled without some help
+        self._dispatch_table = copyreg.dispatch_table.copy()
+        self._dispatch_table[TagStr] = _reduce_tagstr
+
+    def _fname(self, content: str) -> str:
+        h = hashlib.sha256()
+        h.update(CppHeaderParser.__version__.encode("utf-8"))
+        h.update(b"\0")
+        h.update(content.encode("utf-8"))
+        return join(self.cache_dir, f"{h.hexdigest()}.pickle")
+
+    def get(self, content: str) -> typing.Optional[CppHeaderParser.CppHeader]:
+        """Returns the parsed header for the content, or None if not cached"""
+        fname = self._fname(content)
+        try:
+            with open(fname, "rb") as fp:
+                header = pickle.load(fp)
+        except Exception:
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+        return header
+
+    def put(self, content: str, header: CppHeaderParser.CppHeader):
+        """
+        Stores the parsed header. This must be called before the header is
+        modified by any hooks.
+        """
+        fp = io.BytesIO()
+        pickler = pickle.Pickler(fp, pickle.HIGHEST_PROTOCOL)
+        pickler.dispatch_table = self._dispatch_table
+        pickler.dump(header)
+
+        # multiple generation processes may write to the cache at once
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fname = self._fname(content)
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as wfp:
+            wfp.write(fp.getvalue())
+        os.replace(tmp, fname)
+
+        _evict(self.cache_dir, self.max_size)
+
+
+class ModelState(typing.NamedTuple):
+    """
+    The fields that were set on a validated generation data model, which
+    can be used to construct it again without validating it
+    """
+
+    cls: str
+    values: typing.Dict[str, typing.Any]
+
+    def construct(self) -> BaseModel:
+        cls = getattr(hooks_datacfg, self.cls)
+        values = {k: _construct(v) for k, v in self.values.items()}
+        return cls.construct(_fields_set=set(values), **values)
+
+
+def _dump(v):
+    if isinstance(v, BaseModel):
+        return ModelState(
+            type(v).__name__, {k: _dump(getattr(v, k)) for k in v.__fields_set__}
+        )
+    elif isinstance(v, dict):
+        return {k: _dump(i) for k, i in v.items()}
+    elif isinstance(v, list):
+        return [_dump(i) for i in v]
+    return v
+
+
+def _construct(v):
+    if isinstance(v, ModelState):
+        return v.construct()
+    elif isinstance(v, dict):
+        return {k: _construct(i) for k, i in v.items()}
+    elif isinstance(v, list):
+        return [_construct(i) for i in v]
+    return v
+
+
+#: Entries of these fields are constructed when GeneratorData looks them up
+_deferred_fields = ("attributes", "classes", "enums", "functions")
+
+
+class GenDataCache:
+    """
+    Stores validated generation data on disk, keyed on the content of the
+    yaml file and the version of robotpy-build. When a file has not changed
+    it is not parsed or validated again; instead, the models are constructed
+    directly from the cached data.
+
+    The per-entry models in the top level of the data (classes, functions,
+    enums and attributes) are not constructed until they are looked up by
+    GeneratorData, so entries for things that are never generated cost
+    almost nothing. When a file is not in the cache, all of it is still
+    validated, so that every error in it is reported.
+
+    When the cache grows larger than max_size bytes, the least recently
+    used entries are removed.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        # the models may change without the version changing in development
+        h = hashlib.sha256()
+        h.update(version.encode("utf-8"))
+        h.update(b"\0")
+        hash_files(h, [hooks_datacfg.__file__])
+        self._key = h.digest()
+
+    def _fname(self, content: bytes) -> str:
+        h = hashlib.sha256(self._key)
+        h.update(content)
+        return join(self.cache_dir, f"{h.hexdigest()}.pickle")
+
+    def load(self, datafile: str) -> HooksDataYaml:
+        """Loads the generation data from the yaml file"""
+        with open(datafile, "rb") as fp:
+            content = fp.read()
+
+        fname = self._fname(content)
+        try:
+            with open(fname, "rb") as fp:
+                state = pickle.load(fp)
+        except Exception:
+            pass
+        else:
+            try:
+                os.utime(fname)
+            except OSError:
+                pass
+
+            # deferred entries are left as ModelState
+            values = {
+                k: v if k in _deferred_fields else _construct(v)
+                for k, v in state.values.items()
+            }
+            return HooksDataYaml.construct(_fields_set=set(values), **values)
+
+        data = load_generation_data_yaml(content)
+        self._put(fname, _dump(data))
+        return data
+
+    def _put(self, fname: str, state: ModelState):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fp:
+            pickle.dump(state, fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fname)
+
+        _evict(self.cache_dir, self.max_size)
+
+
+def load_generation_data_yaml(content: typing.Union[str, bytes]) -> HooksDataYaml:
+    """Parses and validates generation data"""
+    data = yaml.safe_load(content)
+    if data is None:
+        data = {}
+
+    return HooksDataYaml(**data)
+
+
+def _evict(cache_dir: str, max_size: int):
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(".pickle"):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+    if total <= max_size:
+        return
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        _remove_files([path])
+        total -= size
+
+
+def _remove_files(fnames: typing.Iterable[str]):
+    for fname in fnames:
+        try:
+            os.unlink(fname)
+        except OSError:
+            pass
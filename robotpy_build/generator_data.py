@@ -1,5 +1,6 @@
 import yaml
 
+from .gencache import ModelState
 from .hooks_datacfg import (
     ClassData,
     EnumData,
@@ -8,7 +9,7 @@ from .hooks_datacfg import (
     FunctionData,
 )
 
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 
 
 class GeneratorData:
@@ -28,8 +29,15 @@ class GeneratorData:
         self.enums: Dict[str, bool] = {}
         self.attributes: Dict[str, bool] = {}
 
+    def _lookup(self, entries: Dict[str, Any], name: str):
+        # entries of cached generation data are constructed on first use
+        data = entries.get(name)
+        if isinstance(data, ModelState):
+            data = entries[name] = data.construct()
+        return data
+
     def get_class_data(self, name: str) -> ClassData:
-        data = self.data.classes.get(name)
+        data = self._lookup(self.data.classes, name)
         missing = data is None
         if missing:
             data = ClassData()
@@ -56,7 +64,7 @@ class GeneratorData:
         return data
 
     def get_enum_data(self, name: str) -> EnumData:
-        data = self.data.enums.get(name)
+        data = self._lookup(self.data.enums, name)
         if data is None:
             self.enums[name] = False
             data = EnumData()
@@ -75,7 +83,7 @@ class GeneratorData:
             data = cls_data.methods.get(name)
             report_base = self.classes[cls_key]["functions"]
         else:
-            data = self.data.functions.get(name)
+            data = self._lookup(self.data.functions, name)
             report_base = self.functions
 
         report_base = report_base.setdefault(name, {"overloads": {}, "first": fn})
@@ -115,7 +123,7 @@ class GeneratorData:
         return data
 
     def get_prop_data(self, name) -> PropData:
-        data = self.data.attributes.get(name)
+        data = self._lookup(self.data.attributes, name)
         if data is None:
             self.attributes[name] = False
             data = PropData()
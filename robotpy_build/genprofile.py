@@ -0,0 +1,164 @@
+#
+# Profiling of the code generation stages
+#
+
+import contextlib
+import json
+import time
+import tracemalloc
+import typing
+
+# python 3.9+
+_reset_peak = getattr(tracemalloc, "reset_peak", None)
+
+
+class _StageEntry:
+    __slots__ = ["start", "start_mem", "peak"]
+
+    def __init__(self, start: float, start_mem: int):
+        self.start = start
+        self.start_mem = start_mem
+        self.peak = start_mem
+
+
+class GenProfiler:
+    """
+    Records the wall time and memory allocated by each stage of generating
+    a single header. Repeated calls of the same stage and name are added
+    together. Stages may be nested, in which case the time spent in the
+    inner stage is also counted by the outer stage.
+    """
+
+    def __init__(self, header: str):
+        self.header = header
+        self._records: typing.Dict[typing.Tuple[str, str], typing.Dict] = {}
+        self._stack: typing.List[_StageEntry] = []
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, name: str = ""):
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1].peak = max(self._stack[-1].peak, peak)
+        if _reset_peak:
+            _reset_peak()
+
+        entry = _StageEntry(time.perf_counter(), current)
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - entry.start
+            current, peak = tracemalloc.get_traced_memory()
+            self._stack.pop()
+
+            entry.peak = max(entry.peak, peak)
+            if self._stack:
+                self._stack[-1].peak = max(self._stack[-1].peak, entry.peak)
+            if _reset_peak:
+                _reset_peak()
+
+            record = self._records.get((stage, name))
+            if record is None:
+                record = self._records[(stage, name)] = {
+                    "header": self.header,
+                    "stage": stage,
+                    "name": name,
+                    "calls": 0,
+                    "wall": 0.0,
+                    "allocated": 0,
+                    "peak": 0 if _reset_peak else None,
+                }
+
+            record["calls"] += 1
+            record["wall"] += elapsed
+            record["allocated"] += current - entry.start_mem
+            if _reset_peak:
+                record["peak"] = max(record["peak"], entry.peak - entry.start_mem)
+
+    def get_records(self) -> typing.List[typing.Dict]:
+        return list(self._records.values())
+
+
+class _NullStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_null_stage = _NullStage()
+_current: typing.Optional[GenProfiler] = None
+
+
+def stage(stage: str, name: str = ""):
+    """
+    Context manager that records a stage of generation if profiling is
+    enabled, otherwise does nothing
+    """
+    if _current is None:
+        return _null_stage
+    return _current.stage(stage, name)
+
+
+@contextlib.contextmanager
+def profiling(header: str) -> typing.Iterator[GenProfiler]:
+    """Enables profiling while generating the specified header"""
+    global _current
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+
+    profiler = GenProfiler(header)
+    old_current = _current
+    _current = profiler
+    try:
+        with profiler.stage("total"):
+            yield profiler
+    finally:
+        _current = old_current
+        if started:
+            tracemalloc.stop()
+
+
+def _fmt_size(size: typing.Optional[int]) -> str:
+    if size is None:
+        return "-"
+    return f"{size / (1024 * 1024):.1f}M"
+
+
+def print_table(records: typing.List[typing.Dict], limit: typing.Optional[int] = None):
+    """Prints the slowest stages"""
+    records = sorted(records, key=lambda r: r["wall"], reverse=True)
+    if limit:
+        records = records[:limit]
+
+    rows = [("wall (s)", "calls", "alloc", "peak", "header", "stage", "name")]
+    for r in records:
+        rows.append(
+            (
+                f"{r['wall']:.3f}",
+                str(r["calls"]),
+                _fmt_size(r["allocated"]),
+                _fmt_size(r["peak"]),
+                r["header"],
+                r["stage"],
+                r["name"],
+            )
+        )
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print(
+            "  ".join(
+                c.rjust(w) if i < 4 else c.ljust(w)
+                for i, (c, w) in enumerate(zip(row, widths))
+            ).rstrip()
+        )
+
+
+def write_json(fname: str, records: typing.List[typing.Dict]):
+    records = sorted(records, key=lambda r: r["wall"], reverse=True)
+    with open(fname, "w") as fp:
+        json.dump(records, fp, indent=2)
@@ -1,5 +1,4 @@
 from keyword import iskeyword
-import re
 import sphinxify
 import typing
 
@@ -13,7 +12,10 @@ from .hooks_datacfg import (
     PropAccess,
     ReturnValuePolicy,
 )
+from .casters import CasterIndex
+from .gencache import DocCache, FingerprintStore
 from .generator_data import GeneratorData, MissingReporter
+from . import genprofile
 from .mangle import trampoline_signature
 
 
@@ -49,8 +51,6 @@ _operators = {
 }
 # fmt: on
 
-_type_caster_seps = re.compile(r"[<>\(\)]")
-
 
 class HookError(Exception):
     pass
@@ -68,16 +68,25 @@ class Hooks:
     _qualname_bad = ":<>="
     _qualname_trans = str.maketrans(_qualname_bad, "_" * len(_qualname_bad))
 
+    # how docstrings are escaped and quoted as C++ string literals; these
+    # are part of the DocCache key
+    _doc_escapes = (("\\", "\\\\"), ('"', '\\"'))
+    _doc_quote = '"%s"'
+
     def __init__(
         self,
         data: HooksDataYaml,
-        casters: typing.Dict[str, typing.Dict[str, typing.Any]],
+        casters: CasterIndex,
         report_only: bool,
+        doc_cache: typing.Optional[DocCache] = None,
+        lazy_init: bool = False,
     ):
         self.gendata = GeneratorData(data)
         self.rawdata = data
         self.casters = casters
         self.report_only = report_only
+        self.doc_cache = doc_cache
+        self.lazy_init = lazy_init
         self.has_operators = False
         self.has_vcheck = False
 
@@ -87,7 +96,7 @@ class Hooks:
         self.subpackages: typing.Dict[str, str] = {}
 
     def report_missing(self, name: str, reporter: MissingReporter):
-        self.gendata.report_missing(name, reporter)
+        return self.gendata.report_missing(name, reporter)
 
     def _add_type_caster(self, typename: str):
         # defer until the end since there's lots of duplication
@@ -101,25 +110,10 @@ class Hooks:
         else:
             v["x_module_var"] = "m"
 
-    def _get_type_caster_cfgs(self, typename: str):
-        tmpl_idx = typename.find("<")
-        if tmpl_idx == -1:
-            typenames = [typename]
-        else:
-            typenames = [typename[:tmpl_idx]] + _type_caster_seps.split(
-                typename[tmpl_idx:].replace(" ", "")
-            )
-        for typename in typenames:
-            if typename:
-                ccfg = self.casters.get(typename)
-                if ccfg:
-                    yield ccfg
-
     def _get_type_caster_includes(self):
         includes = set()
         for typename in self.types:
-            for ccfg in self._get_type_caster_cfgs(typename):
-                includes.add(ccfg["hdr"])
+            includes |= self.casters.get_includes(typename)
         return sorted(includes)
 
     def _set_name(self, name, data, strip_prefixes=None, is_operator=False):
@@ -147,22 +141,75 @@ class Hooks:
 
     def _process_doc(
         self, thing, data, append_prefix="", param_remap: typing.Dict[str, str] = {}
+    ) -> typing.Optional[typing.List[str]]:
+        doxygen = None
+        if data.doc is None:
+            doxygen = thing.get("doxygen")
+            if doxygen is None and data.doc_append is None:
+                return None
+
+        if self.doc_cache is None:
+            return self._convert_doc(doxygen, data, append_prefix, param_remap)
+
+        key = FingerprintStore.make_key(
+            doxygen,
+            param_remap if doxygen else None,
+            data.doc,
+            data.doc_append,
+            append_prefix,
+            self._doc_escapes,
+            self._doc_quote,
+        )
+        return self._cached_doc(
+            key, self._convert_doc, doxygen, data, append_prefix, param_remap
+        )
+
+    def _process_tmpl_doc(
+        self, doc: typing.Optional[str]
+    ) -> typing.Optional[typing.List[str]]:
+        if self.doc_cache is None or not doc:
+            return self._quote_doc(doc)
+
+        key = FingerprintStore.make_key(
+            "template", doc, self._doc_escapes, self._doc_quote
+        )
+        return self._cached_doc(key, self._quote_doc, doc)
+
+    def _cached_doc(
+        self, key: str, convert: typing.Callable, *args
+    ) -> typing.Optional[typing.List[str]]:
+        try:
+            return self.doc_cache.get(key)
+        except KeyError:
+            pass
+
+        doc_quoted = convert(*args)
+        self.doc_cache.put(key, doc_quoted)
+        return doc_quoted
+
+    def _convert_doc(
+        self,
+        doxygen: typing.Optional[str],
+        data,
+        append_prefix: str,
+        param_remap: typing.Dict[str, str],
     ) -> typing.Optional[typing.List[str]]:
         doc = ""
 
         if data.doc is not None:
             doc = data.doc
-        elif "doxygen" in thing:
-            doc = thing["doxygen"]
-            if param_remap:
-                d = sphinxify.Doc.from_comment(doc)
-                for param in d.params:
-                    new_name = param_remap.get(param.name)
-                    if new_name:
-                        param.name = new_name
-                doc = str(d)
-            else:
-                doc = sphinxify.process_raw(doc)
+        elif doxygen is not None:
+            doc = doxygen
+            with genprofile.stage("docstrings"):
+                if param_remap:
+                    d = sphinxify.Doc.from_comment(doc)
+                    for param in d.params:
+                        new_name = param_remap.get(param.name)
+                        if new_name:
+                            param.name = new_name
+                    doc = str(d)
+                else:
+                    doc = sphinxify.process_raw(doc)
 
         if data.doc_append is not None:
             doc += f"\n{append_prefix}" + data.doc_append.replace(
@@ -177,9 +224,12 @@ class Hooks:
         doc_quoted: typing.Optional[typing.List[str]] = None
         if doc:
             # TODO
-            doc = doc.replace("\\", "\\\\").replace('"', '\\"')
+            for s, r in self._doc_escapes:
+                doc = doc.replace(s, r)
             doc_quoted = doc.splitlines(keepends=True)
-            doc_quoted = ['"%s"' % (dq.replace("\n", "\\n"),) for dq in doc_quoted]
+            doc_quoted = [
+                self._doc_quote % (dq.replace("\n", "\\n"),) for dq in doc_quoted
+            ]
 
         return doc_quoted
 
@@ -205,7 +255,7 @@ class Hooks:
     def _maybe_add_default_arg_cast(self, p, name):
         if not p.get("disable_type_caster_default_cast", False):
             found_typename = None
-            for ccfg in self._get_type_caster_cfgs(p["x_type"]):
+            for ccfg in self.casters.get_cfgs(p["x_type"]):
                 if ccfg.get("darg"):
                     if found_typename and found_typename != ccfg["typename"]:
                         raise HookError(
@@ -328,11 +378,12 @@ class Hooks:
                 qualname = f"::{qualname}"
             tmpl_data_d = tmpl_data.dict()
             tmpl_data_d["x_qualname_"] = qualname.translate(self._qualname_trans)
-            tmpl_data_d["x_doc_set"] = self._quote_doc(tmpl_data.doc)
+            tmpl_data_d["x_class"] = f"{qualname}<{', '.join(tmpl_data.params)}>"
+            tmpl_data_d["x_doc_set"] = self._process_tmpl_doc(tmpl_data.doc)
             doc_add = tmpl_data.doc_append
             if doc_add:
                 doc_add = f"\n{doc_add}"
-            tmpl_data_d["x_doc_add"] = self._quote_doc(doc_add)
+            tmpl_data_d["x_doc_add"] = self._process_tmpl_doc(doc_add)
             self._add_subpackage(tmpl_data_d, tmpl_data)
             templates[k] = tmpl_data_d
 
@@ -341,6 +392,20 @@ class Hooks:
 
         data["templates"] = templates
 
+        data["x_required_bases"] = self._get_required_bases(header)
+
+        # used by lazy initialization
+        data["lazy_init"] = self.lazy_init
+        if self.lazy_init:
+            lazy_exports, lazy_defines, lazy_eager, lazy_typeids = self._get_lazy_info(
+                header, templates
+            )
+            data["lazy_exports"] = lazy_exports
+            data["lazy_defines"] = lazy_defines
+            data["lazy_eager"] = lazy_eager
+            data["lazy_typeids"] = lazy_typeids
+            data["lazy_types"] = sorted(self.types)
+
         data["type_caster_includes"] = self._get_type_caster_includes()
         data["has_vcheck"] = self.has_vcheck
 
@@ -348,6 +413,76 @@ class Hooks:
         self._extract_typealias(self.rawdata.typealias, user_typealias, set())
         data["user_typealias"] = user_typealias
 
+    def _is_bound(self, cls) -> bool:
+        # templates (and classes nested in them) are bound separately
+        while cls:
+            if cls["data"].ignore or "template" in cls:
+                return False
+            cls = cls["parent"]
+        return True
+
+    def _get_required_bases(self, header):
+        """
+        Returns the base classes of the classes bound by this header that
+        are defined somewhere else. They may belong to a wrapper that
+        registers its types lazily, so they are registered before the
+        classes that derive from them.
+        """
+        local = set(self.class_hierarchy.keys())
+        bases = {}
+
+        for cls in header.classes:
+            if not self._is_bound(cls):
+                continue
+            for base in cls["x_inherits"]:
+                if base["x_qualname"] not in local:
+                    bases[base["x_class"]] = True
+
+        return list(bases.keys())
+
+    def _get_lazy_info(self, header, templates):
+        """
+        Returns the (subpackage, name) of everything that the header adds to
+        the module, the names of the types that it registers, whether the
+        header must be initialized eagerly because custom code could add
+        something else, and expressions for the std::type_info names of the
+        classes that it registers
+        """
+        subpackages = {var: pkg for pkg, var in self.subpackages.items()}
+        subpackages["m"] = ""
+
+        exports = set()
+        defines = set()
+        eager = bool(self.rawdata.inline_code)
+        typeids = []
+
+        for en in header.enums:
+            if "name" in en and not en["data"].ignore:
+                exports.add((subpackages[en["x_module_var"]], en["x_name"]))
+                defines.add(en["name"])
+                if en["data"].inline_code:
+                    eager = True
+
+        for i, (name, tmpl_data) in enumerate(templates.items(), 1):
+            exports.add((subpackages[tmpl_data["x_module_var"]], name))
+            typeids.append(f'rpygen::bind_{tmpl_data["x_qualname_"]}_{i}::type_name()')
+
+        for cls in header.classes:
+            if cls["data"].ignore:
+                continue
+            if self._is_bound(cls):
+                typeids.append(f'typeid(typename {cls["x_qualname"]}).name()')
+            defines.add(cls["name"])
+            defines.update(e["name"] for e in cls["enums"]["public"] if "name" in e)
+            if not cls["parent"] and "template" not in cls:
+                exports.add((subpackages[cls["x_module_var"]], cls["x_name"]))
+
+        for fn in header.functions:
+            if not fn["data"].ignore and not fn["data"].ignore_py:
+                exports.add((subpackages[fn["x_module_var"]], fn["x_name"]))
+
+        return sorted(exports), sorted(defines), eager, typeids
+
     def _function_hook(self, fn, data: FunctionData, internal: bool = False):
         """shared with methods/functions"""
 
@@ -17,6 +17,33 @@ struct EmptyTrampolineCfg {};
 // robotpy-build specific extensions waiting for inclusion into pybind11
 namespace rpybuild_ext {
 using py::raise_from;
+
+// Wrappers that use lazy_init only register a type with pybind11 when it is
+// first used. They add a function that registers each of their types to
+// this dictionary (shared by every module), keyed on the name of its
+// std::type_info
+inline py::dict lazy_types() {
+    auto types = static_cast<PyObject*>(py::get_shared_data("rpybuild_lazy_types"));
+    if (!types) {
+        types = py::dict().release().ptr();
+        py::set_shared_data("rpybuild_lazy_types", types);
+    }
+    return py::reinterpret_borrow<py::dict>(types);
+}
+
+// Registers T if it's defined by a lazily initialized wrapper that hasn't
+// registered it yet; used before binding classes that derive from T
+template <typename T>
+void require_type() {
+    if (!py::detail::get_type_info(typeid(T))) {
+        py::dict types = lazy_types();
+        py::str name(typeid(T).name());
+        if (types.contains(name)) {
+            types[name]();
+        }
+    }
+}
+
 } // namespace rpybuild_ext
 
 // Use this to define your module instead of PYBIND11_MODULE
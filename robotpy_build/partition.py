@@ -0,0 +1,186 @@
+#
+# Cost-based partitioning of the generated translation units
+#
+# The cost of a translation unit is estimated from the number of things
+# that need to be bound, since each method, overload and trampoline override
+# adds more templates for the compiler to instantiate
+#
+
+import typing
+
+
+def _is_bound(item) -> bool:
+    data = item.get("data")
+    return data is not None and not data.ignore
+
+
+def class_cost(cls) -> int:
+    """Estimates the cost of binding a class, including its nested classes"""
+    if not _is_bound(cls):
+        return 0
+
+    has_trampoline = cls.get("x_has_trampoline", False)
+
+    cost = 1
+    names: typing.Dict[str, int] = {}
+    for access in ("public", "protected"):
+        if access == "protected" and not has_trampoline:
+            continue
+
+        for fn in cls["methods"][access]:
+            if not _is_bound(fn) or fn["data"].ignore_py:
+                continue
+
+            cost += 1
+            names[fn["name"]] = names.get(fn["name"], 0) + 1
+
+            # each virtual function is overridden in the trampoline
+            if has_trampoline and fn["virtual"]:
+                cost += 1
+
+    # overloads are more expensive to resolve
+    cost += sum(n for n in names.values() if n > 1)
+
+    for access in ("public", "protected"):
+        cost += sum(1 for prop in cls["properties"][access] if _is_bound(prop))
+
+    for ncls in cls["nested_classes"]:
+        cost += class_cost(ncls)
+
+    return cost
+
+
+def _split_classes(header) -> typing.List[typing.Dict]:
+    # same classes that cls.cpp.j2 binds in the finish() method
+    return [
+        cls
+        for cls in header.classes
+        if not cls["parent"] and not cls["data"].ignore and "template" not in cls
+    ]
+
+
+def _has_definitions(header) -> bool:
+    # Anything with external linkage that is defined in the header would be
+    # defined again by each part that includes it
+    for fn in header.functions:
+        if fn.get("defined") and not (
+            fn.get("inline")
+            or fn.get("static")
+            or fn.get("constexpr")
+            or fn.get("template")
+        ):
+            return True
+
+    for var in header.variables:
+        if not (
+            var.get("extern")
+            or var.get("static")
+            or var.get("constant")
+            or var.get("constexpr")
+            or var.get("inline")
+        ):
+            return True
+
+    return False
+
+
+def can_batch(header, data, user_typealias: typing.List[str]) -> bool:
+    """
+    Returns True if the translation unit generated for the header can be
+    compiled together with other headers. Anything that it puts at file
+    scope (using directives and declarations, type aliases, holder type
+    casters and the macros that trampolines depend on) would also apply to
+    the headers that come after it, and extra_includes_first would no
+    longer come first.
+    """
+    if data.extra_includes_first or user_typealias:
+        return False
+
+    for using in header.using.values():
+        if using.get("using_type") != "typealias":
+            return False
+
+    for cls in header.classes:
+        if (
+            cls.get("namespace")
+            or cls.get("x_has_trampoline")
+            or (cls.get("data") is not None and cls["data"].nodelete)
+        ):
+            return False
+
+    return True
+
+
+def header_cost(header) -> int:
+    """Estimates the cost of the translation unit generated for a header"""
+    cost = 1 + sum(class_cost(cls) for cls in _split_classes(header))
+    cost += sum(1 for fn in header.functions if _is_bound(fn))
+    cost += len(header.enums)
+    return cost
+
+
+def split_header(header, target_cost: int) -> int:
+    """
+    If the header is more expensive than the target, divides its classes
+    into consecutive parts of roughly equal cost. Part 0 is bound in the
+    header's own translation unit, along with everything that isn't a
+    class.
+
+    Sets x_tu_part on each class (and x_tu_part_start on the first class of
+    each part), and returns the number of parts, or 0 if the header is not
+    split. Headers that define functions or variables with external linkage
+    are never split, since every part needs to include the header.
+    """
+    classes = _split_classes(header)
+    total = header_cost(header)
+    if total <= target_cost or len(classes) < 2 or _has_definitions(header):
+        return 0
+
+    nparts = min(len(classes), -(-total // target_cost))
+    budget = total / nparts
+
+    part = 0
+    part_cost = total - sum(class_cost(cls) for cls in classes)
+    for cls in classes:
+        cost = class_cost(cls)
+        start = False
+        if part_cost and part_cost + cost > budget and part + 1 < nparts:
+            part += 1
+            part_cost = 0
+            start = True
+
+        cls["x_tu_part"] = part
+        cls["x_tu_part_start"] = start
+        part_cost += cost
+
+    return part + 1 if part else 0
+
+
+def batch_headers(
+    costs: typing.List[typing.Tuple[str, int]], target_cost: int
+) -> typing.List[typing.List[str]]:
+    """
+    Groups tiny headers (a quarter of the target cost or less) into batches
+    that are compiled together as a single translation unit. Each batch has
+    at least two headers and costs no more than the target.
+    """
+    batches: typing.List[typing.List[str]] = []
+    batch: typing.List[str] = []
+    batch_cost = 0
+
+    for name, cost in costs:
+        if cost * 4 > target_cost:
+            continue
+
+        if batch and batch_cost + cost > target_cost:
+            batches.append(batch)
+            batch = []
+            batch_cost = 0
+
+        batch.append(name)
+        batch_cost += cost
+
+    if batch:
+        batches.append(batch)
+
+    return [b for b in batches if len(b) > 1]
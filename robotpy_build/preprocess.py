@@ -0,0 +1,329 @@
+#
+# Preprocessing of headers prior to parsing them with CppHeaderParser
+#
+
+import copy
+import io
+import os
+from os.path import abspath, normpath, relpath
+import re
+import shlex
+import shutil
+import subprocess
+import sysconfig
+import typing
+
+from header2whatever.preprocess import H2WPreprocessor, PreprocessorError
+from header2whatever.util import read_file
+
+
+class IncludeCache:
+    """
+    Memoizes the tokenized lines of each file that is preprocessed, so that
+    files included by many headers are only tokenized once per generation
+    run. Tokenization doesn't depend on the macros that are defined, so
+    entries are keyed on the path, size and modification time of the file.
+
+    The tokens are shared by every header that includes the file, and are
+    only copied by :class:`_CachingPreprocessor` when a macro in them needs
+    to be expanded.
+    """
+
+    def __init__(self):
+        self._lines: typing.Dict[
+            typing.Tuple[str, int, int], typing.List[typing.List[typing.Any]]
+        ] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def group_lines(self, pp: H2WPreprocessor, input: str, abssource: str):
+        try:
+            st = os.stat(abssource)
+        except (OSError, TypeError, ValueError):
+            return H2WPreprocessor.group_lines(pp, input, abssource)
+
+        key = (abssource, st.st_mtime_ns, st.st_size)
+        lines = self._lines.get(key)
+        if lines is None:
+            self.misses += 1
+            lines = list(H2WPreprocessor.group_lines(pp, input, abssource))
+            self._lines[key] = lines
+        else:
+            self.hits += 1
+
+        # the preprocessor removes tokens from the lines of disabled blocks
+        return [list(line) for line in lines]
+
+
+# Macros that pcpp expands by modifying the token in place
+_inplace_macros = {"__LINE__", "__COUNTER__"}
+
+
+class _CachingPreprocessor(H2WPreprocessor):
+    def __init__(self, include_cache: IncludeCache):
+        super().__init__()
+        self.include_cache = include_cache
+        self._expand_depth = 0
+
+    def group_lines(self, input, abssource):
+        return self.include_cache.group_lines(self, input, abssource)
+
+    # pcpp modifies the tokens that it expands macros in, so tokens that are
+    # shared with other headers are copied first
+
+    def expand_macros(self, tokens, expanding_from=[]):
+        if self._expand_depth == 0:
+            macros = self.macros
+            for tok in tokens:
+                if tok.type == self.t_ID and (
+                    tok.value in macros or tok.value in _inplace_macros
+                ):
+                    tokens = [_copy_token(tok) for tok in tokens]
+                    break
+
+        self._expand_depth += 1
+        try:
+            return super().expand_macros(tokens, expanding_from)
+        finally:
+            self._expand_depth -= 1
+
+    def evalexpr(self, tokens):
+        return super().evalexpr([_copy_token(tok) for tok in tokens])
+
+
+def _copy_token(tok):
+    tok = copy.copy(tok)
+    # don't share the list that pcpp uses to track recursive expansion
+    tok.expanded_from = []
+    return tok
+
+
+class PreprocessResult(typing.NamedTuple):
+    #: Preprocessed content of the header
+    content: str
+
+    #: Absolute path of every file that was read while preprocessing the
+    #: header, including the header itself
+    included: typing.List[str]
+
+
+def preprocess_file(
+    fname: str,
+    include_paths: typing.List[str],
+    defines: typing.List[str],
+    include_cache: typing.Optional[IncludeCache] = None,
+) -> PreprocessResult:
+    """
+    Preprocesses a header via pcpp, in the same way that header2whatever
+    does when ``preprocess`` is set and ``pp_retain_all_content`` is False.
+
+    Unlike header2whatever, this also reports which files were included
+    so that callers can tell when the output needs to be regenerated.
+    If an include cache is given, it is shared with other calls.
+    """
+
+    if include_cache is not None:
+        pp = _CachingPreprocessor(include_cache)
+    else:
+        pp = H2WPreprocessor()
+    for p in include_paths:
+        pp.add_path(p)
+
+    for define in defines:
+        pp.define(define)
+
+    pp.line_directive = "#line"
+
+    pp_content = read_file(fname)
+    pp.parse(pp_content, fname)
+
+    if pp.errors:
+        raise PreprocessorError("\n".join(pp.errors))
+    elif pp.return_code:
+        raise PreprocessorError("failed with exit code %d" % pp.return_code)
+
+    fp = io.StringIO()
+    pp.write(fp)
+    fp.seek(0)
+    content = _filter_self(fname, fp)
+
+    included = []
+    seen = set()
+    for it in pp.include_times:
+        path = it.included_abspath
+        if path and path not in seen:
+            seen.add(path)
+            included.append(path)
+
+    return PreprocessResult(content, included)
+
+
+def _filter_self(fname: str, fp: typing.TextIO) -> str:
+    # Same as header2whatever: the output of pcpp includes the content of
+    # every included file, so only keep the content of the header itself
+
+    # Compute the filename to match based on how pcpp does it
+    try:
+        relfname = relpath(fname)
+    except ValueError:
+        relfname = fname
+    relfname = relfname.replace("\\", "/")
+
+    relfname += '"\n'
+
+    new_output = io.StringIO()
+    keep = True
+
+    for line in fp:
+        if line.startswith("#line"):
+            keep = line.endswith(relfname)
+
+        if keep:
+            new_output.write(line)
+
+    return new_output.getvalue()
+
+
+#
+# Compiler preprocessor backend
+#
+
+_linemarker_re = re.compile(r'^# (\d+) "(.*)"')
+
+# pcpp is told the language version via a define, the compiler needs a flag
+_cxx_std = {
+    "201103L": "c++11",
+    "201402L": "c++14",
+    "201703L": "c++17",
+    "202002L": "c++20",
+}
+
+
+# "NAME", "NAME VALUE" or "NAME(ARGS) VALUE", split in the same place as pcpp
+_define_re = re.compile(r"\s*([^\s(]+(?:\([^)]*\))?)(?:\s+(.*))?$", re.DOTALL)
+
+
+def _get_cxx_define_arg(define: str) -> str:
+    m = _define_re.match(define)
+    if not m:
+        raise PreprocessorError(f"invalid define {define!r}")
+
+    name, value = m.groups()
+    value = (value or "").strip()
+
+    if name == "__cplusplus":
+        std = _cxx_std.get(value)
+        if not std:
+            raise PreprocessorError(f"unknown C++ version {value!r}")
+        return f"-std={std}"
+
+    # pcpp defines a macro without a value as empty, but -DNAME defines it
+    # as 1, so the value must always be given
+    return f"-D{name}={value}"
+
+
+def get_cxx_preprocessor() -> typing.Optional[typing.List[str]]:
+    """
+    Returns the command for the C++ compiler that extensions are built
+    with, or None if it cannot be found
+    """
+    cxx = os.environ.get("CXX") or sysconfig.get_config_var("CXX")
+    if not cxx:
+        return None
+
+    cmd = shlex.split(cxx)
+    if not cmd or not shutil.which(cmd[0]):
+        return None
+
+    return cmd
+
+
+def get_cxx_version(cxx: typing.List[str]) -> str:
+    """
+    Returns the version output of the compiler used by
+    :func:`preprocess_file_cxx`, so that a different compiler is noticed
+    """
+    try:
+        proc = subprocess.run(
+            cxx + ["--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding="utf-8",
+            errors="replace",
+        )
+    except OSError:
+        return ""
+    return proc.stdout
+
+
+def preprocess_file_cxx(
+    fname: str,
+    include_paths: typing.List[str],
+    defines: typing.List[str],
+    cxx: typing.List[str],
+) -> PreprocessResult:
+    """
+    Preprocesses a header using the compiler's preprocessor. Only the
+    content of the header itself is returned, in the same format as
+    :func:`preprocess_file`.
+    """
+
+    args = cxx + ["-E", "-dD", "-C", "-x", "c++"]
+    for define in defines:
+        args.append(_get_cxx_define_arg(define))
+
+    for p in include_paths:
+        args.append(f"-I{p}")
+
+    args.append(fname)
+
+    try:
+        proc = subprocess.run(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+            errors="replace",
+        )
+    except OSError as e:
+        raise PreprocessorError(f"could not run {cxx[0]}: {e}") from e
+
+    if proc.returncode != 0:
+        raise PreprocessorError(
+            proc.stderr.strip() or "failed with exit code %d" % proc.returncode
+        )
+
+    # Line markers are rewritten as #line directives that refer to the
+    # header in the same way that pcpp does
+    target = normpath(abspath(fname))
+    try:
+        relfname = relpath(fname)
+    except ValueError:
+        relfname = fname
+    relfname = relfname.replace("\\", "/")
+
+    content = io.StringIO()
+    included = []
+    seen = set()
+    keep = False
+
+    for line in proc.stdout.splitlines(keepends=True):
+        m = _linemarker_re.match(line)
+        if m:
+            path = m.group(2)
+            if path.startswith("<"):
+                keep = False
+                continue
+
+            path = normpath(abspath(path.replace("\\\\", "\\")))
+            if path not in seen:
+                seen.add(path)
+                included.append(path)
+
+            keep = path == target
+            if keep:
+                content.write(f'#line {m.group(1)} "{relfname}"\n')
+        elif keep:
+            content.write(line)
+
+    return PreprocessResult(content.getvalue(), included)
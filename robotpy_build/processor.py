@@ -0,0 +1,466 @@
+#
+# robotpy-build specific version of header2whatever's processing pipeline
+#
+
+import glob
+import multiprocessing
+import os
+from os.path import basename, isfile, join, relpath
+import typing
+
+import CppHeaderParser
+import jinja2
+
+from header2whatever.config import Config
+from header2whatever.parse import (
+    ConfigProcessor,
+    CppHeaderParserError,
+    PreprocessorError,
+    SkipGeneration,
+    call_hook,
+)
+
+from . import genprofile, partition
+from .casters import CasterIndex
+from .gencache import DocCache, DocChanges, ParseCache
+from .generator_data import MissingReporter
+from .hooks import Hooks
+from .hooks_datacfg import HooksDataYaml
+from .preprocess import IncludeCache, preprocess_file, preprocess_file_cxx
+
+_hook_names = ("function_hook", "method_hook", "class_hook", "header_hook")
+
+
+class OutputWriter:
+    """
+    Writes generated files, but leaves them alone if their content has not
+    changed. This keeps the mtime of the file unchanged, so that the
+    compiler (and ccache) doesn't think it needs to be rebuilt.
+    """
+
+    def __init__(self):
+        #: Files that were actually written
+        self.changed: typing.Set[str] = set()
+
+        #: Files whose content was already up to date
+        self.unchanged: typing.Set[str] = set()
+
+    def write(self, fname: str, content: str) -> bool:
+        """Returns True if the file was written"""
+        # text mode, so that newlines are translated for the platform
+        try:
+            with open(fname, encoding="utf-8") as fp:
+                if fp.read() == content:
+                    if fname not in self.changed:
+                        self.unchanged.add(fname)
+                    return False
+        except (OSError, UnicodeDecodeError):
+            pass
+
+        with open(fname, "w", encoding="utf-8") as fp:
+            fp.write(content)
+
+        self.unchanged.discard(fname)
+        self.changed.add(fname)
+        return True
+
+    def remove_unwritten(self, outdir: str, *keep: str):
+        """Removes files in outdir that weren't written by this object"""
+        written = self.changed | self.unchanged
+        for fname in glob.glob(join(glob.escape(outdir), "**"), recursive=True):
+            if isfile(fname) and fname not in written and fname not in keep:
+                os.unlink(fname)
+
+    def merge(self, changed: typing.Set[str], unchanged: typing.Set[str]):
+        """Merges the results of another writer into this one"""
+        self.changed |= changed
+        self.unchanged |= unchanged
+        self.unchanged -= self.changed
+
+    def report(self, name: str):
+        changed = len(self.changed)
+        total = changed + len(self.unchanged)
+        print(f"{name}: {changed} of {total} generated files changed")
+
+
+class GenJob(typing.NamedTuple):
+    """Everything needed to generate the wrapper for a single header"""
+
+    name: str
+    header: str
+
+    #: h2w configuration dictionary
+    cfgd: typing.Dict[str, typing.Any]
+    root: str
+
+    data: HooksDataYaml
+    data_fname: typing.Optional[str]
+    casters: CasterIndex
+    report_only: bool
+
+    parse_cache: typing.Optional[ParseCache]
+
+    #: If set, the compiler command used to preprocess the header
+    cxx_pp: typing.Optional[typing.List[str]]
+
+    #: If True, record how long each stage of generation takes
+    profile: bool
+
+    #: If set, headers that cost more than this are split into multiple
+    #: translation units, which are written to gen_dir
+    tu_cost: typing.Optional[int]
+    gen_dir: str
+
+    #: If True, the header is registered with pybind11 when it's first used
+    lazy_init: bool
+
+
+class GenResult(typing.NamedTuple):
+    included: typing.List[str]
+    written: typing.List[str]
+    missing: typing.Dict[str, typing.Any]
+    changed: typing.Set[str]
+    unchanged: typing.Set[str]
+
+    #: include cache statistics for this job
+    include_hits: int
+    include_misses: int
+
+    #: genprofile records, if profiling was enabled
+    profile: typing.Optional[typing.List[typing.Dict[str, typing.Any]]]
+
+    #: Cost of the header if it can be compiled in a unity translation unit
+    unity_cost: typing.Optional[int]
+
+    #: docstring cache entries added and used by this job
+    docs: typing.Optional[DocChanges]
+
+
+class _SplitTemplate(typing.NamedTuple):
+    src: str
+    dst: str
+    vars: typing.Dict[str, typing.Any]
+
+
+class GenProcessor(ConfigProcessor):
+    """
+    Processes a single-header h2w configuration. This is the same as
+    header2whatever's ConfigProcessor, except that it keeps track of which
+    files were read and written so that the wrapper can determine when a
+    header needs to be regenerated.
+    """
+
+    def __init__(self, searchpath, bytecode_cache: typing.Optional[str] = None):
+        super().__init__(searchpath)
+        self.outputs = OutputWriter()
+
+        # compiled templates are stored on disk so that they don't need
+        # to be compiled again by every build
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+            self._env.bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache)
+
+        #: Files that were included by the last header processed
+        self.included: typing.List[str] = []
+
+        #: Files that were written by the last configuration processed
+        self.written: typing.List[str] = []
+
+        self.parse_cache: typing.Optional[ParseCache] = None
+        self.doc_cache: typing.Optional[DocCache] = None
+        self.cxx_pp: typing.Optional[typing.List[str]] = None
+        self.tu_cost: typing.Optional[int] = None
+        self.gen_dir = ""
+
+        #: set by the last configuration processed
+        self.unity_cost: typing.Optional[int] = None
+
+        #: Shared by every header processed by this object
+        self.include_cache = IncludeCache()
+
+    def run(self, job: GenJob) -> GenResult:
+        """Generates the wrapper for a single header"""
+        self.outputs = OutputWriter()
+        self.parse_cache = job.parse_cache
+        self.cxx_pp = job.cxx_pp
+        self.tu_cost = job.tu_cost
+        self.gen_dir = job.gen_dir
+
+        hits = self.include_cache.hits
+        misses = self.include_cache.misses
+
+        cfg = Config(job.cfgd)
+        cfg.validate()
+        cfg.root = job.root
+
+        hooks = Hooks(
+            job.data, job.casters, job.report_only, self.doc_cache, job.lazy_init
+        )
+        try:
+            if job.profile:
+                with genprofile.profiling(job.name) as profiler:
+                    self.process_config(cfg, job.data, hooks)
+                profile = profiler.get_records()
+            else:
+                self.process_config(cfg, job.data, hooks)
+                profile = None
+        except Exception as e:
+            raise ValueError(f"processing {job.header}") from e
+
+        missing = hooks.report_missing(job.data_fname, MissingReporter())
+
+        return GenResult(
+            self.included,
+            self.written,
+            missing,
+            self.outputs.changed,
+            self.outputs.unchanged,
+            self.include_cache.hits - hits,
+            self.include_cache.misses - misses,
+            profile,
+            self.unity_cost,
+            self.doc_cache.take_changes() if self.doc_cache else None,
+        )
+
+    def _process_config(self, cfg: Config, data, hookobj):
+        self.included = []
+        self.written = []
+        self.unity_cost = None
+
+        hooks = {}
+        for n in _hook_names:
+            fn = getattr(hookobj, n, None)
+            if fn:
+                hooks[n] = [fn]
+            else:
+                hooks[n] = []
+
+        gbls = {}
+        gbls["config"] = cfg
+        gbls.update(cfg.vars)
+        gbls["data"] = data
+
+        # Provide an escape mechanism
+        def _skip_generation():
+            raise SkipGeneration()
+
+        gbls["skip_generation"] = _skip_generation
+
+        # generation code depends on this being just one header
+        (fname,) = cfg.headers
+        header = self._process_header(cfg, fname, hooks, gbls)
+
+        gbls["headers"] = [header]
+        gbls["header"] = header
+
+        templates = list(cfg.templates)
+
+        nparts = 0
+        if self.tu_cost:
+            nparts = partition.split_header(header, self.tu_cost)
+            if nparts:
+                mod_fn = cfg.vars["mod_fn"]
+                templates.append(
+                    _SplitTemplate(
+                        "cls_split.hpp.j2", join(self.gen_dir, f"{mod_fn}_init.hpp"), {}
+                    )
+                )
+                for part in range(1, nparts):
+                    templates.append(
+                        _SplitTemplate(
+                            "cls_part.cpp.j2",
+                            join(self.gen_dir, f"{mod_fn}_part{part}.cpp"),
+                            {"part": part},
+                        )
+                    )
+
+            elif partition.can_batch(header, data, gbls["user_typealias"]):
+                self.unity_cost = partition.header_cost(header)
+
+        gbls["tu_nparts"] = nparts
+
+        for tmpl in templates:
+            with genprofile.stage("render", basename(tmpl.src)):
+                self._render_template(tmpl, gbls)
+
+        if cfg.class_templates:
+            for clsdata in header.classes:
+                gbls["cls"] = clsdata
+                for tmpl in cfg.class_templates:
+                    name = f"{basename(tmpl.src)} ({clsdata['name']})"
+                    with genprofile.stage("render", name):
+                        self._render_template(tmpl, gbls)
+
+    def _preprocess(self, cfg: Config, fname: str):
+        if self.cxx_pp:
+            try:
+                return preprocess_file_cxx(
+                    fname, cfg.pp_include_paths, cfg.pp_defines, self.cxx_pp
+                )
+            except PreprocessorError as e:
+                print(f"WARNING: preprocessing {fname} with {self.cxx_pp[0]} failed:")
+                print(e)
+                print("WARNING: using pcpp instead")
+
+        return preprocess_file(
+            fname, cfg.pp_include_paths, cfg.pp_defines, self.include_cache
+        )
+
+    def _parse_header(self, cfg: Config, fname: str) -> CppHeaderParser.CppHeader:
+        try:
+            with genprofile.stage("preprocess"):
+                result = self._preprocess(cfg, fname)
+        except Exception as e:
+            raise PreprocessorError("processing " + fname) from e
+
+        self.included = result.included
+
+        with genprofile.stage("parse"):
+            if self.parse_cache is not None:
+                header = self.parse_cache.get(result.content)
+                if header is not None:
+                    return header
+
+            try:
+                header = CppHeaderParser.CppHeader(
+                    result.content, argType="string", preprocessed=True
+                )
+            except Exception as e:
+                raise CppHeaderParserError("processing " + fname) from e
+
+            if self.parse_cache is not None:
+                self.parse_cache.put(result.content, header)
+
+        return header
+
+    def _process_header(self, cfg: Config, fname: str, hooks, data):
+        header = self._parse_header(cfg, fname)
+
+        header.full_fname = fname
+        root = getattr(cfg, "root", None)
+        if root:
+            header.rel_fname = relpath(fname, root)
+        else:
+            header.rel_fname = fname
+
+        header.fname = basename(fname)
+
+        header.classes = header.classes_order
+
+        header.all_classes = header.classes
+        header.all_functions = header.functions
+        header.all_enums = header.enums
+        header.all_global_enums = header.global_enums
+        header.all_variables = header.variables
+
+        for cls in header.classes:
+            for method in cls["methods"]["public"]:
+                call_hook(method["name"], hooks, "method_hook", method, data)
+            with genprofile.stage("class_hook", cls["name"]):
+                call_hook(cls["name"], hooks, "class_hook", cls, data)
+
+        with genprofile.stage("function_hook"):
+            for fn in header.functions:
+                call_hook(fn["name"], hooks, "function_hook", fn, data)
+
+        with genprofile.stage("header_hook"):
+            call_hook(header.fname, hooks, "header_hook", header, data)
+        return header
+
+    def _render_template(self, tmpl, data):
+        jtmpl = self._env.get_template(basename(tmpl.src))
+
+        data["per_tmpl_vars"] = tmpl.vars
+
+        try:
+            s = jtmpl.render(**data)
+        except SkipGeneration:
+            return
+
+        dst = tmpl.dst
+        if "{" in dst:
+            dst = jinja2.Template(dst, undefined=jinja2.StrictUndefined).render(**data)
+
+        self.outputs.write(dst, s)
+        self.written.append(dst)
+
+
+#
+# Parallel generation support
+#
+
+# Processors are reused for every wrapper generated by this process, so that
+# each template is only compiled (or loaded from the bytecode cache) once
+_processors: typing.Dict[typing.Tuple[str, typing.Optional[str]], GenProcessor] = {}
+
+_worker_processor: typing.Optional[GenProcessor] = None
+
+
+def _get_processor(searchpath, bytecode_cache: typing.Optional[str]) -> GenProcessor:
+    key = (searchpath, bytecode_cache)
+    processor = _processors.get(key)
+    if processor is None:
+        processor = _processors[key] = GenProcessor(searchpath, bytecode_cache)
+    return processor
+
+
+def _worker_init(
+    searchpath,
+    bytecode_cache: typing.Optional[str],
+    doc_cache: typing.Optional[DocCache],
+):
+    global _worker_processor
+    _worker_processor = _get_processor(searchpath, bytecode_cache)
+    _worker_processor.doc_cache = doc_cache
+
+
+def _worker_run(job: GenJob) -> GenResult:
+    assert _worker_processor is not None
+    return _worker_processor.run(job)
+
+
+def get_gen_jobs() -> int:
+    """
+    Number of processes to use for generation, set via RPYBUILD_GEN_JOBS.
+    Like RPYBUILD_PARALLEL, 1 means use all available CPUs.
+    """
+    jobs = int(os.environ.get("RPYBUILD_GEN_JOBS", "0"))
+    if jobs == 1:
+        jobs = multiprocessing.cpu_count()
+
+    # workers are forked so that setup.py isn't reexecuted in each worker
+    if jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("WARNING: RPYBUILD_GEN_JOBS is not supported on this platform")
+        jobs = 0
+
+    return jobs
+
+
+def run_jobs(
+    searchpath,
+    jobs: typing.List[GenJob],
+    njobs: int,
+    bytecode_cache: typing.Optional[str] = None,
+    doc_cache: typing.Optional[DocCache] = None,
+) -> typing.Iterator[GenResult]:
+    """
+    Runs each job and yields the results in the same order as the jobs.
+    If njobs is more than 1, the jobs are run in that many worker processes.
+
+    If bytecode_cache is specified, compiled templates are cached in that
+    directory. If doc_cache is specified, converted docstrings are looked up
+    in it; the changes that each job made to it are in its result, and
+    should be merged back into it.
+    """
+    if njobs <= 1 or len(jobs) <= 1:
+        processor = _get_processor(searchpath, bytecode_cache)
+        processor.doc_cache = doc_cache
+        for job in jobs:
+            yield processor.run(job)
+        return
+
+    # workers are forked, so they start with a copy of the docstring cache
+    ctx = multiprocessing.get_context("fork")
+    initargs = (searchpath, bytecode_cache, doc_cache)
+    with ctx.Pool(min(njobs, len(jobs)), _worker_init, initargs) as pool:
+        yield from pool.imap(_worker_run, jobs)
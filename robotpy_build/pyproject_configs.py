@@ -317,6 +317,50 @@ class WrapperConfig(Model):
     #: Preprocessor definitions to apply when compiling this wrapper.
     pp_defines: List[str] = []
 
+    #: Preprocessor used to process headers before they are parsed during
+    #: code generation:
+    #:
+    #: * ``pcpp``: a preprocessor written in python
+    #: * ``compiler``: the C++ compiler's preprocessor (``$CXX -E``), which
+    #:   is much faster for headers with deep include chains. If the
+    #:   compiler cannot be found or fails, ``pcpp`` is used instead.
+    pp_backend: str = "pcpp"
+
+    #: Enables cost-based partitioning of the generated translation units.
+    #: The cost of binding each class is estimated from the number of
+    #: methods, overloads and trampoline overrides it has.
+    #:
+    #: * Headers that cost more than this are split into multiple
+    #:   translation units, each containing some of the classes
+    #: * Headers that cost less than a quarter of this are compiled together
+    #:   in unity translation units, unless their translation unit has
+    #:   anything at file scope that would affect the headers after it
+    #:   (classes in a namespace, ``using`` declarations, type aliases,
+    #:   trampolines, ``nodelete`` classes or ``extra_includes_first``)
+    #:
+    #: A value of a few hundred is a reasonable starting point.
+    tu_cost: Optional[int] = None
+
+    #: If True, headers are registered with pybind11 the first time that
+    #: something they define is accessed on the module, instead of when the
+    #: module is imported. This can significantly reduce the time it takes
+    #: to import very large wrappers. Requires Python 3.7+.
+    #:
+    #: Headers that contain base classes of other headers, that define
+    #: ``inline_code``, or whose types are used by such headers are still
+    #: registered when the module is imported. When a header is registered,
+    #: the headers whose types it uses are registered too.
+    #:
+    #: Base classes are registered when a class that derives from them is
+    #: registered, even by another package, as long as this module has
+    #: been imported first.
+    #:
+    #: .. warning:: Objects can only be converted to Python once their type
+    #:              has been registered, so custom code or other packages
+    #:              that return these types must access the type on the
+    #:              module first
+    lazy_init: bool = False
+
     #: If True, skip this wrapper; typically used in conjection with an override.
     ignore: bool = False
 
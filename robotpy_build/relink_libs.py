@@ -33,6 +33,7 @@ from os import path
 
 from typing import Dict, List, Optional, Tuple
 
+from .download import unshare_file
 from .pkgcfg_provider import PkgCfg, PkgCfgProvider
 
 
@@ -47,6 +48,9 @@ def set_install_name(file: str, old_install_name: str, new_install_name: str):
     # This function just calls delocate's set_install_name which uses install_name_tool.
     # This function exists in case we want to change the implementation.
 
+    # install_name_tool modifies the file in place, which must not change
+    # the copy in the download cache
+    unshare_file(file)
     _set_install_name(file, old_install_name, new_install_name)
     print("Relink:", file, ":", old_install_name, "->", new_install_name)
 
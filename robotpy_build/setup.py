@@ -3,6 +3,7 @@ from os.path import abspath, exists, join
 from setuptools import find_packages, setup as _setup
 from setuptools_scm import get_version
 import tomli
+from typing import List, Optional
 
 try:
     from wheel.bdist_wheel import bdist_wheel as _bdist_wheel
@@ -38,12 +39,12 @@ class Setup:
     this stuff to a million setup.py files
     """
 
-    def __init__(self):
+    def __init__(self, platform_name: Optional[str] = None):
         self.root = abspath(os.getcwd())
         self.wrappers = []
         self.static_libs = []
 
-        self.platform = get_platform()
+        self.platform = get_platform(platform_name)
 
         project_fname = join(self.root, "pyproject.toml")
 
@@ -195,7 +196,7 @@ class Setup:
             downloads = convert_maven_to_downloads(cfg.maven_lib_download, static)
             cfg.maven_lib_download = None
             if cfg.download:
-                cfg.download.append(downloads)
+                cfg.download.extend(downloads)
             else:
                 cfg.download = downloads
 
@@ -203,6 +204,21 @@ class Setup:
             for dl in cfg.download:
                 dl._update_with_platform(self.platform)
 
+    def get_download_urls(self) -> List[str]:
+        """
+        Returns the url of every file that build_dl downloads for the
+        platform, without preparing the project
+        """
+        cfgs = [(cfg, False) for cfg in self.project.wrappers.values()]
+        cfgs += [(cfg, True) for cfg in self.project.static_libs.values()]
+
+        urls = []
+        for cfg, static in cfgs:
+            if not cfg.ignore:
+                self._fix_downloads(cfg, static)
+                urls += [dl.url for dl in cfg.download or ()]
+        return urls
+
     def run(self):
         # assemble all the pieces and make it work
         _setup(**self.setup_kwargs)
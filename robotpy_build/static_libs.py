@@ -4,7 +4,7 @@ import posixpath
 import shutil
 from typing import Any, Dict, List, Optional
 
-from .download import download_and_extract_zip
+from .download import ExtractionManifest, extract_zips, get_archive_hash, get_zip
 from .pyproject_configs import Download, StaticLibConfig
 
 
@@ -82,10 +82,7 @@ class StaticLib:
 
         self.set_root(libdir)
 
-        shutil.rmtree(self.libdir, ignore_errors=True)
-        shutil.rmtree(self.incdir, ignore_errors=True)
-
-        os.makedirs(self.libdir)
+        steps = []
 
         for dl in self.cfg.download:
 
@@ -108,4 +105,27 @@ class StaticLib:
             if dl.dlopenlibs is not None:
                 raise ValueError(f"{dl.url}: cannot specify dlopenlibs in static lib")
 
-            download_and_extract_zip(dl.url, to, cache)
+            steps.append((dl.url, to))
+
+        zips = [get_zip(url, cache) for url, _ in steps]
+
+        # Only extract again if something changed since the last time
+        key = [
+            [url, get_archive_hash(zip_fname), to]
+            for zip_fname, (url, to) in zip(zips, steps)
+        ]
+        manifest = ExtractionManifest(
+            join(self.root, f"{self.name}.manifest.json"), [self.libdir, self.incdir]
+        )
+        if manifest.is_current(key):
+            return
+
+        manifest.remove()
+        shutil.rmtree(self.libdir, ignore_errors=True)
+        shutil.rmtree(self.incdir, ignore_errors=True)
+
+        os.makedirs(self.libdir)
+
+        extract_zips((zip_fname, to) for zip_fname, (_, to) in zip(zips, steps))
+
+        manifest.save(key)
@@ -8,17 +8,24 @@ import pprint
 import subprocess
 import sys
 import re
+import tempfile
+import time
 from urllib.request import Request, urlopen
 from urllib.error import HTTPError
 from collections import defaultdict
 import tomli
 import tomli_w
 from contextlib import suppress
+from typing import Dict, List, Optional, Tuple
 
 from .setup import Setup
 from .generator_data import MissingReporter
 from .command.util import get_build_temp_path
+from .wrapper import get_caster_indexes
 
+from . import dlcache
+from .download import needs_revalidation, prefetch, probe_urls
+from . import genprofile
 from . import overrides
 from . import platforms
 
@@ -81,6 +88,101 @@ class BuildDep:
             return p.returncode
 
 
+class CacheTool:
+    @classmethod
+    def add_subparser(cls, parent_parser, subparsers):
+        parser = subparsers.add_parser(
+            "cache",
+            help="Inspect or prune the shared download cache",
+            parents=[parent_parser],
+        )
+        parser.add_argument(
+            "action",
+            nargs="?",
+            choices=["info", "list", "prune", "clear"],
+            default="info",
+        )
+        parser.add_argument(
+            "--max-size",
+            type=int,
+            default=None,
+            help="prune: size to prune the cache to in MiB (default: RPYBUILD_CACHE_SIZE)",
+        )
+        return parser
+
+    def run(self, args):
+        cache = dlcache.ArtifactCache(
+            join(dlcache.get_cache_dir(), "downloads"),
+            dlcache.get_cache_size() * 1024 * 1024,
+        )
+
+        if args.action == "info":
+            entries = cache.entries()
+            print("location:", cache.root)
+            print("entries: ", len(entries))
+            print("unpacked:", len(cache.trees()))
+            print("probes:  ", len(cache.probes()))
+            print(f"size:     {cache.total_size() / 1048576:.1f} MiB")
+            print(f"limit:    {cache.max_size / 1048576:.0f} MiB")
+        elif args.action == "list":
+            for entry in reversed(cache.entries()):
+                used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["used"]))
+                size = entry["size"] / 1048576
+                print(f"{used}  {size:8.1f} MiB  {entry['url']}")
+        elif args.action == "prune":
+            max_size = cache.max_size
+            if args.max_size is not None:
+                max_size = args.max_size * 1024 * 1024
+            removed = cache.evict(max_size, grace=0)
+            print(f"removed {removed} entries")
+        elif args.action == "clear":
+            cache.clear()
+            print("cleared", cache.root)
+
+
+class PrefetchTool:
+    @classmethod
+    def add_subparser(cls, parent_parser, subparsers):
+        parser = subparsers.add_parser(
+            "prefetch",
+            help="Download the files needed to build a project for offline builds",
+            parents=[parent_parser],
+        )
+        parser.add_argument(
+            "platforms",
+            nargs="*",
+            help="Use robotpy-build platform-info --list for available platforms (default: this platform)",
+        )
+        parser.add_argument(
+            "--all", action="store_true", help="Download files for every platform"
+        )
+        parser.add_argument(
+            "--cache",
+            default=join("build", "cache"),
+            help="Directory to download to if the shared cache is disabled",
+        )
+        return parser
+
+    def run(self, args):
+        names = args.platforms or [None]
+        if args.all:
+            names = platforms.get_platform_names()
+
+        urls = []
+        for name in names:
+            urls += Setup(name).get_download_urls()
+
+        urls = list(dict.fromkeys(urls))
+        print(f"Fetching {len(urls)} files")
+        errors = prefetch(urls, args.cache)
+
+        for url, error in errors.items():
+            print(f"ERROR: {url}: {error}", file=sys.stderr)
+
+        print(f"{len(urls) - len(errors)} of {len(urls)} files are in the cache")
+        return not errors
+
+
 class GenCreator:
     @classmethod
     def add_subparser(cls, parent_parser, subparsers):
@@ -103,9 +205,12 @@ class GenCreator:
             pfx = "strip_prefixes:\n- " + "\n- ".join(args.strip_prefixes) + "\n\n"
 
         s = get_setup()
+        caster_indexes = get_caster_indexes(s.wrappers)
         for wrapper in s.wrappers:
             reporter = MissingReporter()
-            wrapper.on_build_gen("", reporter)
+            wrapper.on_build_gen(
+                "", reporter, caster_index=caster_indexes.get(wrapper.name)
+            )
 
             nada = True
             for name, report in reporter.as_yaml():
@@ -127,6 +232,54 @@ class GenCreator:
                 print("Nothing to do!")
 
 
+class GenProfile:
+    @classmethod
+    def add_subparser(cls, parent_parser, subparsers):
+        parser = subparsers.add_parser(
+            "gen-profile",
+            help="Generate every header and report how long each stage took",
+            parents=[parent_parser],
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            default="genprofile.json",
+            help="Write all timings to this JSON file",
+        )
+        parser.add_argument(
+            "-n", "--limit", type=int, default=30, help="Number of rows to display"
+        )
+        return parser
+
+    def run(self, args):
+        # downloaded headers need to be extracted first
+        subprocess.check_call([sys.executable, "setup.py", "build_dl"])
+
+        s = get_setup()
+
+        # headers are generated into a temporary directory without caches,
+        # so that every header is generated from scratch and the files used
+        # by the build are left alone
+        records = []
+        caster_indexes = get_caster_indexes(s.wrappers)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for wrapper in s.wrappers:
+                wrapper.on_build_gen(
+                    join(tmpdir, "gensrc"),
+                    profile=records,
+                    hppoutdir=join(tmpdir, "rpygen", wrapper.name),
+                    caster_index=caster_indexes.get(wrapper.name),
+                )
+
+        if not records:
+            print("Nothing to do!")
+            return
+
+        genprofile.print_table(records, args.limit)
+        genprofile.write_json(args.output, records)
+        print("Wrote", args.output)
+
+
 class HeaderScanner:
     @classmethod
     def add_subparser(cls, parent_parser, subparsers):
@@ -255,6 +408,95 @@ class ImportCreator:
         )
 
 
+class ImportProfile:
+    @classmethod
+    def add_subparser(cls, parent_parser, subparsers):
+        parser = subparsers.add_parser(
+            "import-profile",
+            help="Import a module and report how long its libraries and headers took to initialize",
+            parents=[parent_parser],
+        )
+        parser.add_argument("module", help="Ex: wpilib")
+        parser.add_argument(
+            "-n", "--limit", type=int, default=30, help="Number of rows to display"
+        )
+        return parser
+
+    def run(self, args):
+        import ctypes
+        import importlib
+        import time
+
+        # (ns, source, name, phase)
+        rows = []
+
+        # libinit files load shared libraries via cdll.LoadLibrary
+        load_library = ctypes.cdll.LoadLibrary
+
+        def _load_library(name):
+            start = time.perf_counter()
+            try:
+                return load_library(name)
+            finally:
+                elapsed = int((time.perf_counter() - start) * 1e9)
+                rows.append((elapsed, "cdll.LoadLibrary", basename(name), "load"))
+
+        already_imported = set(sys.modules.keys())
+
+        ctypes.cdll.LoadLibrary = _load_library
+        start = time.perf_counter()
+        try:
+            importlib.import_module(args.module)
+        finally:
+            import_ns = int((time.perf_counter() - start) * 1e9)
+            del ctypes.cdll.LoadLibrary
+
+        library_ns = sum(row[0] for row in rows)
+
+        # extensions built with RPYBUILD_INIT_PROFILE=1 record how long each
+        # header took to initialize
+        init_ns = 0
+        profiled = False
+        for modname, module in sorted(sys.modules.items()):
+            if modname in already_imported:
+                continue
+            profile = getattr(module, "__dict__", {}).get("_rpybuild_init_profile")
+            if profile is None:
+                continue
+
+            profiled = True
+            for header, phase, ns in profile:
+                rows.append((ns, modname, header, phase))
+                init_ns += ns
+
+        rows.sort(reverse=True)
+        if args.limit:
+            rows = rows[: args.limit]
+
+        table = [("time (ms)", "source", "name", "phase")]
+        for ns, source, name, phase in rows:
+            table.append((f"{ns / 1e6:.3f}", source, name, phase))
+
+        widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+        for row in table:
+            print(
+                "  ".join(
+                    c.rjust(w) if i == 0 else c.ljust(w)
+                    for i, (c, w) in enumerate(zip(row, widths))
+                ).rstrip()
+            )
+
+        print()
+        print(f"import {args.module}: {import_ns / 1e6:.3f}ms")
+        print(f"  shared libraries: {library_ns / 1e6:.3f}ms")
+        if profiled:
+            print(f"  native initialization: {init_ns / 1e6:.3f}ms")
+        else:
+            print(
+                "  native initialization: not recorded, rebuild with RPYBUILD_INIT_PROFILE=1"
+            )
+
+
 class PlatformInfo:
     @classmethod
     def add_subparser(cls, parent_parser, subparsers):
@@ -337,13 +579,77 @@ class MavenParser:
             action="store_true",
             help="Try known os and arch combinations instead of parsing html (needed for rev)",
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=16,
+            help="Number of URLs to check at once when using --brute_force",
+        )
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            help="Check every URL again instead of using cached results",
+        )
         return parser
 
     def check_url_exists(self, file_url):
-        with suppress(Exception):
-            if urlopen(Request(file_url)).code == 200:
-                return True
-        return False
+        return bool(self.probes.get(file_url))
+
+    def _get_brute_force_urls(
+        self, dir_url: str, art: str, ver: str
+    ) -> List[Tuple[str, Optional[str], Optional[str]]]:
+        """
+        Returns (url, os, arch) for each file that --brute_force looks for.
+        os and arch are None for the source archives.
+        """
+        urls = []
+        for os in self.os_names:
+            for arch in self.arch_names:
+                for after_arch in self.after_archs + [""]:
+                    classifier = os + arch + after_arch
+                    urls.append((f"{dir_url}{art}-{ver}-{classifier}.zip", os, arch))
+
+        urls.append((f"{dir_url}{art}-{ver}-source.zip", None, None))
+        urls.append((f"{dir_url}{art}-{ver}-sources.zip", None, None))
+        return urls
+
+    def probe(self, artifacts: List[Tuple[str, str, str]], jobs: int, refresh: bool):
+        """
+        Checks which of the files that --brute_force looks for exist for each
+        (dir_url, artifact, version). Results for released versions are
+        cached, since their files don't change.
+        """
+        urls = {}
+        for dir_url, art, ver in artifacts:
+            urls[dir_url] = [
+                url for url, _, _ in self._get_brute_force_urls(dir_url, art, ver)
+            ]
+
+        # stored in the shared cache, unless it is disabled
+        cache = dlcache.get_artifact_cache()
+
+        self.probes: Dict[str, Optional[bool]] = {}
+        for dir_url in urls:
+            if cache is None or refresh or needs_revalidation(dir_url):
+                continue
+            self.probes.update(cache.load_probes(dir_url) or {})
+
+        to_probe = [
+            url
+            for dir_urls in urls.values()
+            for url in dir_urls
+            if url not in self.probes
+        ]
+        self.probes.update(probe_urls(to_probe, jobs))
+
+        for dir_url, dir_urls in urls.items():
+            results = {url: self.probes[url] for url in dir_urls}
+            # unknown results (network errors) are checked again next time
+            if cache is None or None in results.values() or needs_revalidation(dir_url):
+                continue
+            with suppress(OSError):
+                cache.save_probes(dir_url, results)
 
     def run(self, args):
 
@@ -376,6 +682,19 @@ class MavenParser:
                 print("No maven_lib_downloads in pyproject.toml")
                 exit()
 
+            if args.brute_force:
+                # everything is checked at once up front
+                artifacts = []
+                for wrapper in {**wrappers, **static_libs}.values():
+                    mvl = wrapper["maven_lib_download"]
+                    grp = mvl["group_id"].replace(".", "/")
+                    art = mvl["artifact_id"]
+                    ver = mvl["version"]
+                    dir_url = f"{mvl['repo_url']}/{grp}/{art}/{ver}/"
+                    artifacts.append((dir_url, art, ver))
+
+                self.probe(artifacts, args.jobs, args.refresh)
+
             for w_name, wrapper in {**wrappers, **static_libs}.items():
 
                 if "maven_lib_download" not in wrapper:
@@ -397,22 +716,18 @@ class MavenParser:
 
                 if args.brute_force:
 
-                    for os in self.os_names:
-                        for arch in self.arch_names:
-                            for after_arch in self.after_archs + [""]:
-                                classifier = os + arch + after_arch
-                                file_url = f"{dir_url}{art}-{ver}-{classifier}.zip"
-
-                                if self.check_url_exists(file_url):
-                                    plats[os].add(arch)
+                    prefix = f"{dir_url}{art}-{ver}-"
+                    for file_url, os, arch in self._get_brute_force_urls(
+                        dir_url, art, ver
+                    ):
+                        if not self.check_url_exists(file_url):
+                            continue
 
-                    if self.check_url_exists(f"{dir_url}{art}-{ver}-source.zip"):
-                        found_source = True
-                        source_name = "source"
-
-                    if self.check_url_exists(f"{dir_url}{art}-{ver}-sources.zip"):
-                        found_source = True
-                        source_name = "sources"
+                        if os is not None:
+                            plats[os].add(arch)
+                        else:
+                            found_source = True
+                            source_name = file_url[len(prefix) : -len(".zip")]
 
                 else:
                     try:
@@ -488,10 +803,14 @@ def main():
 
     for cls in (
         BuildDep,
+        CacheTool,
         GenCreator,
+        GenProfile,
         HeaderScanner,
         ImportCreator,
+        ImportProfile,
         PlatformInfo,
+        PrefetchTool,
         ShowOverrides,
         MavenParser,
     ):
@@ -1,4 +1,9 @@
+import copy
+import CppHeaderParser
+import functools
 import glob
+import hashlib
+import header2whatever
 import json
 import inspect
 import os
@@ -15,13 +20,11 @@ from os.path import (
     splitext,
 )
 import posixpath
+import re
 import shutil
+import sys
 import toposort
-from typing import Any, Dict, List, Optional, Set
-import yaml
-
-from header2whatever.config import Config
-from header2whatever.parse import ConfigProcessor
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from urllib.error import HTTPError
 import dataclasses
@@ -29,11 +32,35 @@ import dataclasses
 from setuptools import Extension
 
 from .devcfg import get_dev_config
-from .download import download_and_extract_zip
+from .dlcache import sha256_file
+from .download import (
+    ExtractionManifest,
+    download_and_extract_zip,
+    extract_zips,
+    get_archive_files,
+    get_archive_hash,
+    get_patched_tree,
+    get_zip,
+    link_tree,
+)
+from . import genprofile, partition
+from .casters import CasterIndex, get_caster_index
+from .gencache import (
+    DocCache,
+    FingerprintStore,
+    GenDataCache,
+    ParseCache,
+    hash_files,
+    load_generation_data_yaml,
+)
 from .pyproject_configs import PatchInfo, WrapperConfig, Download
 from .generator_data import MissingReporter
-from .hooks import Hooks
 from .hooks_datacfg import HooksDataYaml
+from .preprocess import get_cxx_preprocessor, get_cxx_version
+from .processor import GenJob, OutputWriter, get_gen_jobs, run_jobs
+
+_ident_re = re.compile(r"[A-Za-z_]\w*")
+_include_re = re.compile(r'^\s*#\s*include\s*([<"])([^>"]+)[>"]', re.MULTILINE)
 
 
 class Wrapper:
@@ -90,6 +117,11 @@ class Wrapper:
 
         self._gen_includes = []
 
+        # Used by build_ext to precompile the headers shared by the
+        # generated sources
+        self.pch_includes: List[str] = []
+        self.pch_sources: Set[str] = set()
+
         self.extension = None
         if self.cfg.sources or self.cfg.autogen_headers:
             define_macros = [("RPYBUILD_MODULE_NAME", extname)] + [
@@ -334,16 +366,6 @@ class Wrapper:
         pkgcfgpy = join(self.root, "pkgcfg.py")
         srcdir = join(srcdir, self.name)
 
-        try:
-            os.unlink(self.libinit_import_py)
-        except OSError:
-            pass
-
-        try:
-            os.unlink(pkgcfgpy)
-        except OSError:
-            pass
-
         libnames_full = []
         downloads = self.cfg.download
         if downloads:
@@ -352,19 +374,58 @@ class Wrapper:
         self._write_libinit_py(libnames_full)
         self._write_pkgcfg_py(pkgcfgpy, libnames_full)
 
-    def _apply_patches(self, patches: List[PatchInfo], root: str):
+    def _parse_patch(self, p: PatchInfo):
         import patch
 
-        for p in patches:
-            patch_path = join(self.setup_root, normpath(p.patch))
-            ps = patch.PatchSet()
-            with open(patch_path, "rb") as fp:
-                if not ps.parse(fp):
-                    raise ValueError(f"Error parsing patch '{patch_path}'")
+        patch_path = join(self.setup_root, normpath(p.patch))
+        ps = patch.PatchSet()
+        with open(patch_path, "rb") as fp:
+            if not ps.parse(fp):
+                raise ValueError(f"Error parsing patch '{patch_path}'")
+        return ps
 
+    def _apply_patches(self, patches: List[PatchInfo], root: str):
+        for p in patches:
+            ps = self._parse_patch(p)
             if not ps.apply(strip=p.strip, root=root):
+                patch_path = join(self.setup_root, normpath(p.patch))
                 raise ValueError(f"Error applying patch '{patch_path}' to '{root}'")
 
+    def _patches_in_archive(
+        self, patches: List[PatchInfo], zip_fname: str, src: str
+    ) -> bool:
+        # True if every file that the patches modify comes from the files
+        # under src in the archive, and not from another download
+        import patch
+
+        files = get_archive_files(zip_fname, src)
+        for p in patches:
+            for item in self._parse_patch(p).items:
+                old, new = item.source, item.target
+                if p.strip:
+                    old = patch.pathstrip(old, p.strip)
+                    new = patch.pathstrip(new, p.strip)
+
+                # same order as PatchSet.findfile
+                names = [old, new]
+                if old.startswith(b"a/") and new.startswith(b"b/"):
+                    names += [old[2:], new[2:]]
+
+                for name in names:
+                    name = posixpath.normpath(os.fsdecode(name))
+                    if name in files:
+                        break
+                else:
+                    return False
+
+        return True
+
+    def _get_patches_key(self, patches: Optional[List[PatchInfo]]) -> List[Any]:
+        return [
+            [sha256_file(join(self.setup_root, normpath(p.patch))), p.strip]
+            for p in patches or ()
+        ]
+
     def _clean_and_download(
         self, downloads: List[Download], cache: str, srcdir: str
     ) -> List[str]:
@@ -375,22 +436,19 @@ class Wrapper:
         add_libdir = False
         add_incdir = False
 
-        # Remove downloaded/generated artifacts first
-        shutil.rmtree(libdir, ignore_errors=True)
-        shutil.rmtree(incdir, ignore_errors=True)
-        shutil.rmtree(srcdir, ignore_errors=True)
-
         dlopen_libnames = self.get_dlopen_library_names()
         libnames_full = []
 
+        # (url, to, patches, what the patches apply to in the archive,
+        #  patch root) for each extraction
+        steps = []
+
         for dl in downloads:
             # extract the whole thing into a directory when using for sources
             if dl.sources is not None:
-                download_and_extract_zip(dl.url, srcdir, cache)
+                steps.append((dl.url, srcdir, dl.patches, "", srcdir))
                 sources = [join(srcdir, normpath(s)) for s in dl.sources]
                 self.extension.sources.extend(sources)
-                if dl.patches:
-                    self._apply_patches(dl.patches, srcdir)
             elif dl.sources is not None:
                 raise ValueError("sources must be None if use_sources is False!")
             elif dl.patches is not None:
@@ -399,7 +457,6 @@ class Wrapper:
             if dl.libs or dl.dlopenlibs:
                 add_libdir = True
                 extract_names = []
-                os.makedirs(libdir)
 
                 libext = dl.libexts.get(self.platform.libext, self.platform.libext)
                 linkext = dl.linkexts.get(self.platform.linkext, self.platform.linkext)
@@ -433,10 +490,32 @@ class Wrapper:
                 to[dl.incdir] = self.incdir
                 add_incdir = True
 
-            download_and_extract_zip(dl.url, to, cache)
+            steps.append((dl.url, to, dl.header_patches, dl.incdir, incdir))
+
+        zips = [get_zip(url, cache) for url, *_ in steps]
+
+        # Only extract again if something changed since the last time
+        key = [
+            [url, get_archive_hash(zip_fname), to, self._get_patches_key(patches)]
+            for zip_fname, (url, to, patches, *_) in zip(zips, steps)
+        ]
+        manifest = ExtractionManifest(
+            f"{srcdir}.manifest.json", [libdir, incdir, srcdir]
+        )
+
+        if not manifest.is_current(key):
+            # Remove downloaded/generated artifacts first
+            manifest.remove()
+            shutil.rmtree(libdir, ignore_errors=True)
+            shutil.rmtree(incdir, ignore_errors=True)
+            shutil.rmtree(srcdir, ignore_errors=True)
+
+            if add_libdir:
+                os.makedirs(libdir)
 
-            if dl.header_patches:
-                self._apply_patches(dl.header_patches, incdir)
+            self._extract(zips, steps)
+
+            manifest.save(key)
 
         if add_incdir:
             for f in glob.glob(join(glob.escape(incdir), "**"), recursive=True):
@@ -448,6 +527,44 @@ class Wrapper:
 
         return libnames_full
 
+    def _extract(self, zips: List[str], steps: List[Tuple]):
+        # Archives are extracted together until a download needs to be
+        # patched, so that files from later downloads still replace the
+        # patched files just like when each one is extracted in turn
+        extract = []
+
+        for zip_fname, (_, to, patches, patch_src, patch_root) in zip(zips, steps):
+            tree = None
+            if (
+                patches
+                and patch_src is not None
+                and self._patches_in_archive(patches, zip_fname, patch_src)
+            ):
+                # patched files are cached, so the patches are only
+                # applied once for each archive
+                tree = get_patched_tree(
+                    zip_fname,
+                    patch_src,
+                    self._get_patches_key(patches),
+                    functools.partial(self._apply_patches, patches),
+                )
+
+            if tree is not None:
+                if isinstance(to, dict):
+                    to = {k: v for k, v in to.items() if k != patch_src}
+                    extract.append((zip_fname, to))
+                extract_zips(extract)
+                extract = []
+                link_tree(tree, patch_root)
+            else:
+                extract.append((zip_fname, to))
+                if patches:
+                    extract_zips(extract)
+                    extract = []
+                    self._apply_patches(patches, patch_root)
+
+        extract_zips(extract)
+
     def _write_libinit_py(self, libnames):
 
         # This file exists to ensure that any shared library dependencies
@@ -497,8 +614,7 @@ class Wrapper:
 
         init = init.replace("##IMPORTS##", imports)
 
-        with open(self.libinit_import_py, "w") as fp:
-            fp.write(init)
+        OutputWriter().write(self.libinit_import_py, init)
 
         self._add_addl_data_file(self.libinit_import_py)
 
@@ -578,27 +694,78 @@ class Wrapper:
             """
             )
 
-        with open(fname, "w") as fp:
-            fp.write(pkgcfg)
+        OutputWriter().write(fname, pkgcfg)
 
         self._add_addl_data_file(fname)
 
-    def _load_generation_data(self, datafile):
-        with open(datafile) as fp:
-            data = yaml.safe_load(fp)
+    def _load_generation_data(self, datafile, gendata_cache=None):
+        if gendata_cache is not None:
+            return gendata_cache.load(datafile)
 
-        if data is None:
-            data = {}
+        with open(datafile) as fp:
+            return load_generation_data_yaml(fp)
 
-        return HooksDataYaml(**data)
+    def _get_generation_key(
+        self, pp_includes, pp_defines, casters, cxx_pp, tu_cost, lazy_init
+    ) -> str:
+        # anything that affects the output of every header goes in here
+        thisdir = abspath(dirname(__file__))
+        h = hashlib.sha256()
+        hash_files(h, sorted(glob.glob(join(thisdir, "templates", "*.j2"))))
+        hash_files(
+            h,
+            [
+                join(thisdir, f)
+                for f in (
+                    "casters.py",
+                    "hooks.py",
+                    "hooks_datacfg.py",
+                    "generator_data.py",
+                    "mangle.py",
+                    "partition.py",
+                    "preprocess.py",
+                    "processor.py",
+                )
+            ],
+        )
+        # the parser and the preprocessor (pcpp is part of header2whatever),
+        # or the compiler that preprocesses the headers
+        versions = [CppHeaderParser.__version__, header2whatever.__version__]
+        if cxx_pp:
+            versions.append(get_cxx_version(cxx_pp))
+        return FingerprintStore.make_key(
+            h.hexdigest(),
+            versions,
+            self.incdir,
+            pp_includes,
+            pp_defines,
+            casters,
+            cxx_pp,
+            tu_cost,
+            lazy_init,
+        )
 
     def on_build_gen(
-        self, cxx_gen_dir, missing_reporter: Optional[MissingReporter] = None
+        self,
+        cxx_gen_dir,
+        missing_reporter: Optional[MissingReporter] = None,
+        cache_dir: Optional[str] = None,
+        profile: Optional[List[Dict[str, Any]]] = None,
+        hppoutdir: Optional[str] = None,
+        caster_index: Optional[CasterIndex] = None,
     ):
 
         if not self.cfg.autogen_headers:
             return
 
+        # If profile is specified, the stages of generating each header are
+        # timed and recorded in it. RPYBUILD_GEN_PROFILE=1 does the same for
+        # normal builds, and writes the results next to the generated files
+        profile_fname = None
+        if profile is None and os.environ.get("RPYBUILD_GEN_PROFILE") == "1":
+            profile = []
+            profile_fname = join(cxx_gen_dir, f"{self.name}-genprofile.json")
+
         cxx_gen_dir = join(cxx_gen_dir, self.name)
 
         if missing_reporter:
@@ -609,44 +776,100 @@ class Wrapper:
 
         thisdir = abspath(dirname(__file__))
 
-        hppoutdir = join(self.rpy_incdir, "rpygen")
+        # the class headers are installed with the package, unless they are
+        # being generated somewhere else
+        install_hpp = hppoutdir is None
+        if hppoutdir is None:
+            hppoutdir = join(self.rpy_incdir, "rpygen")
         tmpl_dir = join(thisdir, "templates")
         cpp_tmpl = join(tmpl_dir, "cls.cpp.j2")
         cls_tmpl_inst_cpp = join(tmpl_dir, "cls_tmpl_inst.cpp.j2")
         cls_tmpl_inst_hpp = join(tmpl_dir, "cls_tmpl_inst.hpp.j2")
         hpp_tmpl = join(tmpl_dir, "cls_rpy_include.hpp.j2")
         classdeps_tmpl = join(tmpl_dir, "clsdeps.json.j2")
+        lazy_tmpl = join(tmpl_dir, "lazy.json.j2")
 
         pp_includes = self._all_includes(False)
+        pp_defines = [self._cpp_version] + self.platform.defines + self.cfg.pp_defines
+        # the index is normally built once for every wrapper by the caller
+        if caster_index is None:
+            caster_index = get_caster_index(self._all_casters())
+        casters = caster_index.casters
+
+        tu_cost = None if report_only else self.cfg.tu_cost
+        lazy_init = self.cfg.lazy_init and not report_only
+        if lazy_init and sys.version_info < (3, 7):
+            # the module __getattr__ hooks need PEP 562
+            raise ValueError(f"{self.name}: lazy_init requires Python 3.7+")
+
+        pp_backend = self.cfg.pp_backend
+        cxx_pp = None
+        if pp_backend == "compiler":
+            cxx_pp = get_cxx_preprocessor()
+            if cxx_pp is None:
+                print(
+                    f"WARNING: {self.name}: C++ compiler not found,"
+                    " using pcpp to preprocess headers"
+                )
+        elif pp_backend != "pcpp":
+            raise ValueError(
+                f"{self.name}: pp_backend must be 'pcpp' or 'compiler',"
+                f" not {pp_backend!r}"
+            )
 
-        # TODO: only regenerate files if the generated files
-        #       have changed
+        # Headers whose inputs have not changed since the last time they
+        # were generated are skipped, and their previous outputs are kept
+        fingerprints = None
         if not report_only:
-
-            if self.dev_config.only_generate is None:
-                shutil.rmtree(cxx_gen_dir, ignore_errors=True)
-                shutil.rmtree(hppoutdir, ignore_errors=True)
+            fingerprints = FingerprintStore(
+                join(cxx_gen_dir, ".rpybuild-fingerprints.json"),
+                self._get_generation_key(
+                    pp_includes, pp_defines, casters, cxx_pp, tu_cost, lazy_init
+                ),
+            )
 
             os.makedirs(cxx_gen_dir, exist_ok=True)
             os.makedirs(hppoutdir, exist_ok=True)
 
+        # Parsed headers are cached so that headers that only need to be
+        # regenerated because their generation data changed aren't reparsed
+        parse_cache = None
+        parse_cache_size = int(os.environ.get("RPYBUILD_PARSE_CACHE_SIZE", "256"))
+        if cache_dir and not report_only and parse_cache_size > 0:
+            parse_cache = ParseCache(
+                join(cache_dir, "parsed"), parse_cache_size * 1024 * 1024
+            )
+
+        # Validated generation data is cached so that unchanged yaml files
+        # don't need to be parsed and validated again
+        gendata_cache = None
+        gendata_cache_size = int(os.environ.get("RPYBUILD_GENDATA_CACHE_SIZE", "64"))
+        if cache_dir and gendata_cache_size > 0:
+            gendata_cache = GenDataCache(
+                join(cache_dir, "gendata"), gendata_cache_size * 1024 * 1024
+            )
+
         per_header = False
         data_fname = self.cfg.generation_data
         if self.cfg.generation_data:
             datapath = join(self.setup_root, normpath(self.cfg.generation_data))
             per_header = isdir(datapath)
             if not per_header:
-                data = self._load_generation_data(datapath)
+                data = self._load_generation_data(datapath, gendata_cache)
         else:
+            datapath = None
             data = HooksDataYaml()
 
-        pp_defines = [self._cpp_version] + self.platform.defines + self.cfg.pp_defines
-        casters = self._all_casters()
-
         # These are written to file to make it easier for dev mode to work
         classdeps = {}
+        lazydeps = {}
 
-        processor = ConfigProcessor(tmpl_dir)
+        outputs = OutputWriter()
+
+        # (name, fingerprint data filename, job) for headers that need to be
+        # generated, or (name, data filename, fingerprint entry) for headers
+        # that were skipped; missing reports are merged in header order
+        pending: List[Any] = []
 
         if self.dev_config.only_generate is not None:
             only_generate = {n: True for n in self.dev_config.only_generate}
@@ -686,6 +909,11 @@ class Wrapper:
                     {"src": cpp_tmpl, "dst": cpp_dst},
                     {"src": classdeps_tmpl, "dst": classdeps_dst},
                 ]
+
+                if lazy_init:
+                    lazydeps_dst = join(cxx_gen_dir, f"{name}_lazy.json")
+                    lazydeps[name] = lazydeps_dst
+                    templates.append({"src": lazy_tmpl, "dst": lazydeps_dst})
                 class_templates = [{"src": hpp_tmpl, "dst": hpp_dst}]
 
             if per_header:
@@ -694,7 +922,7 @@ class Wrapper:
                     print("WARNING: could not find", data_fname)
                     data = HooksDataYaml()
                 else:
-                    data = self._load_generation_data(data_fname)
+                    data = self._load_generation_data(data_fname, gendata_cache)
 
                 # split instantiation of each template to separate cpp files to reduce
                 # compiler memory for really obscene objects
@@ -718,8 +946,18 @@ class Wrapper:
                         self.extension.sources.append(tmpl_cpp_dst)
 
             if only_generate is not None and not only_generate.pop(name, False):
+                # the previous outputs are still used
+                if tu_cost and name in fingerprints.headers:
+                    pending.append((name, None, fingerprints.headers[name]))
                 continue
 
+            fp_data_fname = data_fname if per_header else datapath
+            if fingerprints is not None and only_generate is None:
+                entry = fingerprints.get_current(name, fp_data_fname)
+                if entry is not None:
+                    pending.append((name, data_fname, entry))
+                    continue
+
             # for each thing, create a h2w configuration dictionary
             cfgd = {
                 # generation code depends on this being just one header!
@@ -733,17 +971,82 @@ class Wrapper:
                 "vars": {"mod_fn": name},
             }
 
-            cfg = Config(cfgd)
-            cfg.validate()
-            cfg.root = self.incdir
+            job = GenJob(
+                name,
+                header,
+                cfgd,
+                self.incdir,
+                data,
+                data_fname,
+                caster_index,
+                report_only,
+                parse_cache,
+                cxx_pp,
+                profile is not None,
+                tu_cost,
+                cxx_gen_dir,
+                lazy_init,
+            )
+            pending.append((name, fp_data_fname, job))
+
+        jobs = [job for _, _, job in pending if isinstance(job, GenJob)]
+        bytecode_cache = join(cache_dir, "jinja") if cache_dir else None
+
+        # Converted docstrings are cached, since converting them is slow and
+        # the same comments are converted again whenever a header changes
+        doc_cache = None
+        doc_cache_size = int(os.environ.get("RPYBUILD_DOC_CACHE_SIZE", "64"))
+        if cache_dir and jobs and not report_only and doc_cache_size > 0:
+            doc_cache = DocCache(
+                join(cache_dir, "docs.pickle"), doc_cache_size * 1024 * 1024
+            )
+
+        results = run_jobs(tmpl_dir, jobs, get_gen_jobs(), bytecode_cache, doc_cache)
+        include_hits = 0
+        include_misses = 0
+
+        # (name, outputs, unity cost) of each header, used for partitioning
+        tu_info = []
+
+        for name, fname, item in pending:
+            if not isinstance(item, GenJob):
+                tu_info.append((name, item["outputs"], item["unity_cost"]))
+                if fname and item["missing"]:
+                    missing = copy.deepcopy(item["missing"])
+                    missing_reporter.add_report(fname, missing)
+                continue
+
+            # results are yielded in the same order as the jobs
+            result = next(results)
+            tu_info.append((name, result.written, result.unity_cost))
+            if result.missing:
+                missing_reporter.add_report(item.data_fname, result.missing)
+
+            outputs.merge(result.changed, result.unchanged)
+            include_hits += result.include_hits
+            include_misses += result.include_misses
+            if result.profile:
+                profile.extend(result.profile)
+            if doc_cache is not None and result.docs:
+                doc_cache.merge(result.docs)
+
+            if fingerprints is not None:
+                fingerprints.update(
+                    name,
+                    fname,
+                    result.included,
+                    result.written,
+                    result.missing,
+                    result.unity_cost,
+                )
 
-            hooks = Hooks(data, casters, report_only)
-            try:
-                processor.process_config(cfg, data, hooks)
-            except Exception as e:
-                raise ValueError(f"processing {header}") from e
+        if fingerprints is not None:
+            if only_generate is None:
+                fingerprints.remove_unused(self.cfg.autogen_headers.keys())
+            fingerprints.save()
 
-            hooks.report_missing(data_fname, missing_reporter)
+        if doc_cache is not None:
+            doc_cache.save()
 
         if only_generate:
             unused = ", ".join(sorted(only_generate))
@@ -757,15 +1060,44 @@ class Wrapper:
 
         # generate an inline file that can be included + called
         if not report_only:
-            self._write_wrapper_hpp(cxx_gen_dir, classdeps)
+            if tu_cost:
+                self._partition_sources(cxx_gen_dir, tu_info, tu_cost, outputs)
+            init_profile = os.environ.get("RPYBUILD_INIT_PROFILE") == "1"
+            self._write_wrapper_hpp(
+                cxx_gen_dir, classdeps, lazydeps, outputs, init_profile
+            )
+
+            self.pch_sources = {
+                s for s in self.extension.sources if s.startswith(cxx_gen_dir + sep)
+            }
+            self.pch_includes = self._get_pch_includes(self.pch_sources)
+            outputs.report(self.name)
+            if profile is not None and include_hits + include_misses:
+                hit_rate = 100 * include_hits / (include_hits + include_misses)
+                print(
+                    f"{self.name}: preprocessor include cache: {include_hits} hits,"
+                    f" {include_misses} misses ({hit_rate:.0f}% hit rate)"
+                )
+
+            # Everything was regenerated, so anything not written this time
+            # is left over from some previous build
+            if self.dev_config.only_generate is None and not fingerprints.loaded:
+                outputs.remove_unwritten(cxx_gen_dir, fingerprints.fname)
+                outputs.remove_unwritten(hppoutdir)
             gen_includes = [cxx_gen_dir]
         else:
             gen_includes = []
 
+        if profile_fname is not None:
+            genprofile.print_table(profile, 20)
+            genprofile.write_json(profile_fname, profile)
+            print(f"{self.name}: generation profile written to {profile_fname}")
+
         self._gen_includes = gen_includes
 
-        for f in glob.glob(join(glob.escape(hppoutdir), "*.hpp")):
-            self._add_addl_data_file(f)
+        if install_hpp:
+            for f in glob.glob(join(glob.escape(hppoutdir), "*.hpp")):
+                self._add_addl_data_file(f)
 
     def finalize_extension(self):
         if self.extension is None:
@@ -784,7 +1116,229 @@ class Wrapper:
         self.extension.libraries = self._all_library_names()
         self.extension.extra_objects = self._all_extra_objects()
 
-    def _write_wrapper_hpp(self, outdir, classdeps):
+    def _partition_sources(
+        self,
+        outdir: str,
+        tu_info: List[Tuple[str, List[str], Optional[int]]],
+        tu_cost: int,
+        outputs: OutputWriter,
+    ):
+        # headers that were split have extra translation units
+        unity_costs = []
+        for name, written, unity_cost in tu_info:
+            part_re = re.compile(re.escape(name) + r"_part\d+\.cpp")
+            for fname in written:
+                if part_re.fullmatch(basename(fname)):
+                    self.extension.sources.append(fname)
+
+            if unity_cost is not None:
+                unity_costs.append((name, unity_cost))
+
+        # tiny headers are compiled together so that they only need to parse
+        # pybind11 and friends once
+        unity_fnames = set()
+        batches = partition.batch_headers(unity_costs, tu_cost)
+        for i, batch in enumerate(batches, start=1):
+            unity_fname = join(outdir, f"rpygen_unity{i}.cpp")
+            content = "// This file is autogenerated, DO NOT EDIT\n" + "".join(
+                f'#include "{name}.cpp"\n' for name in batch
+            )
+            outputs.write(unity_fname, content)
+            unity_fnames.add(unity_fname)
+
+            for name in batch:
+                self.extension.sources.remove(join(outdir, f"{name}.cpp"))
+            self.extension.sources.append(unity_fname)
+
+        for fname in glob.glob(join(glob.escape(outdir), "rpygen_unity*.cpp")):
+            if fname not in unity_fnames:
+                os.unlink(fname)
+
+    def _get_pch_includes(self, sources: Set[str]) -> List[str]:
+        """
+        Returns the headers that can be precompiled for the generated
+        sources: robotpy_build.h and any pybind11 headers that come right
+        after it, if every one of them starts by including them in the same
+        order. Anything else could change what the code that comes before
+        it in some source means.
+        """
+        scanned: Dict[str, Tuple[List[str], bool]] = {}
+
+        def _scan(fname: str) -> Tuple[List[str], bool]:
+            # the includes at the top of the file, and whether the file
+            # contains nothing else
+            result = scanned.get(fname)
+            if result is not None:
+                return result
+
+            scanned[fname] = ([], False)
+            includes: List[str] = []
+            with open(fname) as fp:
+                for line in fp:
+                    line = line.strip()
+                    if not line or line.startswith("//") or line == "#pragma once":
+                        continue
+                    m = _include_re.match(line)
+                    if m is None:
+                        break
+                    kind, inc = m.groups()
+                    if kind == "<":
+                        includes.append(inc)
+                        continue
+                    # generated files include each other
+                    path = join(dirname(fname), inc)
+                    if not exists(path):
+                        break
+                    incs, only_includes = _scan(path)
+                    includes += incs
+                    if not only_includes:
+                        break
+                else:
+                    result = scanned[fname] = (includes, True)
+                    return result
+
+            result = scanned[fname] = (includes, False)
+            return result
+
+        common: Optional[List[str]] = None
+        for fname in sources:
+            includes = _scan(fname)[0]
+            if common is None:
+                common = includes
+            else:
+                n = 0
+                while n < min(len(common), len(includes)):
+                    if common[n] != includes[n]:
+                        break
+                    n += 1
+                common = common[:n]
+
+        if not common or common[0] != "robotpy_build.h":
+            return []
+
+        pch = ["robotpy_build.h"]
+        for inc in common[1:]:
+            if not inc.startswith("pybind11/"):
+                break
+            pch.append(inc)
+        return pch
+
+    def _get_lazy_init(
+        self,
+        ordering: List[str],
+        to_sort: Dict[str, Set[str]],
+        lazydeps: Dict[str, str],
+    ) -> Tuple[List[str], str]:
+        """
+        Determines which headers can be initialized lazily, and returns
+        them along with the code that installs the module __getattr__ hooks
+        that initialize them
+        """
+        lazy_data = {}
+        for name, jsonfile in lazydeps.items():
+            with open(jsonfile) as fp:
+                lazy_data[name] = json.load(fp)
+
+        # Types are matched by their unqualified name, since that's often
+        # how they are referred to. Matching too many is harmless.
+        typenames: Dict[str, Set[str]] = {}
+        for name, data in lazy_data.items():
+            for typename in data["defines"]:
+                typenames.setdefault(typename, set()).add(name)
+
+        # headers whose classes are used by each header
+        uses: Dict[str, Set[str]] = {}
+        for name in ordering:
+            used = set(to_sort.get(name, ()))
+            for typename in lazy_data[name]["types"]:
+                for ident in _ident_re.findall(typename):
+                    used |= typenames.get(ident, set())
+            used.discard(name)
+            uses[name] = used
+
+        # Headers with base classes used by other headers must be
+        # initialized first, and so must everything they use
+        has_dependents = set()
+        for deps in to_sort.values():
+            has_dependents |= deps
+
+        eager = {
+            name
+            for name in ordering
+            if name in has_dependents or lazy_data[name]["eager"]
+        }
+        pending = list(eager)
+        while pending:
+            for dep in uses[pending.pop()]:
+                if dep not in eager:
+                    eager.add(dep)
+                    pending.append(dep)
+
+        lazy = [name for name in ordering if name not in eager]
+        if not lazy:
+            return [], ""
+
+        lazy_idx = {name: i for i, name in enumerate(lazy)}
+
+        # everything that needs to be initialized along with each header,
+        # in initialization order
+        needs: Dict[str, List[int]] = {}
+        for name in lazy:
+            needed = {name}
+            pending = [name]
+            while pending:
+                for dep in uses[pending.pop()]:
+                    if dep not in eager and dep not in needed:
+                        needed.add(dep)
+                        pending.append(dep)
+            needs[name] = sorted(lazy_idx[n] for n in needed)
+
+        scopes: Dict[str, Dict[str, Set[int]]] = {"": {}}
+        for name in lazy:
+            for pkg, export in lazy_data[name]["exports"]:
+                scope = scopes.setdefault(pkg, {})
+                scope.setdefault(export, set()).update(needs[name])
+
+        lines = [
+            "",
+            "    auto rpybuild_lazy = std::make_shared<rpybuild_lazy_state>(m);",
+            "    rpybuild_lazy->headers = {",
+        ]
+        for name in lazy:
+            lines.append(f"        {{begin_init_{name}, finish_init_{name}, false}},")
+        lines.append("    };")
+
+        # other headers (and other packages) register the lazily registered
+        # base classes of their classes through rpybuild_ext::require_type
+        for name in lazy:
+            args = ", ".join(str(i) for i in needs[name])
+            lines.append(
+                f"    rpybuild_lazy_register(rpybuild_lazy, lazy_types_{name}, {{{args}}});"
+            )
+
+        for pkg, names in sorted(scopes.items()):
+            lines.append("    {")
+            if pkg:
+                lines.append(f'        py::module scope = m.def_submodule("{pkg}");')
+            else:
+                lines.append("        py::module scope = m;")
+            lines.append("        py::dict names;")
+            for export, idx in sorted(names.items()):
+                args = ", ".join(str(i) for i in sorted(idx))
+                lines.append(f'        names["{export}"] = py::make_tuple({args});')
+            lines.append("        rpybuild_lazy_install(rpybuild_lazy, scope, names);")
+            lines.append("    }")
+
+        return lazy, "\n".join(lines)
+
+    def _write_wrapper_hpp(
+        self,
+        outdir,
+        classdeps,
+        lazydeps,
+        outputs: OutputWriter,
+        init_profile: bool = False,
+    ):
 
         decls = []
         begin_calls = []
@@ -829,11 +1383,69 @@ class Wrapper:
 
         ordering.extend(toposort.toposort_flatten(to_sort, sort=True))
 
+        lazy: List[str] = []
+        if lazydeps:
+            lazy, lazy_init = self._get_lazy_init(ordering, to_sort, lazydeps)
+
         for name in ordering:
             decls.append(f"void begin_init_{name}(py::module &m);")
             decls.append(f"void finish_init_{name}();")
-            begin_calls.append(f"    begin_init_{name}(m);")
-            finish_calls.append(f"    finish_init_{name}();")
+            if name in lazy:
+                decls.append(
+                    f"void lazy_types_{name}(std::vector<const char*> &types);"
+                )
+                continue
+            elif init_profile:
+                # each call is timed, and the results are stored in the
+                # module so that import-profile can retrieve them
+                begin_calls.append(
+                    "    rpybuild_init_start = rpybuild_init_clock::now();"
+                )
+                begin_calls.append(f"    begin_init_{name}(m);")
+                begin_calls.append(
+                    f'    rpybuild_init_record(rpybuild_init_profile, "{name}", "begin", rpybuild_init_start);'
+                )
+                finish_calls.append(
+                    "    rpybuild_init_start = rpybuild_init_clock::now();"
+                )
+                finish_calls.append(f"    finish_init_{name}();")
+                finish_calls.append(
+                    f'    rpybuild_init_record(rpybuild_init_profile, "{name}", "finish", rpybuild_init_start);'
+                )
+            else:
+                begin_calls.append(f"    begin_init_{name}(m);")
+                finish_calls.append(f"    finish_init_{name}();")
+
+        if init_profile:
+            profile_decls = inspect.cleandoc(
+                """
+
+            #include <chrono>
+
+            typedef std::chrono::steady_clock rpybuild_init_clock;
+
+            static void rpybuild_init_record(py::list &profile, const char *name, const char *phase,
+                                             rpybuild_init_clock::time_point start) {
+                auto elapsed = rpybuild_init_clock::now() - start;
+                auto ns = std::chrono::duration_cast<std::chrono::nanoseconds>(elapsed).count();
+                profile.append(py::make_tuple(name, phase, ns));
+            }
+
+            """
+            )
+            begin_calls.insert(0, "    py::list rpybuild_init_profile;")
+            begin_calls.insert(
+                1, "    rpybuild_init_clock::time_point rpybuild_init_start;"
+            )
+            finish_calls.append(
+                '    m.attr("_rpybuild_init_profile") = rpybuild_init_profile;'
+            )
+        else:
+            profile_decls = None
+
+        if lazy:
+            decls.insert(0, _lazy_init_decls + "\n")
+            finish_calls.append(lazy_init)
 
         content = (
             inspect.cleandoc(
@@ -841,7 +1453,7 @@ class Wrapper:
 
         // This file is autogenerated, DO NOT EDIT
         #pragma once
-        #include <robotpy_build.h>
+        #include <robotpy_build.h>##PROFILE_DECLS##
 
         // forward declarations
         ##DECLS##
@@ -854,10 +1466,151 @@ class Wrapper:
         
         """
             )
+            .replace(
+                "##PROFILE_DECLS##", f"\n\n{profile_decls}" if profile_decls else ""
+            )
             .replace("##DECLS##", "\n".join(decls))
             .replace("##BEGIN_CALLS##", "\n".join(begin_calls))
             .replace("##FINISH_CALLS##", "\n".join(finish_calls))
         )
 
-        with open(join(outdir, "rpygen_wrapper.hpp"), "w") as fp:
-            fp.write(content)
+        outputs.write(join(outdir, "rpygen_wrapper.hpp"), content)
+
+
+def get_caster_indexes(wrappers: List[Wrapper]) -> Dict[str, CasterIndex]:
+    """
+    Builds the type caster index used by each wrapper, keyed on the name
+    of the wrapper. This is done once per build, and wrappers that use the
+    same type casters share an index.
+    """
+    indexes: Dict[str, CasterIndex] = {}
+    by_deps: Dict[Any, CasterIndex] = {}
+    for wrapper in wrappers:
+        if not wrapper.cfg.autogen_headers:
+            continue
+
+        # the casters only depend on the dependencies of the wrapper, unless
+        # it has casters of its own
+        key = (
+            frozenset(wrapper.all_deps()),
+            wrapper.name if wrapper.cfg.type_casters else None,
+        )
+        index = by_deps.get(key)
+        if index is None:
+            index = by_deps[key] = get_caster_index(wrapper._all_casters())
+        indexes[wrapper.name] = index
+    return indexes
+
+
+# Headers that are initialized lazily are initialized by the __getattr__
+# of the module (or subpackage) the first time something they define is
+# accessed, along with any other headers whose types they use
+_lazy_init_decls = inspect.cleandoc(
+    """
+
+#include <memory>
+#include <string>
+#include <vector>
+
+struct rpybuild_lazy_header {
+    void (*begin_init)(py::module &m);
+    void (*finish_init)();
+    bool initialized;
+};
+
+struct rpybuild_lazy_state {
+    py::module m;
+    std::vector<rpybuild_lazy_header> headers;
+    bool initializing = false;
+
+    explicit rpybuild_lazy_state(py::module &m) : m(m) {}
+
+    // same two-phase initialization as initWrapper
+    void init(const std::vector<size_t> &indices) {
+        std::vector<rpybuild_lazy_header*> pending;
+        for (auto i : indices) {
+            auto &header = headers[i];
+            if (!header.initialized) {
+                header.initialized = true;
+                pending.push_back(&header);
+            }
+        }
+
+        // a header can require a base class from another package that
+        // registers its types lazily, which may require one from here
+        bool was_initializing = initializing;
+        initializing = true;
+        try {
+            for (auto header : pending) {
+                header->begin_init(m);
+            }
+            for (auto header : pending) {
+                header->finish_init();
+            }
+        } catch (...) {
+            initializing = was_initializing;
+            throw;
+        }
+        initializing = was_initializing;
+    }
+
+    void init_all() {
+        std::vector<size_t> indices;
+        for (size_t i = 0; i < headers.size(); i++) {
+            indices.push_back(i);
+        }
+        init(indices);
+    }
+};
+
+static void rpybuild_lazy_register(std::shared_ptr<rpybuild_lazy_state> state,
+                                   void (*get_types)(std::vector<const char*> &types),
+                                   std::vector<size_t> indices) {
+    std::vector<const char*> types;
+    get_types(types);
+
+    py::cpp_function init([state, indices]() {
+        state->init(indices);
+    });
+
+    py::dict registry = rpybuild_ext::lazy_types();
+    for (auto name : types) {
+        registry[py::str(name)] = init;
+    }
+}
+
+static void rpybuild_lazy_install(std::shared_ptr<rpybuild_lazy_state> state, py::module scope, py::dict names) {
+    py::dict scope_dict = scope.attr("__dict__");
+    std::string scope_name = py::str(scope.attr("__name__"));
+
+    scope.attr("__getattr__") = py::cpp_function([state, scope_dict, scope_name, names](py::str name) -> py::object {
+        // while initializing, pybind11 looks up existing attributes
+        if (!state->initializing) {
+            if (names.contains(name)) {
+                std::vector<size_t> indices;
+                for (auto i : names[name].cast<py::tuple>()) {
+                    indices.push_back(i.cast<size_t>());
+                }
+                state->init(indices);
+            } else if (std::string(name) == "__all__") {
+                // star imports use the module dictionary
+                state->init_all();
+            }
+        }
+
+        if (scope_dict.contains(name)) {
+            return scope_dict[name];
+        }
+        throw py::attribute_error("module '" + scope_name + "' has no attribute '" + std::string(name) + "'");
+    });
+
+    scope.attr("__dir__") = py::cpp_function([state, scope_dict]() -> py::object {
+        if (!state->initializing) {
+            state->init_all();
+        }
+        return py::module::import("builtins").attr("sorted")(scope_dict);
+    });
+}
+
+"""
+)
@@ -0,0 +1,9 @@
+from . import _init_rpytest_lazy
+from . import _rpytest_lazy
+
+# Names are only looked up on the compiled module when they are used, so
+# that the headers that define them are registered lazily
+
+
+def __getattr__(name):
+    return getattr(_rpytest_lazy, name)
@@ -0,0 +1,6 @@
+#pragma once
+
+struct LazyBase {
+    virtual ~LazyBase() = default;
+    virtual int baseFn() const { return 1; }
+};
@@ -0,0 +1,11 @@
+#pragma once
+
+struct LazyOther {
+    int otherFn() const { return 2; }
+};
+
+template <typename T>
+struct LazyTmpl {
+    virtual ~LazyTmpl() = default;
+    virtual T tmplFn() const { return 3; }
+};
@@ -0,0 +1,8 @@
+from . import _init_rpytest_lazychild
+
+# the base classes are defined in this module, which must be imported first
+from ..lazy import _rpytest_lazy
+
+from ._rpytest_lazychild import LazyChild, LazyTmplChild
+
+__all__ = ["LazyChild", "LazyTmplChild"]
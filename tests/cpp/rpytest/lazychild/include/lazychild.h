@@ -0,0 +1,11 @@
+#pragma once
+
+#include <lazybase.h>
+#include <lazyother.h>
+
+// the base classes are registered lazily by another package
+struct LazyChild : LazyBase {
+    int childFn() const { return 4; }
+};
+
+struct LazyTmplChild : LazyTmpl<int> {};
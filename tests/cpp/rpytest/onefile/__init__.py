@@ -0,0 +1,6 @@
+from . import _init_rpytest_onefile
+
+# autogenerated by 'robotpy-build create-imports rpytest.onefile rpytest.onefile._rpytest_onefile'
+from ._rpytest_onefile import OnefileClass, onefile2_fn, onefile_fn
+
+__all__ = ["OnefileClass", "onefile2_fn", "onefile_fn"]
@@ -0,0 +1,11 @@
+#pragma once
+
+//
+// Headers of a wrapper whose generation data is a single file
+//
+
+int onefileOriginal() { return 0x1; }
+
+struct OnefileClass {
+    int fnOriginal() { return 0x2; }
+};
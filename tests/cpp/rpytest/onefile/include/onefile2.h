@@ -0,0 +1,3 @@
+#pragma once
+
+int onefile2Original() { return 0x3; }
@@ -0,0 +1,3 @@
+#include <rpygen_wrapper.hpp>
+
+RPYBUILD_PYBIND11_MODULE(m) { initWrapper(m); }
\ No newline at end of file
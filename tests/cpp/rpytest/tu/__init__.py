@@ -0,0 +1,6 @@
+from . import _init_rpytest_tu
+
+# autogenerated by 'robotpy-build create-imports rpytest.tu rpytest.tu._rpytest_tu'
+from ._rpytest_tu import TUSplit1, TUSplit2, TUSplit3, tu1, tu2, tu_a_fn, tu_b_fn
+
+__all__ = ["TUSplit1", "TUSplit2", "TUSplit3", "tu1", "tu2", "tu_a_fn", "tu_b_fn"]
@@ -0,0 +1,7 @@
+#pragma once
+
+//
+// Tiny headers that are batched into one translation unit
+//
+
+inline int tu_a_fn() { return 0xa; }
@@ -0,0 +1,3 @@
+#pragma once
+
+inline int tu_b_fn() { return 0xb; }
@@ -0,0 +1,20 @@
+#pragma once
+
+//
+// Classes in different namespaces with the same name, whose methods use
+// unqualified names. Batching them into one translation unit would make
+// the names ambiguous.
+//
+
+namespace tu1 {
+
+struct Item {
+    int get() const { return 1; }
+};
+
+struct User {
+    int use(const Item &item) { return item.get(); }
+    int use(int i) { return i; }
+};
+
+} // namespace tu1
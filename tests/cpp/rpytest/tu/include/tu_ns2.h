@@ -0,0 +1,14 @@
+#pragma once
+
+namespace tu2 {
+
+struct Item {
+    int get() const { return 2; }
+};
+
+struct User {
+    int use(const Item &item) { return item.get(); }
+    int use(int i) { return i; }
+};
+
+} // namespace tu2
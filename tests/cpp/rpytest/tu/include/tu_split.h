@@ -0,0 +1,27 @@
+#pragma once
+
+//
+// A header that costs more than tu_cost, so its classes are split across
+// several translation units
+//
+
+struct TUSplit1 {
+    int fn1() { return 1; }
+    int fn2() { return 2; }
+    int fn3() { return 3; }
+    int fn4() { return 4; }
+};
+
+struct TUSplit2 {
+    int fn1() { return 5; }
+    int fn2() { return 6; }
+    int fn3() { return 7; }
+    int fn4() { return 8; }
+};
+
+struct TUSplit3 {
+    int fn1() { return 9; }
+    int fn2() { return 10; }
+    int fn3() { return 11; }
+    int fn4() { return 12; }
+};
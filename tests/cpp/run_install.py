@@ -20,10 +20,8 @@ def create_artifact_path(path, group_id, artifact_id, version, classifier):
     return join(path, fname)
 
 
-def http_server():
-    httpd = http.server.HTTPServer(
-        ("127.0.0.1", 0), http.server.SimpleHTTPRequestHandler
-    )
+def http_server(handler=http.server.SimpleHTTPRequestHandler):
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), handler)
 
     t = threading.Thread(target=httpd.serve_forever, daemon=True)
     t.start()
@@ -31,6 +29,26 @@ def http_server():
     return httpd, httpd.socket.getsockname()[1]
 
 
+def create_maven_repo(root, d):
+    """Creates the artifacts that the test project downloads in d"""
+
+    # create headers and sources zip files
+    hname = create_artifact_path(d, "fake.dl", "dl", "1.2.3", "headers")
+    with zipfile.ZipFile(hname, "w") as z:
+        z.write(join(root, "dl", "downloaded.h"), "downloaded.h")
+
+    sname = create_artifact_path(d, "fake.dl", "dl", "1.2.3", "sources")
+    with zipfile.ZipFile(sname, "w") as z:
+        z.write(join(root, "dl", "downloaded.cpp"), "downloaded.cpp")
+
+
+def write_pyproject(root, port):
+    with open(join(root, "pyproject.toml.tmpl")) as rfp:
+        content = rfp.read().replace("RANDOM_PORT", str(port))
+        with open(join(root, "pyproject.toml"), "w") as wfp:
+            wfp.write(content)
+
+
 if __name__ == "__main__":
 
     root = abspath(dirname(__file__))
@@ -41,15 +59,7 @@ if __name__ == "__main__":
 
     # create tempdir with maven directory structure for pkg
     with tempfile.TemporaryDirectory() as d:
-
-        # create headers and sources zip files
-        hname = create_artifact_path(d, "fake.dl", "dl", "1.2.3", "headers")
-        with zipfile.ZipFile(hname, "w") as z:
-            z.write(join(root, "dl", "downloaded.h"), "downloaded.h")
-
-        sname = create_artifact_path(d, "fake.dl", "dl", "1.2.3", "sources")
-        with zipfile.ZipFile(sname, "w") as z:
-            z.write(join(root, "dl", "downloaded.cpp"), "downloaded.cpp")
+        create_maven_repo(root, d)
 
         # http.server prior to 3.7 could only serve the current directory
         os.chdir(d)
@@ -57,10 +67,7 @@ if __name__ == "__main__":
         # start http server on random port
         httpd, port = http_server()
 
-        with open(join(root, "pyproject.toml.tmpl")) as rfp:
-            content = rfp.read().replace("RANDOM_PORT", str(port))
-            with open(join(root, "pyproject.toml"), "w") as wfp:
-                wfp.write(content)
+        write_pyproject(root, port)
 
         cwd = None
 
@@ -87,6 +94,9 @@ if __name__ == "__main__":
         env = os.environ.copy()
         env["SETUPTOOLS_SCM_PRETEND_VERSION"] = "0.0.1"
 
+        # don't leave the test downloads in the user's shared cache
+        env["RPYBUILD_CACHE_DIR"] = join(d, "rpybuild-cache")
+
         subprocess.check_call(cmd_args, cwd=cwd, env=env)
 
         # Windows fails if you try to delete the directory you're currently in
@@ -0,0 +1,80 @@
+#
+# Tests for the type caster lookup
+#
+
+import pickle
+
+from robotpy_build import casters
+from robotpy_build.casters import CasterIndex, get_caster_index, split_typename
+
+
+def test_split_typename():
+    assert split_typename("int") == ("int",)
+    assert split_typename("std::vector<int>") == ("std::vector", "", "int", "")
+    assert split_typename("std::map<std::string, std::vector<Foo> >") == (
+        "std::map",
+        "",
+        "std::string,std::vector",
+        "Foo",
+        "",
+        "",
+    )
+    assert split_typename("std::function<void(int)>") == (
+        "std::function",
+        "",
+        "void",
+        "int",
+        "",
+        "",
+    )
+
+
+def _index():
+    return CasterIndex(
+        {
+            "std::vector": {"hdr": "pybind11/stl.h", "typename": "std::vector"},
+            "std::string": {"hdr": "pybind11/stl.h", "typename": "std::string"},
+            "units::meter_t": {
+                "hdr": "units_caster.h",
+                "darg": True,
+                "typename": "units::meter_t",
+            },
+        },
+        "key",
+    )
+
+
+def test_get_cfgs():
+    index = _index()
+    assert index.get_cfgs("int") == ()
+    assert [c["typename"] for c in index.get_cfgs("std::string")] == ["std::string"]
+
+    # template arguments are looked up as well
+    cfgs = index.get_cfgs("std::vector<units::meter_t>")
+    assert [c["typename"] for c in cfgs] == ["std::vector", "units::meter_t"]
+    assert [c.get("darg", False) for c in cfgs] == [False, True]
+
+    # and the result is remembered
+    assert index.get_cfgs("std::vector<units::meter_t>") is cfgs
+
+
+def test_get_includes():
+    index = _index()
+    assert index.get_includes("int") == frozenset()
+    assert index.get_includes("std::vector<std::string>") == {"pybind11/stl.h"}
+    assert index.get_includes("std::vector<units::meter_t>") == {
+        "pybind11/stl.h",
+        "units_caster.h",
+    }
+
+
+def test_shared_index(monkeypatch):
+    monkeypatch.setattr(casters, "_indexes", {})
+    cfg = {"std::vector": {"hdr": "pybind11/stl.h", "typename": "std::vector"}}
+
+    index = get_caster_index(cfg)
+    assert get_caster_index(dict(cfg)) is index
+    assert get_caster_index({}) is not index
+
+    # unpickling an index in the same process gives the shared index
+    assert pickle.loads(pickle.dumps(index)) is index
@@ -0,0 +1,649 @@
+#
+# Tests for the shared download cache, using a local HTTP server
+#
+
+import argparse
+import errno
+import glob
+import hashlib
+import http.client
+import http.server
+import io
+import os
+import shutil
+import socketserver
+import threading
+import time
+from urllib.error import HTTPError
+from os.path import join
+import zipfile
+
+import pytest
+
+from robotpy_build import download, dlcache
+from robotpy_build.pyproject_configs import PatchInfo
+from robotpy_build.tool import MavenParser
+from robotpy_build.wrapper import Wrapper
+
+from cpp.run_install import http_server
+
+
+def make_zip(files):
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, "w") as z:
+        for name, content in files.items():
+            z.writestr(name, content)
+    return b.getvalue()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves the files of the server, with support for ETag and Range"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.user_agents.append(self.headers.get("User-Agent"))
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()
+        rng = self.headers.get("Range")
+
+        if self.headers.get("If-None-Match") == etag:
+            status = 304
+            body = b""
+        elif rng and self.headers.get("If-Range") == etag:
+            status = 206
+            body = data[int(rng[len("bytes=") :].rstrip("-")) :]
+        else:
+            status = 200
+            body = data
+
+        server.requests.append((self.path, status, rng))
+
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        truncate = server.truncate.pop(self.path, None)
+        if truncate is not None:
+            # the connection is closed before everything is sent
+            self.wfile.write(body[:truncate])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd, port = http_server(Handler)
+    httpd.files = {}
+    httpd.requests = []
+    httpd.user_agents = []
+    httpd.truncate = {}
+    httpd.url = f"http://127.0.0.1:{port}"
+    try:
+        yield httpd
+    finally:
+        download._close_connections()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """The shared cache, in a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("RPYBUILD_CACHE_DIR", str(tmp_path / "rc"))
+    for name in (
+        "RPYBUILD_CACHE_SIZE",
+        "RPYBUILD_DL_REVALIDATE",
+        "RPYBUILD_DL_LINK",
+        "RPYBUILD_OFFLINE",
+    ):
+        monkeypatch.delenv(name, raising=False)
+    return dlcache.get_artifact_cache()
+
+
+def test_corrupted_blob(server, cache, capsys):
+    server.files["/a.zip"] = make_zip({"a.txt": "a"})
+    url = server.url + "/a.zip"
+
+    blob = download.get_zip(url, "bc")
+    assert cache.get(url) == blob
+
+    with open(blob, "ab") as fp:
+        fp.write(b"junk")
+
+    # the corrupted file is discarded and downloaded again
+    assert cache.get(url) is None
+    assert "discarding corrupted cache entry" in capsys.readouterr().out
+    assert not os.path.exists(blob)
+
+    download.download_and_extract_zip(url, "out", "bc")
+    assert [r[:2] for r in server.requests] == [("/a.zip", 200), ("/a.zip", 200)]
+    with open(join("out", "a.txt")) as fp:
+        assert fp.read() == "a"
+
+
+def test_resume_download(server, cache):
+    data = make_zip({"a.txt": "a" * 100000})
+    server.files["/a.zip"] = data
+    server.truncate["/a.zip"] = 30000
+    url = server.url + "/a.zip"
+
+    with pytest.raises(http.client.IncompleteRead):
+        download.download_and_extract_zip(url, "out", "bc")
+
+    # the partial file is kept
+    (part,) = glob.glob(join(cache.tmp_dir, "*.part"))
+    assert os.path.getsize(part) == 30000
+
+    # and the download continues where it left off
+    download.download_and_extract_zip(url, "out", "bc")
+    assert server.requests == [("/a.zip", 200, None), ("/a.zip", 206, "bytes=30000-")]
+    assert not os.path.exists(part)
+
+    with open(cache.get(url), "rb") as fp:
+        assert fp.read() == data
+    with open(join("out", "a.txt")) as fp:
+        assert fp.read() == "a" * 100000
+
+
+def test_revalidate_snapshot(server, cache):
+    server.files["/a-SNAPSHOT.zip"] = make_zip({"a.txt": "1"})
+    url = server.url + "/a-SNAPSHOT.zip"
+
+    download.download_and_extract_zip(url, "out", "bc")
+
+    # unchanged on the server, so the cached copy is used
+    download.download_and_extract_zip(url, "out", "bc")
+    assert [r[1] for r in server.requests] == [200, 304]
+    with open(join("out", "a.txt")) as fp:
+        assert fp.read() == "1"
+
+    # changed on the server
+    server.files["/a-SNAPSHOT.zip"] = make_zip({"a.txt": "2"})
+    download.download_and_extract_zip(url, "out", "bc")
+    assert [r[1] for r in server.requests] == [200, 304, 200]
+    with open(join("out", "a.txt")) as fp:
+        assert fp.read() == "2"
+
+    # other files aren't revalidated
+    server.files["/b-1.0.zip"] = make_zip({"b.txt": "b"})
+    for _ in range(2):
+        download.download_and_extract_zip(server.url + "/b-1.0.zip", "out", "bc")
+    assert [r[1] for r in server.requests] == [200, 304, 200, 200]
+
+
+def _extract(zip_fname, out):
+    # same as Wrapper._clean_and_download, returns True if it extracted
+    out = os.path.abspath(out)
+    manifest = download.ExtractionManifest(f"{out}.manifest.json", [out])
+    key = [download.get_archive_hash(zip_fname)]
+    if manifest.is_current(key):
+        return False
+
+    manifest.remove()
+    shutil.rmtree(out, ignore_errors=True)
+    download.extract_zip(zip_fname, out)
+    manifest.save(key)
+    return True
+
+
+def test_extraction_manifest(server, cache):
+    server.files["/a.zip"] = make_zip({"a.txt": "a", "d/b.txt": "b"})
+    zip_fname = download.get_zip(server.url + "/a.zip", "bc")
+
+    assert _extract(zip_fname, "out")
+    st = os.stat(join("out", "d", "b.txt"))
+
+    # nothing changed, so the files are left alone
+    assert not _extract(zip_fname, "out")
+    assert os.stat(join("out", "d", "b.txt")).st_mtime_ns == st.st_mtime_ns
+
+    # a file was touched, so everything is extracted again
+    os.utime(join("out", "d", "b.txt"), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert _extract(zip_fname, "out")
+
+    with open(join("out", "a.txt"), "w") as fp:
+        fp.write("changed")
+    assert _extract(zip_fname, "out")
+    with open(join("out", "a.txt")) as fp:
+        assert fp.read() == "a"
+
+    assert not _extract(zip_fname, "out")
+
+    # a removed file is noticed too
+    os.unlink(join("out", "d", "b.txt"))
+    assert _extract(zip_fname, "out")
+    assert os.path.exists(join("out", "d", "b.txt"))
+
+    # and so is a different archive
+    server.files["/b.zip"] = make_zip({"a.txt": "b"})
+    assert _extract(download.get_zip(server.url + "/b.zip", "bc"), "out")
+    with open(join("out", "a.txt")) as fp:
+        assert fp.read() == "b"
+
+
+def test_patched_tree(server, cache):
+    server.files["/a.zip"] = make_zip({"inc/a.h": "a", "inc/b.h": "b"})
+    zip_fname = download.get_zip(server.url + "/a.zip", "bc")
+
+    patched = []
+
+    def apply_patches(root):
+        patched.append(root)
+        with open(join(root, "a.h"), "w") as fp:
+            fp.write("patched")
+
+    root = download.get_patched_tree(zip_fname, "inc", ["p1"], apply_patches)
+    assert patched == [root]
+
+    # the patches are only applied once
+    assert download.get_patched_tree(zip_fname, "inc", ["p1"], apply_patches) == root
+    assert patched == [root]
+
+    download.link_tree(root, "out")
+    with open(join("out", "a.h")) as fp:
+        assert fp.read() == "patched"
+    with open(join("out", "b.h")) as fp:
+        assert fp.read() == "b"
+
+    # different patches are stored separately
+    other = download.get_patched_tree(zip_fname, "inc", ["p2"], apply_patches)
+    assert other != root
+    assert patched == [root, other]
+
+
+def test_offline(server, cache, monkeypatch):
+    server.files["/a.zip"] = make_zip({"a.txt": "a"})
+    url = server.url + "/a.zip"
+
+    monkeypatch.setenv("RPYBUILD_OFFLINE", "1")
+    with pytest.raises(OSError, match="robotpy-build prefetch") as excinfo:
+        download.check_offline([url], "bc")
+    assert url in str(excinfo.value)
+
+    with pytest.raises(OSError, match="RPYBUILD_OFFLINE"):
+        download.get_zip(url, "bc")
+    assert server.requests == []
+
+    monkeypatch.delenv("RPYBUILD_OFFLINE")
+    assert download.prefetch([url], "bc") == {}
+
+    # once downloaded, builds don't need the server
+    monkeypatch.setenv("RPYBUILD_OFFLINE", "1")
+    download.check_offline([url], "bc")
+    download.download_and_extract_zip(url, "out", "bc")
+    assert len(server.requests) == 1
+    with open(join("out", "a.txt")) as fp:
+        assert fp.read() == "a"
+
+
+class SlowHandler(Handler):
+    """Takes a while to respond, and counts the requests in progress"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if self.path in server.files:
+                time.sleep(server.delay)
+            super().do_GET()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def slow_server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.files = {}
+    httpd.requests = []
+    httpd.user_agents = []
+    httpd.truncate = {}
+    httpd.lock = threading.Lock()
+    httpd.active = 0
+    httpd.max_active = 0
+    httpd.delay = 0.5
+    httpd.url = f"http://127.0.0.1:{httpd.socket.getsockname()[1]}"
+    try:
+        yield httpd
+    finally:
+        download._close_connections()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_parallel_downloads(slow_server, cache, monkeypatch):
+    monkeypatch.setenv("RPYBUILD_DL_JOBS", "4")
+    urls = []
+    for i in range(4):
+        slow_server.files[f"/{i}.zip"] = make_zip({f"{i}.txt": str(i)})
+        urls.append(f"{slow_server.url}/{i}.zip")
+
+    start = time.monotonic()
+    with download.parallel_downloads(urls, "bc"):
+        for url in urls:
+            download.download_and_extract_zip(url, "out", "bc")
+    elapsed = time.monotonic() - start
+
+    assert slow_server.max_active == 4
+    assert elapsed < 4 * slow_server.delay
+    assert sorted(r[0] for r in slow_server.requests) == [f"/{i}.zip" for i in range(4)]
+    for i in range(4):
+        with open(join("out", f"{i}.txt")) as fp:
+            assert fp.read() == str(i)
+
+
+def test_parallel_downloads_error(slow_server, cache, monkeypatch):
+    monkeypatch.setenv("RPYBUILD_DL_JOBS", "2")
+    missing = slow_server.url + "/missing.zip"
+    urls = [missing]
+    for i in range(5):
+        slow_server.files[f"/{i}.zip"] = make_zip({f"{i}.txt": str(i)})
+        urls.append(f"{slow_server.url}/{i}.zip")
+
+    # the error of the download in the background is raised by the build
+    # step that needs it
+    with pytest.raises(HTTPError) as excinfo:
+        with download.parallel_downloads(urls, "bc"):
+            download.download_and_extract_zip(missing, "out", "bc")
+    assert excinfo.value.code == 404
+
+    # downloads that hadn't started were cancelled, and the ones in
+    # progress were finished
+    requested = [r[0] for r in slow_server.requests]
+    assert "/4.zip" not in requested
+    assert 1 <= len(requested) < 5
+    for path in requested:
+        assert cache.get(slow_server.url + path) is not None
+
+
+def test_project_cache_same_basename(server, cache, monkeypatch):
+    # without the shared cache, files are named by the basename of the url
+    monkeypatch.setenv("RPYBUILD_CACHE_SIZE", "0")
+    server.files["/x/a.zip"] = make_zip({"x.txt": "x"})
+    server.files["/y/a.zip"] = make_zip({"y.txt": "y"})
+
+    active = set()
+    overlapped = []
+    _download = download._download
+
+    def slow_download(url, dst_fname, *args, **kwargs):
+        if dst_fname in active:
+            overlapped.append(dst_fname)
+        active.add(dst_fname)
+        try:
+            time.sleep(0.2)
+            return _download(url, dst_fname, *args, **kwargs)
+        finally:
+            active.discard(dst_fname)
+
+    monkeypatch.setattr(download, "_download", slow_download)
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda url: results.append(download.get_zip(url, "bc")),
+            args=(server.url + path,),
+        )
+        for path in ("/x/a.zip", "/y/a.zip")
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the downloads to the same file were not interleaved
+    assert overlapped == []
+    assert results == [join("bc", "a.zip")] * 2
+    assert not glob.glob(join("bc", "*.part"))
+
+
+def test_unpacked_size(server, cache):
+    server.files["/a.zip"] = make_zip({"a.txt": "a" * 1000, "b.txt": "b" * 2000})
+    server.files["/c.zip"] = make_zip({"c.txt": "c" * 4000})
+    a_zip = download.get_zip(server.url + "/a.zip", "bc")
+    c_zip = download.get_zip(server.url + "/c.zip", "bc")
+    blobs = os.path.getsize(a_zip) + os.path.getsize(c_zip)
+
+    # only the files that are needed are unpacked
+    download.extract_zip(a_zip, {"a.txt": join("out", "a.txt")})
+    (a_tree,) = cache.trees()
+    assert os.listdir(a_tree["path"]) == ["a.txt"]
+    assert a_tree["size"] == 1000
+    assert cache.total_size() == blobs + 1000
+
+    # and the rest are added when they are needed
+    download.extract_zip(a_zip, join("out", "a"))
+    (a_tree,) = cache.trees()
+    assert sorted(os.listdir(a_tree["path"])) == ["a.txt", "b.txt"]
+    assert cache.total_size() == blobs + 3000
+
+    download.extract_zip(c_zip, join("out", "c"))
+    assert cache.total_size() == blobs + 7000
+
+    # the least recently used directory is removed first
+    os.utime(a_tree["path"] + ".json", (1, 1))
+    assert cache.evict(blobs + 4000, grace=0) == 1
+    assert not os.path.exists(a_tree["path"])
+    assert [t["size"] for t in cache.trees()] == [4000]
+    assert cache.get(server.url + "/a.zip") == a_zip
+
+    # directories are removed along with their archive
+    assert cache.evict(0, grace=0) == 3
+    assert cache.trees() == []
+    assert cache.total_size() == 0
+
+    with open(join("out", "a", "b.txt")) as fp:
+        assert fp.read() == "b" * 2000
+
+
+def _patch(fname, name, old, new):
+    with open(fname, "w") as fp:
+        fp.write(f"--- {name}\n+++ {name}\n@@ -1 +1 @@\n-{old}\n+{new}\n")
+    return [PatchInfo(patch=fname)]
+
+
+def test_patch_order(server, cache, tmp_path):
+    server.files["/a.zip"] = make_zip({"inc/x.h": "a\n", "inc/y.h": "a\n"})
+    server.files["/b.zip"] = make_zip({"inc/x.h": "b\n", "inc/z.h": "b\n"})
+    a_zip = download.get_zip(server.url + "/a.zip", "bc")
+    b_zip = download.get_zip(server.url + "/b.zip", "bc")
+    inc = str(tmp_path / "out")
+
+    wrapper = Wrapper.__new__(Wrapper)
+    wrapper.setup_root = str(tmp_path)
+
+    def step(patches):
+        return (None, {"inc": inc}, patches, "inc", inc)
+
+    # the patched files from a are replaced by b, which is extracted later
+    x_patch = _patch("x.patch", "x.h", "a", "patched")
+    y_patch = _patch("y.patch", "y.h", "a", "patched")
+    wrapper._extract([a_zip, b_zip], [step(x_patch + y_patch), step(None)])
+    with open(join(inc, "x.h")) as fp:
+        assert fp.read() == "b\n"
+    with open(join(inc, "y.h")) as fp:
+        assert fp.read() == "patched\n"
+    assert [t["lock"][:8] for t in cache.trees()].count("patched-") == 1
+
+    # patches that modify files from other downloads are applied in place
+    shutil.rmtree(inc)
+    z_patch = _patch("z.patch", "z.h", "b", "patched")
+    wrapper._extract([b_zip, a_zip], [step(None), step(x_patch + z_patch)])
+    with open(join(inc, "x.h")) as fp:
+        assert fp.read() == "patched\n"
+    with open(join(inc, "z.h")) as fp:
+        assert fp.read() == "patched\n"
+    assert [t["lock"][:8] for t in cache.trees()].count("patched-") == 1
+
+    # patches that don't apply are an error
+    with open("bad.patch", "w") as fp:
+        fp.write("--- y.h\n+++ y.h\n@@ -1,2 +1,2 @@\n c\n-d\n+patched\n")
+    bad_patch = [PatchInfo(patch="bad.patch")]
+    with pytest.raises(ValueError, match="Error applying patch"):
+        wrapper._extract([a_zip], [step(bad_patch)])
+
+
+def test_maven_probes(server, cache):
+    server.files["/a/1.0/a-1.0-linuxx86-64.zip"] = b"a"
+    dir_url = server.url + "/a/1.0/"
+    url = dir_url + "a-1.0-linuxx86-64.zip"
+
+    parser = MavenParser()
+    parser.os_names = {"linux"}
+    parser.arch_names = {"x86-64"}
+
+    parser.probe([(dir_url, "a", "1.0")], 1, False)
+    assert parser.check_url_exists(url)
+    assert not parser.check_url_exists(dir_url + "a-1.0-sources.zip")
+
+    # the results are stored in the shared cache
+    (probes,) = cache.probes()
+    assert cache.total_size() == probes["size"]
+
+    del server.files["/a/1.0/a-1.0-linuxx86-64.zip"]
+    parser.probe([(dir_url, "a", "1.0")], 1, False)
+    assert parser.check_url_exists(url)
+
+    # and are removed along with everything else
+    assert cache.evict(0, grace=0) == 1
+    assert cache.probes() == []
+    parser.probe([(dir_url, "a", "1.0")], 1, False)
+    assert not parser.check_url_exists(url)
+
+    assert len(cache.probes()) == 1
+    cache.clear()
+    assert cache.probes() == []
+
+
+def test_url_exists_without_head(server):
+    # the server doesn't support HEAD, so the files are requested instead
+    server.files["/a.zip"] = b"a" * 100000
+    assert download.url_exists(server.url + "/a.zip") is True
+    assert download.url_exists(server.url + "/b.zip") is False
+    assert download.url_exists(server.url + "/a.zip") is True
+    assert [r[:2] for r in server.requests] == [("/a.zip", 200), ("/a.zip", 200)]
+    assert server.user_agents == [download.USER_AGENT] * 3
+
+
+def test_maven_brute_force(server, cache, tmp_path, capsys):
+    dir_url = server.url + "/a/a/1.0/"
+    server.files["/a/a/1.0/a-1.0-linuxx86-64.zip"] = b"a"
+    server.files["/a/a/1.0/a-1.0-windowsx86-64static.zip"] = b"a"
+    server.files["/a/a/1.0/a-1.0-sources.zip"] = b"a"
+
+    toml = tmp_path / "pyproject.toml"
+    toml.write_text(
+        "[tool.robotpy-build.wrappers.a.maven_lib_download]\n"
+        f'repo_url = "{server.url}"\n'
+        'group_id = "a"\n'
+        'artifact_id = "a"\n'
+        'version = "1.0"\n'
+    )
+    args = argparse.Namespace(
+        toml_link=str(toml), brute_force=True, jobs=1, refresh=False
+    )
+    MavenParser().run(args)
+
+    out = capsys.readouterr().out
+    assert f"URL :: {dir_url}" in out
+    assert "The name of the source file is: sources" in out
+    assert '{ os = "linux", arch = "x86-64" }' in out
+    assert '{ os = "windows", arch = "x86-64" }' in out
+    assert out.count("{ os =") == 2
+
+
+def test_linker(tmp_path):
+    def fail(err):
+        def method(src, dst):
+            calls.append(err)
+            raise OSError(err, os.strerror(err), dst)
+
+        return method
+
+    src = tmp_path / "src"
+    src.write_text("a")
+    dst = str(tmp_path / "dst")
+
+    # unsupported methods are skipped, and aren't tried again
+    calls = []
+    linker = download._Linker([fail(errno.EXDEV), fail(errno.EMLINK), shutil.copyfile])
+    linker.link(str(src), dst)
+    linker.link(str(src), dst)
+    assert calls == [errno.EXDEV, errno.EMLINK]
+    with open(dst) as fp:
+        assert fp.read() == "a"
+
+    # other errors are raised
+    calls = []
+    linker = download._Linker([fail(errno.ENOSPC), shutil.copyfile])
+    with pytest.raises(OSError) as excinfo:
+        linker.link(str(src), dst)
+    assert excinfo.value.errno == errno.ENOSPC
+    assert linker.methods[0] is not shutil.copyfile
+
+
+def _read_tree(root):
+    tree = {}
+    for dirpath, _, fnames in os.walk(root):
+        for fname in fnames:
+            path = join(dirpath, fname)
+            with open(path) as fp:
+                tree[os.path.relpath(path, root)] = fp.read()
+    return tree
+
+
+def test_threaded_extraction(cache, tmp_path, monkeypatch):
+    # no directory entries, so every directory is created from the file names
+    files = {
+        f"include/d{i % 7}/s{i % 3}/f{i}.h": f"// {i}\n" * (i + 1) for i in range(100)
+    }
+    files["include/top.h"] = "top"
+    files["other/skipped.h"] = "skipped"
+    zip_fname = str(tmp_path / "a.zip")
+    with open(zip_fname, "wb") as fp:
+        fp.write(make_zip(files))
+    with zipfile.ZipFile(zip_fname) as z:
+        assert not any(info.is_dir() for info in z.infolist())
+
+    executors = []
+    ThreadPoolExecutor = download.ThreadPoolExecutor
+
+    def executor(jobs):
+        executors.append(jobs)
+        return ThreadPoolExecutor(jobs)
+
+    monkeypatch.setattr(download, "ThreadPoolExecutor", executor)
+
+    trees = []
+    for jobs in ("1", "8"):
+        monkeypatch.setenv("RPYBUILD_EXTRACT_JOBS", jobs)
+        download.extract_zip(zip_fname, f"all{jobs}")
+        download.extract_zip(zip_fname, {"include": f"inc{jobs}"})
+        trees.append((_read_tree(f"all{jobs}"), _read_tree(f"inc{jobs}")))
+
+    assert executors == [8, 8]
+    serial, threaded = trees
+    assert serial == threaded
+    assert serial[0] == {k.replace("/", os.sep): v for k, v in files.items()}
+    assert len(serial[1]) == 101
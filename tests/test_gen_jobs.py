@@ -0,0 +1,113 @@
+#
+# Ensures that generating the test project in parallel produces the same
+# files as generating it serially
+#
+
+import filecmp
+import os
+from os.path import abspath, dirname, join
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from cpp.run_install import create_maven_repo, http_server, write_pyproject
+
+cpp_root = join(abspath(dirname(__file__)), "cpp")
+
+# generated files that are compared
+GENERATED = ["gensrc", "rpy-include"]
+
+
+@pytest.fixture
+def maven_port(tmp_path, monkeypatch):
+    d = tmp_path / "maven"
+    d.mkdir()
+    create_maven_repo(cpp_root, str(d))
+
+    # http.server prior to 3.7 could only serve the current directory
+    monkeypatch.chdir(d)
+    httpd, port = http_server()
+    try:
+        yield port
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def _generate(tmp_path, port, jobs):
+    root = tmp_path / f"jobs{jobs}"
+    shutil.copytree(
+        cpp_root,
+        str(root),
+        ignore=shutil.ignore_patterns(
+            "build",
+            "rpy-include",
+            "*.egg-info",
+            "__pycache__",
+            "*.so",
+            "_init_*.py",
+            "_rpytest_*",
+            "pkgcfg.py",
+            "pyproject.toml",
+        ),
+    )
+    write_pyproject(str(root), port)
+
+    env = os.environ.copy()
+    env["SETUPTOOLS_SCM_PRETEND_VERSION"] = "0.0.1"
+    env["RPYBUILD_GEN_JOBS"] = str(jobs)
+    # nothing may come from a cache that the other run filled
+    env["RPYBUILD_CACHE_DIR"] = str(tmp_path / f"cache{jobs}")
+
+    subprocess.check_call(
+        [
+            sys.executable,
+            "setup.py",
+            "build_gen",
+            "--build-temp",
+            "build/temp",
+            "--cxx-gen-dir",
+            "build/gensrc",
+        ],
+        cwd=str(root),
+        env=env,
+    )
+
+    # collect the rpy-include directories of every package in one place
+    out = tmp_path / f"out{jobs}"
+    shutil.copytree(str(root / "build" / "gensrc"), str(out / "gensrc"))
+    rpytest = root / "rpytest"
+    for pkg in sorted(os.listdir(str(rpytest))):
+        inc = rpytest / pkg / "rpy-include"
+        if inc.is_dir():
+            shutil.copytree(str(inc), str(out / "rpy-include" / pkg))
+    return out
+
+
+def _diff(dcmp, path=""):
+    diffs = [join(path, f) for f in dcmp.left_only + dcmp.right_only]
+    diffs += [join(path, f) for f in dcmp.diff_files + dcmp.funny_files]
+    for name, sub in dcmp.subdirs.items():
+        diffs += _diff(sub, join(path, name))
+    return diffs
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "fork"), reason="RPYBUILD_GEN_JOBS needs fork support"
+)
+def test_gen_jobs(tmp_path, maven_port):
+    serial = _generate(tmp_path, maven_port, 0)
+    parallel = _generate(tmp_path, maven_port, 4)
+
+    for name in GENERATED:
+        assert os.listdir(str(serial / name))
+        filecmp.clear_cache()
+        # the fingerprints contain the path of the project
+        dcmp = filecmp.dircmp(
+            str(serial / name),
+            str(parallel / name),
+            ignore=[".rpybuild-fingerprints.json"],
+        )
+        assert _diff(dcmp) == []
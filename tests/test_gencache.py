@@ -0,0 +1,97 @@
+#
+# Tests for the caches used during code generation
+#
+
+import os
+
+import CppHeaderParser
+
+from robotpy_build import gencache
+from robotpy_build.casters import CasterIndex
+from robotpy_build.gencache import DocCache, ParseCache
+from robotpy_build.hooks import Hooks
+from robotpy_build.hooks_datacfg import HooksDataYaml
+
+
+def _hooks(doc_cache):
+    return Hooks(HooksDataYaml(), CasterIndex({}, "key"), False, doc_cache)
+
+
+def test_doc_cache_templates(tmp_path):
+    fname = str(tmp_path / "docs.pickle")
+    hooks = _hooks(DocCache(fname, 1024 * 1024))
+
+    assert hooks._process_tmpl_doc('a "b"\nc') == ['"a \\"b\\"\\n"', '"c"']
+    added, used = hooks.doc_cache.take_changes()
+    assert list(added.values()) == [['"a \\"b\\"\\n"', '"c"']]
+    hooks.doc_cache.merge((added, used))
+    hooks.doc_cache.save()
+
+    # the quoted docstring comes from the cache
+    hooks = _hooks(DocCache(fname, 1024 * 1024))
+    assert hooks._process_tmpl_doc('a "b"\nc') == ['"a \\"b\\"\\n"', '"c"']
+    added, used = hooks.doc_cache.take_changes()
+    assert added == {}
+    assert len(used) == 1
+
+
+def test_doc_cache_key(tmp_path, monkeypatch):
+    fname = str(tmp_path / "docs.pickle")
+    cache = DocCache(fname, 1024 * 1024)
+    cache.put("k", ['"doc"'])
+    cache.save()
+    assert DocCache(fname, 1024 * 1024).entries == {"k": ['"doc"']}
+
+    # a change to the hooks discards the cache
+    hash_files = gencache.hash_files
+
+    def changed_hooks(h, fnames):
+        hash_files(h, fnames)
+        h.update(b"changed")
+
+    monkeypatch.setattr(gencache, "hash_files", changed_hooks)
+    assert DocCache(fname, 1024 * 1024).entries == {}
+
+
+def _parse(content):
+    return CppHeaderParser.CppHeader(content, argType="string")
+
+
+def test_parse_cache(tmp_path, monkeypatch):
+    cache = ParseCache(str(tmp_path), 1024 * 1024)
+    content = "struct A { int fn(int x); };\n"
+    assert cache.get(content) is None
+
+    cache.put(content, _parse(content))
+    header = cache.get(content)
+    assert header is not None
+    (method,) = header.classes["A"]["methods"]["public"]
+    assert method["name"] == "fn"
+    assert method["parameters"][0]["name"] == "x"
+
+    # a change to the preprocessed content is a miss
+    assert cache.get("struct A { int fn(int y); };\n") is None
+
+    # and so is a different version of the parser
+    monkeypatch.setattr(CppHeaderParser, "__version__", "0.0.0")
+    assert cache.get(content) is None
+
+
+def test_parse_cache_eviction(tmp_path):
+    contents = {name: f"struct {name} {{}};\n" for name in "ABC"}
+
+    cache = ParseCache(str(tmp_path), 1024 * 1024)
+    cache.put(contents["A"], _parse(contents["A"]))
+    cache.put(contents["B"], _parse(contents["B"]))
+    size = os.path.getsize(cache._fname(contents["A"]))
+    os.utime(cache._fname(contents["A"]), (1000, 1000))
+    os.utime(cache._fname(contents["B"]), (2000, 2000))
+
+    # A was used most recently, so B is removed to make room for C
+    cache = ParseCache(str(tmp_path), size * 2 + size // 2)
+    assert cache.get(contents["A"]) is not None
+    cache.put(contents["C"], _parse(contents["C"]))
+
+    assert cache.get(contents["B"]) is None
+    assert cache.get(contents["A"]) is not None
+    assert cache.get(contents["C"]) is not None
@@ -0,0 +1,28 @@
+# ensures that lazily registered types can be used as base classes
+from rpytest.lazy import _rpytest_lazy
+
+
+def test_lazy_init():
+    # nothing is registered until it's used
+    assert "LazyBase" not in vars(_rpytest_lazy)
+    assert "LazyOther" not in vars(_rpytest_lazy)
+
+    import rpytest.lazy
+
+    assert rpytest.lazy.LazyOther().otherFn() == 2
+    assert "LazyOther" in vars(_rpytest_lazy)
+    assert "LazyBase" not in vars(_rpytest_lazy)
+
+    # importing a subclass from another package registers the base classes
+    from rpytest.lazychild import LazyChild, LazyTmplChild
+
+    assert "LazyBase" in vars(_rpytest_lazy)
+
+    child = LazyChild()
+    assert isinstance(child, rpytest.lazy.LazyBase)
+    assert child.baseFn() == 1
+    assert child.childFn() == 4
+
+    tmpl_child = LazyTmplChild()
+    assert isinstance(tmpl_child, rpytest.lazy.LazyTmplInt)
+    assert tmpl_child.tmplFn() == 3
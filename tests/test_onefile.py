@@ -0,0 +1,11 @@
+# ensures the generation data of a wrapper can be a single file
+import rpytest.onefile
+
+
+def test_onefile_fn():
+    assert rpytest.onefile.onefile_fn() == 0x1
+    assert rpytest.onefile.onefile2_fn() == 0x3
+
+
+def test_onefile_class():
+    assert rpytest.onefile.OnefileClass().fnRenamed() == 0x2
@@ -0,0 +1,60 @@
+#
+# Tests for deciding which headers can share a translation unit
+#
+
+import CppHeaderParser
+
+from robotpy_build import partition
+from robotpy_build.generator_data import HooksDataYaml
+from robotpy_build.hooks_datacfg import ClassData
+
+
+def _header(content):
+    header = CppHeaderParser.CppHeader(content, argType="string")
+    for cls in header.classes.values():
+        cls["data"] = ClassData()
+    header.classes = list(header.classes.values())
+    return header
+
+
+def test_can_batch():
+    header = _header("struct A { void fn(); };\nvoid fn();\n")
+    assert partition.can_batch(header, HooksDataYaml(), [])
+
+
+def test_can_batch_file_scope():
+    data = HooksDataYaml()
+
+    # using directives and declarations
+    header = _header("namespace ns { struct A { void fn(); }; }\n")
+    assert not partition.can_batch(header, data, [])
+    header = _header("namespace ns { struct A {}; }\nusing ns::A;\n")
+    assert not partition.can_batch(header, data, [])
+
+    # type aliases
+    header = _header("struct A {};\n")
+    assert not partition.can_batch(header, data, ["using B = A"])
+
+    # holder type casters
+    header = _header("struct A {};\n")
+    header.classes[0]["data"] = ClassData(nodelete=True)
+    assert not partition.can_batch(header, data, [])
+
+    # and includes that must come first
+    data = HooksDataYaml(extra_includes_first=["first.h"])
+    assert not partition.can_batch(_header("struct A {};\n"), data, [])
+
+
+def test_can_batch_typealias():
+    header = _header("struct A {};\nusing B = A;\n")
+    assert partition.can_batch(header, HooksDataYaml(), [])
+
+
+def test_can_batch_namespaces():
+    # both headers use the unqualified name Item, which would be ambiguous
+    # once both using directives are in the same translation unit
+    data = HooksDataYaml()
+    ns1 = _header("namespace tu1 { struct Item {}; struct User { void use(Item); }; }")
+    ns2 = _header("namespace tu2 { struct Item {}; struct User { void use(Item); }; }")
+    assert not partition.can_batch(ns1, data, [])
+    assert not partition.can_batch(ns2, data, [])
@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from robotpy_build.preprocess import (
+    IncludeCache,
+    PreprocessorError,
+    get_cxx_preprocessor,
+    preprocess_file,
+    preprocess_file_cxx,
+)
+
+
+@pytest.fixture
+def headers(tmp_path, monkeypatch):
+    # pcpp refers to files relative to the current directory
+    monkeypatch.chdir(tmp_path)
+
+    (tmp_path / "inc.h").write_text(
+        "#pragma once\n"
+        "#define TWICE(x) ((x) + (x))\n"
+        "#if defined(USE_ONE)\n"
+        "#define INC_VALUE TWICE(ONE)\n"
+        "#else\n"
+        "#define INC_VALUE TWICE(__LINE__)\n"
+        "#endif\n"
+    )
+    (tmp_path / "a.h").write_text(
+        '#define ONE 1\n#define USE_ONE\n#include "inc.h"\nint a = INC_VALUE + VALUE;\n'
+    )
+    (tmp_path / "b.h").write_text('#include "inc.h"\nint b = INC_VALUE + VALUE;\n')
+    return tmp_path
+
+
+def test_include_cache(headers):
+    cache = IncludeCache()
+
+    # the same tokens are shared by every header, and are expanded
+    # differently depending on the macros that are defined
+    for fname in ["a.h", "b.h", "a.h", "b.h"]:
+        for value in ["1", "2"]:
+            defines = [f"VALUE {value}"]
+            expected = preprocess_file(fname, ["."], defines)
+            assert preprocess_file(fname, ["."], defines, cache) == expected
+
+    assert cache.misses == 3
+    assert cache.hits == 13
+
+
+def test_include_cache_modified(headers):
+    cache = IncludeCache()
+    assert "int b" in preprocess_file("b.h", ["."], [], cache).content
+
+    (headers / "b.h").write_text('#include "inc.h"\nint changed;\n')
+    st = os.stat(headers / "b.h")
+    os.utime(headers / "b.h", ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    assert "int changed" in preprocess_file("b.h", ["."], [], cache).content
+
+
+def _parse(result):
+    import CppHeaderParser
+
+    header = CppHeaderParser.CppHeader(
+        result.content, argType="string", preprocessed=True
+    )
+
+    def _fn(fn):
+        params = [(p["type"], p["name"]) for p in fn["parameters"]]
+        return (fn["name"], fn["rtnType"], params, fn["line_number"])
+
+    return (
+        [
+            (
+                cls["name"],
+                cls["line_number"],
+                [_fn(m) for m in cls["methods"]["public"]],
+            )
+            for cls in header.classes_order
+        ],
+        [_fn(fn) for fn in header.functions],
+    )
+
+
+def test_cxx_backend(headers):
+    cxx = get_cxx_preprocessor()
+    if cxx is None:
+        pytest.skip("C++ compiler not found")
+
+    (headers / "c.h").write_text(
+        "#pragma once\n"
+        '#include "inc.h"\n'
+        "\n"
+        "#if defined(EMPTY) && TABBED == 2\n"
+        "struct EMPTY Both {\n"
+        "    int JOIN(x, 1)(int y);\n"
+        "};\n"
+        "#endif\n"
+        "\n"
+        "#if __cplusplus >= 201703L\n"
+        "inline EMPTY int fn(int a) { return INC_VALUE; }\n"
+        "#endif\n"
+    )
+
+    defines = [
+        "__cplusplus 201703L",
+        "EMPTY",
+        "TABBED\t2",
+        "JOIN(a, b) a##b",
+    ]
+
+    expected = preprocess_file("c.h", ["."], defines)
+    result = preprocess_file_cxx("c.h", ["."], defines, cxx)
+
+    assert os.path.abspath("inc.h") in result.included
+    assert _parse(result) == _parse(expected)
+    assert _parse(result) == (
+        [("Both", 5, [("x1", "int", [("int", "y")], 6)])],
+        [("fn", "int", [("int", "a")], 11)],
+    )
+
+    # the compiler can't be told to use this version, so pcpp must be used
+    with pytest.raises(PreprocessorError):
+        preprocess_file_cxx("c.h", ["."], ["__cplusplus 199711L"], cxx)
@@ -0,0 +1,102 @@
+#
+# Tests for the cache of compiler flag checks
+#
+
+import os
+from os.path import join
+import sys
+
+import pytest
+import setuptools
+
+from robotpy_build.command import build_ext
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="uses shell scripts as compilers"
+)
+
+
+def make_exe(path, version):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fp:
+        fp.write(f"#!/bin/sh\necho {version}\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+class Compiler:
+    """Supports the flags in supported, and counts the checks"""
+
+    compiler_type = "unix"
+
+    def __init__(self, cmd, supported):
+        self.compiler_so = cmd
+        self.supported = supported
+        self.checked = []
+
+    def compile(self, sources, output_dir, extra_postargs):
+        (flag,) = extra_postargs
+        self.checked.append(flag)
+        if flag not in self.supported:
+            raise setuptools.distutils.errors.CompileError(flag)
+
+
+@pytest.fixture
+def bindir(tmp_path, monkeypatch):
+    monkeypatch.delenv("RPYBUILD_CC_LAUNCHER", raising=False)
+    monkeypatch.setenv("PATH", str(tmp_path / "bin"))
+    return tmp_path / "bin"
+
+
+def test_find_compiler_launcher(bindir):
+    gxx = make_exe(str(bindir / "g++"), "g++ 1.0")
+    make_exe(str(bindir / "ccache"), "ccache 4.0")
+
+    assert build_ext.find_compiler(["g++", "-O2"]) == gxx
+    assert build_ext.find_compiler(["ccache", "g++", "-O2"]) == gxx
+    assert build_ext.find_compiler(["missing", "-O2"]) is None
+
+
+def test_find_compiler_symlink(bindir, tmp_path, monkeypatch):
+    # as set up by distributions, /usr/lib/ccache/g++ -> /usr/bin/ccache
+    ccache = make_exe(str(bindir / "ccache"), "ccache 4.0")
+    gxx = make_exe(str(bindir / "g++"), "g++ 1.0")
+    linkdir = tmp_path / "ccache"
+    linkdir.mkdir()
+    os.symlink(ccache, str(linkdir / "g++"))
+
+    monkeypatch.setenv("PATH", os.pathsep.join([str(linkdir), str(bindir)]))
+    assert build_ext.find_compiler(["g++", "-O2"]) == gxx
+
+
+def test_custom_launcher(bindir, monkeypatch):
+    gxx = make_exe(str(bindir / "g++"), "g++ 1.0")
+    make_exe(str(bindir / "mylauncher"), "mylauncher 1.0")
+
+    monkeypatch.setenv("RPYBUILD_CC_LAUNCHER", "mylauncher")
+    assert build_ext.find_compiler(["mylauncher", "g++"]) == gxx
+
+
+def test_probe_cache(bindir, tmp_path):
+    make_exe(str(bindir / "g++"), "g++ 1.0")
+    make_exe(str(bindir / "ccache"), "ccache 4.0")
+    fname = str(tmp_path / "probes.json")
+
+    compiler = Compiler(["ccache", "g++"], {"-std=c++17"})
+    probes = build_ext.ProbeCache(compiler, fname)
+    assert build_ext.cxx_std(compiler, probes) == 17
+    assert compiler.checked == ["-std=c++20", "-std=c++17"]
+
+    # only supported flags are remembered
+    compiler = Compiler(["ccache", "g++"], {"-std=c++17"})
+    probes = build_ext.ProbeCache(compiler, fname)
+    assert build_ext.cxx_std(compiler, probes) == 17
+    assert compiler.checked == ["-std=c++20"]
+
+    # the compiler's version is part of the key, not the launcher's
+    make_exe(str(bindir / "g++"), "g++ 2.0")
+    os.utime(join(str(bindir), "g++"), ns=(0, 0))
+    compiler = Compiler(["ccache", "g++"], {"-std=c++11"})
+    probes = build_ext.ProbeCache(compiler, fname)
+    assert build_ext.cxx_std(compiler, probes) == 11
+    assert compiler.checked[-1] == "-std=c++11"
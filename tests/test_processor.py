@@ -0,0 +1,42 @@
+#
+# Tests for writing generated files
+#
+
+import os
+
+from robotpy_build.processor import OutputWriter
+
+
+def test_output_writer(tmp_path):
+    fname = str(tmp_path / "a.cpp")
+    other = str(tmp_path / "b.cpp")
+
+    writer = OutputWriter()
+    assert writer.write(fname, "a\n")
+    assert writer.write(other, "b\n")
+    os.utime(fname, ns=(0, 0))
+    os.utime(other, ns=(0, 0))
+
+    # unchanged content leaves the file alone
+    writer = OutputWriter()
+    assert not writer.write(fname, "a\n")
+    assert os.stat(fname).st_mtime_ns == 0
+    assert writer.unchanged == {fname}
+
+    # and changed content is written
+    assert writer.write(other, "c\n")
+    assert os.stat(other).st_mtime_ns != 0
+    with open(other) as fp:
+        assert fp.read() == "c\n"
+    assert writer.changed == {other}
+
+    # a file written earlier in the same run stays changed
+    assert not writer.write(other, "c\n")
+    assert writer.changed == {other}
+    assert writer.unchanged == {fname}
+
+    # files that weren't written are removed
+    stale = tmp_path / "stale.cpp"
+    stale.write_text("")
+    writer.remove_unwritten(str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ["a.cpp", "b.cpp"]
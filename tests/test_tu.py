@@ -0,0 +1,21 @@
+# ensures that a wrapper whose translation units are split and batched
+# (tu_cost) built correctly
+import rpytest.tu
+
+
+def test_tu_batched():
+    assert rpytest.tu.tu_a_fn() == 0xA
+    assert rpytest.tu.tu_b_fn() == 0xB
+
+
+def test_tu_namespaces():
+    # these use unqualified names, and are never batched together
+    assert rpytest.tu.tu1.User().use(rpytest.tu.tu1.Item()) == 1
+    assert rpytest.tu.tu2.User().use(rpytest.tu.tu2.Item()) == 2
+    assert rpytest.tu.tu2.User().use(3) == 3
+
+
+def test_tu_split():
+    assert rpytest.tu.TUSplit1().fn1() == 1
+    assert rpytest.tu.TUSplit2().fn2() == 6
+    assert rpytest.tu.TUSplit3().fn4() == 12